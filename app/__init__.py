@@ -11,7 +11,7 @@ from flask import Flask
 from flask_login import LoginManager
 from flask_cors import CORS
 from apscheduler.schedulers.background import BackgroundScheduler
-from app.commands import create_tables
+from app.commands import create_tables, build_duplicate_index, import_legacy_data, check_bulk_parity
 from app.models.app_user import SMAppUser
 from config import Config
 from app.extensions import db, socketio
@@ -52,8 +52,11 @@ def create_app() -> Flask:
     login_manager.login_view = 'main.login'
     # Register CLI commands
     app.cli.add_command(create_tables)
+    app.cli.add_command(build_duplicate_index)
+    app.cli.add_command(import_legacy_data)
+    app.cli.add_command(check_bulk_parity)
     # запускаем фоновые задачи
-    from app.main.sync.run import run_amo_data_sync, run_pivot_data_builder
+    from app.main.sync.run import run_amo_data_sync, run_amo_data_backfill, run_pivot_data_builder
     for branch in ('sm', ):
         # загрузка данных из Amo
         app.scheduler.add_job(
@@ -64,6 +67,15 @@ def create_app() -> Flask:
             seconds=60,
             max_instances=1
         )
+        # догрузка истории из Amo (с ограничением по количеству окон за запуск)
+        app.scheduler.add_job(
+            id=f'amo_data_backfill_{branch}',
+            func=socketio.start_background_task,
+            args=[run_amo_data_backfill, app, branch],
+            trigger='interval',
+            seconds=300,
+            max_instances=1
+        )
         # обновление данных для сводных таблиц
         # app.scheduler.add_job(
         #     id=f'update_pivot_data_{branch}',
@@ -73,5 +85,15 @@ def create_app() -> Flask:
         #     seconds=60,
         #     max_instances=1
         # )
+    # разбор очереди входящих webhook (новые записи будят обработку сразу, задача подбирает повторы)
+    from app.main.webhooks.run import run as run_webhook_queue
+    app.scheduler.add_job(
+        id='webhook_queue',
+        func=socketio.start_background_task,
+        args=[run_webhook_queue, app],
+        trigger='interval',
+        seconds=Config().webhook_queue['interval'],
+        max_instances=1
+    )
     app.scheduler.start()
     return app
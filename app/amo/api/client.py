@@ -6,10 +6,14 @@ import os
 from datetime import datetime
 import random
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep, time
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Union
+from flask import current_app, has_app_context
 from app.extensions import db
 from app.amo.api.constants import AmoEvent
+from app.amo.api.fetch_scheduler import get_rate_limiter
+from app.amo.api.session import get_session, get_timeout
 from app.models.amo_credentials import CDVAmoCredentials, SMAmoCredentials
 from app.models.amo_token import SMAmoToken, CDVAmoToken
 from app.models.contact import SMContact, CDVContact
@@ -18,12 +22,13 @@ from app.models.lead import CDVLead, SMLead
 from app.models.note import SMNote, CDVNote
 from app.models.pipeline import CDVPipeline, SMPipeline
 from app.models.user import SMUser, CDVUser
+from config import Config
 
 ERROR_SLEEP_INTERVAL = 5
 REQUEST_SLEEP_INTERVAL = 1
 DATA_LIMIT = 50     # Больше 50 не ставить, т.к. по контактам, к примеру, ограничение 50
+IDS_CHUNK_SIZE = 250   # идентификаторов в одном запросе filter[id][] (get_leads_by_ids, get_contacts_by_ids)
 
-MULTI_PROCESS = False
 
 
 class APIClient:
@@ -45,6 +50,11 @@ class APIClient:
         # self.token_pkl: str = f'{self.sub_domain}_token'
         # self.amo_settings_pkl: str = f'amo_{self.sub_domain}_settings'
         self.session = db.session
+        # общая keep-alive сессия поддомена (пул соединений)
+        self.http = get_session(self.sub_domain)
+        self.timeout = get_timeout()
+        # ограничение частоты запросов (общее для всех клиентов поддомена)
+        self.rate_limiter = get_rate_limiter(self.sub_domain)
 
         # # fixme tmp
         # credentials = self.credentials(
@@ -106,7 +116,12 @@ class APIClient:
             "content_type": mime_type,
             # "file_uuid": "367b9f38-5f01-4cea-947e-dfab47aea522"
         }
-        response = requests.post(url=f"{drive_url}/v1.0/sessions", headers=self.headers, json=data)
+        response = self.http.post(
+            url=f"{drive_url}/v1.0/sessions",
+            headers=self.headers,
+            json=data,
+            timeout=self.timeout
+        )
         if response.status_code != 200:
             return
         session = response.json()
@@ -120,7 +135,7 @@ class APIClient:
                 file_chunk = f.read(chunk_size)
                 if not file_chunk:
                     break
-                response = requests.post(upload_url, headers=headers, data=file_chunk)
+                response = self.http.post(upload_url, headers=headers, data=file_chunk, timeout=self.timeout)
                 # Обработка ответа для каждой части
                 try:
                     response.raise_for_status()
@@ -297,7 +312,11 @@ class APIClient:
         Returns:
             список воронок
         """
-        response = requests.get(url=self.__get_url(endpoint='pipelines', entity='leads'), headers=self.headers)
+        response = self.http.get(
+            url=self.__get_url(endpoint='pipelines', entity='leads'),
+            headers=self.headers,
+            timeout=self.timeout
+        )
         json_response = response.json()
         return (json_response.get('_embedded') or {}).get('pipelines') or []
 
@@ -522,7 +541,7 @@ class APIClient:
         self.session.add(credentials)
         self.session.commit()
         # меняем код авторизации на токен
-        response = requests.post(
+        response = self.http.post(
             url=f'https://{self.sub_domain}.amocrm.ru/oauth2/access_token',
             data={
                 'client_id': client_id,
@@ -530,7 +549,8 @@ class APIClient:
                 'grant_type': 'authorization_code',
                 'code': auth_code,
                 'redirect_uri': redirect_url
-            }
+            },
+            timeout=self.timeout
         )
         response_json = response.json()
         if 'access_token' in response_json:
@@ -548,7 +568,7 @@ class APIClient:
         token_data = self.__get_token_data()
         if not token_data:
             return
-        response = requests.post(
+        response = self.http.post(
             url=f'https://{self.sub_domain}.amocrm.ru/oauth2/access_token',
             data={
                 'client_id': self._client_id,
@@ -556,7 +576,8 @@ class APIClient:
                 'grant_type': 'refresh_token',
                 'refresh_token': token_data.refresh_token,
                 'redirect_uri': self._redirect_url
-            }
+            },
+            timeout=self.timeout
         )
         response_json = response.json()
         if 'access_token' in response_json:
@@ -571,7 +592,7 @@ class APIClient:
 
     def test_request(self):
         """ Проверочный запрос, чтобы убедиться, что токен жив """
-        response = requests.get(url=self.__get_url(f'leads/pipelines'), headers=self.headers)
+        response = self.http.get(url=self.__get_url(f'leads/pipelines'), headers=self.headers, timeout=self.timeout)
         if response.status_code == 401:
             self.refresh_token()
             self._set_auth_headers()
@@ -648,8 +669,86 @@ class APIClient:
             event_types=[stage.value for stage in AmoEvent],
         )
 
-    def p_get_data(self, args):
-        return self.__get_data(*args)
+    def p_get_data(self, kwargs: Dict) -> List[Dict]:
+        """ Получение данных с эндпоинта целиком (для параллельной загрузки)
+
+        Args:
+            kwargs: именованные аргументы для __get_data
+
+        Returns:
+            данные из AMO
+        """
+        return list(self.__get_data(**kwargs))
+
+    def __load_chunks(self, tasks_list: List[Dict], max_workers: int) -> List[List[Dict]]:
+        """ Параллельная загрузка пакетов данных (частоту запросов ограничивает общий rate limiter поддомена)
+
+        Args:
+            tasks_list: именованные аргументы __get_data для каждого пакета
+            max_workers: количество одновременно загружаемых пакетов
+
+        Returns:
+            данные пакетов в исходном порядке
+        """
+        if len(tasks_list) < 2:
+            return [self.p_get_data(kwargs) for kwargs in tasks_list]
+        # пакеты загружаются пулом потоков, map сохраняет исходный порядок пакетов
+        app = current_app._get_current_object() if has_app_context() else None
+
+        def load_chunk(kwargs: Dict) -> List[Dict]:
+            if app is None:
+                return self.p_get_data(kwargs)
+            with app.app_context():
+                return self.p_get_data(kwargs)
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(load_chunk, tasks_list))
+
+    def __get_by_ids(self, endpoint: str, ids: Iterable[Union[int, str]], params: str = '') -> Dict[int, Dict]:
+        """ Получение записей по списку идентификаторов: пакетами по IDS_CHUNK_SIZE через filter[id][]
+
+        Args:
+            endpoint: адрес запроса (leads, contacts)
+            ids: идентификаторы записей
+            params: дополнительные параметры запроса
+
+        Returns:
+            словарь вида { id: запись } (записи, которых нет в Amo, в словарь не попадают)
+        """
+        ids = list(dict.fromkeys(int(_id) for _id in ids if _id))
+        tasks_list = []
+        for i in range(0, len(ids), IDS_CHUNK_SIZE):
+            str_ids = '&filter[id][]='.join(map(str, ids[i:i + IDS_CHUNK_SIZE]))
+            chunk_params = f'filter[id][]={str_ids}&limit={IDS_CHUNK_SIZE}'
+            tasks_list.append({
+                'endpoint': endpoint,
+                'params': f'{params}&{chunk_params}' if params else chunk_params,
+                'limit': IDS_CHUNK_SIZE
+            })
+        chunks = self.__load_chunks(tasks_list=tasks_list, max_workers=Config().amo_http['max_concurrency'])
+        return {item['id']: item for chunk in chunks for item in chunk or []}
+
+    def get_leads_by_ids(self, lead_ids: Iterable[Union[int, str]]) -> Dict[int, Dict]:
+        """ Получение сделок (с контактами и причиной отказа) по списку идентификаторов
+
+        Args:
+            lead_ids: идентификаторы сделок
+
+        Returns:
+            словарь вида { id: сделка }
+        """
+        return self.__get_by_ids(endpoint='leads', ids=lead_ids, params='with=contacts,loss_reason')
+
+    def get_contacts_by_ids(self, contact_ids: Iterable[Union[int, str]]) -> Dict[int, Dict]:
+        """ Получение контактов по списку идентификаторов
+
+        Args:
+            contact_ids: идентификаторы контактов
+
+        Returns:
+            словарь вида { id: контакт }
+        """
+        return self.__get_by_ids(endpoint='contacts', ids=contact_ids)
 
     def load_events(self, lead_ids: List[int], event_types: List[str]) -> List[Dict]:
         """ Получить список событий, связанных со сделками
@@ -659,7 +758,7 @@ class APIClient:
             event_types: типы событий
 
         Returns:
-            список событий
+            список событий (в порядке следования пакетов сделок)
         """
         result = []
         if not lead_ids:
@@ -670,48 +769,34 @@ class APIClient:
         # см. https://www.amocrm.ru/developers/content/crm_platform/events-and-notes#events-types
         step = 10
         steps = total // step + 1
-
-        if MULTI_PROCESS:
-            # готовим список параметров для параллельной загрузки
-            processes_num = 5
-            tasks_list = []
-            for x in range(steps):
-                beg = x * step
-                fin = x * step + step
-                str_ids = '&filter[entity_id][]='.join(map(str, lead_ids[beg:fin]))
-                if not str_ids:
-                    break
-                params = f'filter[entity_id][]={str_ids}' \
-                         f'&filter[entity]=lead' \
-                         f'&filter[type][]={str_statuses}' \
-                         f'&limit={step}' \
-                         f'&order=created_at'
-                # здесь важен правильный порядок аргументов
-                tasks_list.append(('events', params, None, None, step))
-            # запускаем параллельную загрузку
-            chunks_dict = object     # fixme 2023-6 ParallelWorker(processes=processes_num).start(func=self.p_get_data, tasks_list=tasks_list)
-            for chunk in chunks_dict.values():
-                if not chunk:
-                    continue
-                result.extend(chunk)
+        # готовим список параметров: один запрос на каждый пакет сделок
+        tasks_list = []
+        for x in range(steps):
+            beg = x * step
+            fin = x * step + step
+            str_ids = '&filter[entity_id][]='.join(map(str, lead_ids[beg:fin]))
+            if not str_ids:
+                break
+            params = f'filter[entity_id][]={str_ids}' \
+                     f'&filter[entity]=lead' \
+                     f'&filter[type][]={str_statuses}' \
+                     f'&limit={step}' \
+                     f'&order=created_at'
+            tasks_list.append({
+                'endpoint': 'events',
+                'params': params,
+                'limit': step,
+                'msg': f'Получение событий: {x + 1} из {steps}'
+            })
+        config = Config().amo_http
+        if config['parallel_events']:
+            chunks = self.__load_chunks(tasks_list=tasks_list, max_workers=config['events_workers'])
         else:
-            for x in range(steps):
-                beg = x * step
-                fin = x * step + step
-                msg = f'Получение событий: {x + 1} из {steps}'
-                str_ids = '&filter[entity_id][]='.join(map(str, lead_ids[beg:fin]))
-                if not str_ids:
-                    break
-                params = f'filter[entity_id][]={str_ids}' \
-                         f'&filter[entity]=lead' \
-                         f'&filter[type][]={str_statuses}' \
-                         f'&limit={step}' \
-                         f'&order=created_at'
-                chunk = self.__get_data(endpoint='events', params=params, limit=step, msg=msg)
-                if not chunk:
-                    continue
-                result.extend(chunk)
-
+            chunks = (self.p_get_data(kwargs) for kwargs in tasks_list)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            result.extend(chunk)
         return result
 
     def _get_leads(self, date_from: datetime, date_to: datetime) -> List[Dict]:
@@ -854,7 +939,11 @@ class APIClient:
             }
         """
         result = {}
-        response = requests.get(url=self.__get_url(endpoint='pipelines', entity='leads'), headers=self.headers)
+        response = self.http.get(
+            url=self.__get_url(endpoint='pipelines', entity='leads'),
+            headers=self.headers,
+            timeout=self.timeout
+        )
         json_response = response.json()
         pipelines = (json_response.get('_embedded') or {}).get('pipelines') or []
         for pipeline in pipelines:
@@ -1057,26 +1146,30 @@ class APIClient:
         """
         response = None
         while not response:
+            self.rate_limiter.acquire()
             try:
                 if method == 'GET':
-                    response = requests.get(
+                    response = self.http.get(
                         url=self.__get_url(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id),
-                        headers=self.headers
+                        headers=self.headers,
+                        timeout=self.timeout
                     )
                     # todo вот тут надо бы обработать всякие 401 - "не авторизован"
                     # print(response.text)
                 elif method == 'PATCH':
-                    response = requests.patch(
+                    response = self.http.patch(
                         url=self.__get_url(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id),
                         headers=self.headers,
-                        data=json.dumps(data)
+                        data=json.dumps(data),
+                        timeout=self.timeout
                     )
                     return response
                 elif method == 'POST':
-                    response = requests.post(
+                    response = self.http.post(
                         url=self.__get_url(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id),
                         headers=self.headers,
-                        json=data
+                        json=data,
+                        timeout=self.timeout
                     )
                     return response
                 else:
@@ -1092,7 +1185,7 @@ class APIClient:
                     print('refreshing token')
                     self.refresh_token()
                     self._set_auth_headers()
-            except requests.exceptions.ConnectionError:
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                 # повторный запрос
                 sleep(REQUEST_SLEEP_INTERVAL)
             except Exception as exc:
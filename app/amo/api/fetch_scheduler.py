@@ -0,0 +1,132 @@
+""" Планировщик запросов к API Amo: ограничение частоты запросов и параллельная загрузка страниц """
+__author__ = 'ke.mizonov'
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from time import monotonic, sleep
+from typing import Callable, Dict, Iterator, List, Optional
+from config import Config
+
+limiters: Dict[str, 'TokenBucket'] = {}
+lock = threading.Lock()
+
+
+class TokenBucket:
+    """ Ограничитель частоты запросов по алгоритму "ведро токенов" (потокобезопасный) """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None):
+        """
+        Args:
+            rate: скорость пополнения ведра, токенов (запросов) в секунду
+            capacity: емкость ведра (максимальный "всплеск" запросов), по умолчанию равна rate
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self.__tokens = self.capacity
+        self.__updated_at = monotonic()
+        self.__lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        """ Забирает токены из ведра, при необходимости дожидаясь их появления
+
+        Args:
+            tokens: количество забираемых токенов
+        """
+        while True:
+            with self.__lock:
+                now = monotonic()
+                self.__tokens = min(self.capacity, self.__tokens + (now - self.__updated_at) * self.rate)
+                self.__updated_at = now
+                if self.__tokens >= tokens:
+                    self.__tokens -= tokens
+                    return
+                delay = (tokens - self.__tokens) / self.rate
+            sleep(delay)
+
+
+def get_rate_limiter(sub_domain: str) -> TokenBucket:
+    """ Синглтон ограничителя частоты запросов для поддомена Amo
+
+    Args:
+        sub_domain: поддомен Amo (swissmedica, drvorobjev, ...)
+
+    Returns:
+        общий для всех клиентов поддомена ограничитель
+    """
+    limiter = limiters.get(sub_domain)
+    if limiter is not None:
+        return limiter
+    with lock:
+        limiter = limiters.get(sub_domain)
+        if limiter is None:
+            rate = Config().amo_http['requests_per_second']
+            limiter = limiters[sub_domain] = TokenBucket(rate=rate)
+    return limiter
+
+
+class PageFetcher:
+    """ Загружает страницы выдачи Amo, держа в работе несколько запросов одновременно
+
+    Число страниц заранее неизвестно: выдача заканчивается на первой странице,
+        которая вернула меньше записей, чем limit (либо не вернула ничего)
+    """
+
+    def __init__(self, fetch_page: Callable[[int], Optional[List[Dict]]], limit: int, max_concurrency: int = 1):
+        """
+        Args:
+            fetch_page: функция загрузки страницы по номеру (нумерация с 1), None - данных нет
+            limit: размер страницы
+            max_concurrency: предельное количество одновременных запросов
+        """
+        self.fetch_page = fetch_page
+        self.limit = limit
+        self.max_concurrency = max(1, max_concurrency)
+
+    def pages(self) -> Iterator[List[Dict]]:
+        """ Страницы выдачи в порядке их получения
+
+        Yields:
+            записи очередной страницы
+        """
+        # первую страницу читаем отдельно: большинство выборок в нее и укладывается
+        chunk = self.fetch_page(1)
+        if chunk is None:
+            return
+        yield chunk
+        if len(chunk) < self.limit:
+            return
+        if self.max_concurrency == 1:
+            yield from self.__sequential_pages(first_page=2)
+        else:
+            yield from self.__concurrent_pages(first_page=2)
+
+    def __sequential_pages(self, first_page: int) -> Iterator[List[Dict]]:
+        page = first_page
+        while True:
+            chunk = self.fetch_page(page)
+            if chunk is None:
+                break
+            yield chunk
+            if len(chunk) < self.limit:
+                break
+            page += 1
+
+    def __concurrent_pages(self, first_page: int) -> Iterator[List[Dict]]:
+        next_page = first_page
+        last_page = None
+        in_flight = {}
+        with ThreadPoolExecutor(max_workers=self.max_concurrency) as executor:
+            while True:
+                # пока конец выдачи не найден, держим в работе max_concurrency запросов
+                while last_page is None and len(in_flight) < self.max_concurrency:
+                    in_flight[executor.submit(self.fetch_page, next_page)] = next_page
+                    next_page += 1
+                if not in_flight:
+                    break
+                done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+                for future in done:
+                    page = in_flight.pop(future)
+                    chunk = future.result()
+                    if chunk is None or len(chunk) < self.limit:
+                        last_page = page if last_page is None else min(last_page, page)
+                    if chunk and (last_page is None or page <= last_page):
+                        yield chunk
@@ -0,0 +1,66 @@
+""" Пул keep-alive HTTP-сессий для обращения к API Amo """
+__author__ = 'ke.mizonov'
+import threading
+from typing import Dict, Optional, Tuple
+import requests
+from requests.adapters import HTTPAdapter
+from config import Config
+
+sessions: Dict[str, requests.Session] = {}
+lock = threading.Lock()
+
+
+def get_session(sub_domain: str) -> requests.Session:
+    """ Синглтон HTTP-сессии для поддомена Amo
+
+    Сессия держит пул keep-alive соединений, поэтому повторные запросы к *.amocrm.ru
+        не тратят время на TCP+TLS рукопожатие
+
+    Args:
+        sub_domain: поддомен Amo (swissmedica, drvorobjev, ...)
+
+    Returns:
+        общая для всех клиентов поддомена HTTP-сессия
+    """
+    session = sessions.get(sub_domain)
+    if session is not None:
+        return session
+    with lock:
+        # пока ждали блокировку, сессию мог создать другой поток
+        session = sessions.get(sub_domain)
+        if session is None:
+            session = sessions[sub_domain] = __build_session()
+    return session
+
+
+def get_timeout() -> Tuple[float, float]:
+    """ Таймауты (на соединение, на чтение) для запросов к Amo """
+    config = Config().amo_http
+    return config['connect_timeout'], config['read_timeout']
+
+
+def close_sessions(sub_domain: Optional[str] = None):
+    """ Закрывает сессию поддомена (либо все сессии), освобождая соединения пула
+
+    Args:
+        sub_domain: поддомен Amo, если не задан - закрываются все сессии
+    """
+    with lock:
+        keys = [sub_domain] if sub_domain else list(sessions.keys())
+        for key in keys:
+            session = sessions.pop(key, None)
+            if session is not None:
+                session.close()
+
+
+def __build_session() -> requests.Session:
+    config = Config().amo_http
+    adapter = HTTPAdapter(
+        pool_connections=config['pool_connections'],
+        pool_maxsize=config['pool_size'],
+        pool_block=True
+    )
+    session = requests.Session()
+    session.mount('https://', adapter)
+    session.mount('http://', adapter)
+    return session
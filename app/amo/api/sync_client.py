@@ -4,15 +4,18 @@ import json
 import mimetypes
 import os
 from datetime import datetime
-import random
 import requests
+from concurrent.futures import ThreadPoolExecutor
 from time import sleep, time
 from typing import Dict, List, Optional, Union, Type
-
+from flask import current_app, has_app_context
 from app.amo.api.sync_controller import SMSyncController, CDVSyncController
+from app.amo.processor.references import invalidate_references
 from app.engine import get_engine
 from app.extensions import db
 from app.amo.api.constants import AmoEvent
+from app.amo.api.fetch_scheduler import PageFetcher, get_rate_limiter
+from app.amo.api.session import get_session, get_timeout
 from app.models.amo_credentials import CDVAmoCredentials, SMAmoCredentials
 from app.models.amo_token import SMAmoToken, CDVAmoToken
 from app.models.contact import SMContact, CDVContact
@@ -21,12 +24,12 @@ from app.models.lead import CDVLead, SMLead
 from app.models.note import SMNote, CDVNote
 from app.models.pipeline import CDVPipeline, SMPipeline
 from app.models.user import SMUser, CDVUser
+from config import Config
 
 ERROR_SLEEP_INTERVAL = 5
 REQUEST_SLEEP_INTERVAL = 1
 DATA_LIMIT = 50     # Больше 50 не ставить, т.к. по контактам, к примеру, ограничение 50
 
-MULTI_PROCESS = False
 
 TSyncController = Union[Type[SMSyncController], Type[CDVSyncController]]
 
@@ -51,6 +54,12 @@ class APIClient:
         # self.token_pkl: str = f'{self.sub_domain}_token'
         # self.amo_settings_pkl: str = f'amo_{self.sub_domain}_settings'
         self.session = db.session
+        # общая keep-alive сессия поддомена (пул соединений)
+        self.http = get_session(self.sub_domain)
+        self.timeout = get_timeout()
+        # ограничение частоты запросов и количество одновременно загружаемых страниц
+        self.rate_limiter = get_rate_limiter(self.sub_domain)
+        self.max_concurrency = Config().amo_http['max_concurrency']
         self.sync_controller = self.sync_controller_class()
 
         # # fixme tmp
@@ -113,7 +122,12 @@ class APIClient:
             "content_type": mime_type,
             # "file_uuid": "367b9f38-5f01-4cea-947e-dfab47aea522"
         }
-        response = requests.post(url=f"{drive_url}/v1.0/sessions", headers=self.headers, json=data)
+        response = self.http.post(
+            url=f"{drive_url}/v1.0/sessions",
+            headers=self.headers,
+            json=data,
+            timeout=self.timeout
+        )
         if response.status_code != 200:
             return
         session = response.json()
@@ -127,7 +141,7 @@ class APIClient:
                 file_chunk = f.read(chunk_size)
                 if not file_chunk:
                     break
-                response = requests.post(upload_url, headers=headers, data=file_chunk)
+                response = self.http.post(upload_url, headers=headers, data=file_chunk, timeout=self.timeout)
                 # Обработка ответа для каждой части
                 try:
                     response.raise_for_status()
@@ -250,13 +264,24 @@ class APIClient:
         """ Получение ссылки на сделку по идентификатору """
         return f'https://{cls.sub_domain}.amocrm.ru/leads/detail/{lead_id}'
 
-    def run(self, date_from: Optional[datetime] = None, date_to: Optional[datetime] = None) -> bool:
+    def run(
+        self,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        with_references: bool = True
+    ) -> bool:
         """
+        Args:
+            date_from: дата с
+            date_to: дата по
+            with_references: синхронизировать также справочники (пользователи, воронки)
+
         Returns:
             True - если на источнике была обнаружена хотя бы одна новая / измененная запись за период
         """
-        self.get_users()
-        self.get_pipelines()
+        if with_references:
+            self.get_users()
+            self.get_pipelines()
         contacts = self.get_contacts(date_from=date_from, date_to=date_to)
         events = self.get_events(date_from=date_from, date_to=date_to)
         leads = self.get_leads(date_from=date_from, date_to=date_to)
@@ -340,7 +365,11 @@ class APIClient:
         Returns:
             True - если получены новые данные
         """
-        return self.get_and_sync_data(endpoint='pipelines', params='', entity='leads', db_table='Pipeline')
+        has_new = self.get_and_sync_data(endpoint='pipelines', params='', entity='leads', db_table='Pipeline')
+        if has_new:
+            # справочники процессора перечитаются при следующем обращении
+            invalidate_references(schema=self.sync_controller.schema)
+        return has_new
 
     def add_lead(self, data: Union[Dict, List]):
         return self.__execute(endpoint='leads/complex', method='POST', data=data)
@@ -540,7 +569,7 @@ class APIClient:
         self.session.add(credentials)
         self.session.commit()
         # меняем код авторизации на токен
-        response = requests.post(
+        response = self.http.post(
             url=f'https://{self.sub_domain}.amocrm.ru/oauth2/access_token',
             data={
                 'client_id': client_id,
@@ -548,7 +577,8 @@ class APIClient:
                 'grant_type': 'authorization_code',
                 'code': auth_code,
                 'redirect_uri': redirect_url
-            }
+            },
+            timeout=self.timeout
         )
         response_json = response.json()
         if 'access_token' in response_json:
@@ -566,7 +596,7 @@ class APIClient:
         token_data = self.__get_token_data()
         if not token_data:
             return
-        response = requests.post(
+        response = self.http.post(
             url=f'https://{self.sub_domain}.amocrm.ru/oauth2/access_token',
             data={
                 'client_id': self._client_id,
@@ -574,7 +604,8 @@ class APIClient:
                 'grant_type': 'refresh_token',
                 'refresh_token': token_data.refresh_token,
                 'redirect_uri': self._redirect_url
-            }
+            },
+            timeout=self.timeout
         )
         response_json = response.json()
         if 'access_token' in response_json:
@@ -589,7 +620,7 @@ class APIClient:
 
     def test_request(self):
         """ Проверочный запрос, чтобы убедиться, что токен жив """
-        response = requests.get(url=self.__get_url(f'leads/pipelines'), headers=self.headers)
+        response = self.http.get(url=self.__get_url(f'leads/pipelines'), headers=self.headers, timeout=self.timeout)
         if response.status_code == 401:
             self.refresh_token()
             self._set_auth_headers()
@@ -666,8 +697,16 @@ class APIClient:
             event_types=[stage.value for stage in AmoEvent],
         )
 
-    def p_get_data(self, args):
-        return self.__get_data(*args)
+    def p_get_data(self, kwargs: Dict) -> List[Dict]:
+        """ Получение данных с эндпоинта целиком (для параллельной загрузки)
+
+        Args:
+            kwargs: именованные аргументы для __get_data
+
+        Returns:
+            данные из AMO
+        """
+        return list(self.__get_data(**kwargs))
 
     def load_events(self, lead_ids: List[int], event_types: List[str]) -> List[Dict]:
         """ Получить список событий, связанных со сделками
@@ -677,7 +716,7 @@ class APIClient:
             event_types: типы событий
 
         Returns:
-            список событий
+            список событий (в порядке следования пакетов сделок)
         """
         result = []
         if not lead_ids:
@@ -688,48 +727,44 @@ class APIClient:
         # см. https://www.amocrm.ru/developers/content/crm_platform/events-and-notes#events-types
         step = 10
         steps = total // step + 1
-
-        if MULTI_PROCESS:
-            # готовим список параметров для параллельной загрузки
-            processes_num = 5
-            tasks_list = []
-            for x in range(steps):
-                beg = x * step
-                fin = x * step + step
-                str_ids = '&filter[entity_id][]='.join(map(str, lead_ids[beg:fin]))
-                if not str_ids:
-                    break
-                params = f'filter[entity_id][]={str_ids}' \
-                         f'&filter[entity]=lead' \
-                         f'&filter[type][]={str_statuses}' \
-                         f'&limit={step}' \
-                         f'&order=created_at'
-                # здесь важен правильный порядок аргументов
-                tasks_list.append(('events', params, None, None, step))
-            # запускаем параллельную загрузку
-            chunks_dict = object     # fixme 2023-6 ParallelWorker(processes=processes_num).start(func=self.p_get_data, tasks_list=tasks_list)
-            for chunk in chunks_dict.values():
-                if not chunk:
-                    continue
-                result.extend(chunk)
+        # готовим список параметров: один запрос на каждый пакет сделок
+        tasks_list = []
+        for x in range(steps):
+            beg = x * step
+            fin = x * step + step
+            str_ids = '&filter[entity_id][]='.join(map(str, lead_ids[beg:fin]))
+            if not str_ids:
+                break
+            params = f'filter[entity_id][]={str_ids}' \
+                     f'&filter[entity]=lead' \
+                     f'&filter[type][]={str_statuses}' \
+                     f'&limit={step}' \
+                     f'&order=created_at'
+            tasks_list.append({
+                'endpoint': 'events',
+                'params': params,
+                'limit': step,
+                'msg': f'Получение событий: {x + 1} из {steps}'
+            })
+        config = Config().amo_http
+        if config['parallel_events'] and len(tasks_list) > 1:
+            # пакеты загружаются пулом потоков, map сохраняет исходный порядок пакетов
+            app = current_app._get_current_object() if has_app_context() else None
+
+            def load_chunk(kwargs: Dict) -> List[Dict]:
+                if app is None:
+                    return self.p_get_data(kwargs)
+                with app.app_context():
+                    return self.p_get_data(kwargs)
+
+            with ThreadPoolExecutor(max_workers=config['events_workers']) as executor:
+                chunks = list(executor.map(load_chunk, tasks_list))
         else:
-            for x in range(steps):
-                beg = x * step
-                fin = x * step + step
-                msg = f'Получение событий: {x + 1} из {steps}'
-                str_ids = '&filter[entity_id][]='.join(map(str, lead_ids[beg:fin]))
-                if not str_ids:
-                    break
-                params = f'filter[entity_id][]={str_ids}' \
-                         f'&filter[entity]=lead' \
-                         f'&filter[type][]={str_statuses}' \
-                         f'&limit={step}' \
-                         f'&order=created_at'
-                chunk = self.__get_data(endpoint='events', params=params, limit=step, msg=msg)
-                if not chunk:
-                    continue
-                result.extend(chunk)
-
+            chunks = (self.p_get_data(kwargs) for kwargs in tasks_list)
+        for chunk in chunks:
+            if not chunk:
+                continue
+            result.extend(chunk)
         return result
 
     def get_leads(self, date_from: datetime, date_to: datetime) -> bool:
@@ -872,7 +907,11 @@ class APIClient:
             }
         """
         result = {}
-        response = requests.get(url=self.__get_url(endpoint='pipelines', entity='leads'), headers=self.headers)
+        response = self.http.get(
+            url=self.__get_url(endpoint='pipelines', entity='leads'),
+            headers=self.headers,
+            timeout=self.timeout
+        )
         json_response = response.json()
         pipelines = (json_response.get('_embedded') or {}).get('pipelines') or []
         for pipeline in pipelines:
@@ -955,7 +994,10 @@ class APIClient:
         """
         params = f'with=role,group' \
                  f'&limit={DATA_LIMIT}'
-        return self.get_and_sync_data(endpoint='users', params=params, limit=50, db_table='User')
+        has_new = self.get_and_sync_data(endpoint='users', params=params, limit=50, db_table='User')
+        if has_new:
+            invalidate_references(schema=self.sync_controller.schema)
+        return has_new
 
     def __get_token_data(self):
         return self.session.query(self.token).order_by(self.token.id.desc()).first()
@@ -1025,7 +1067,6 @@ class APIClient:
                 yield item
             if has_page:
                 break
-            sleep(random.uniform(0.1, REQUEST_SLEEP_INTERVAL))
             # нам вернули данных меньше предельного размера чанка, значит, записей больше нет
             if len(chunk) < limit:
                 break
@@ -1040,7 +1081,10 @@ class APIClient:
         db_table: str = '',
         key: Optional[str] = None
     ) -> bool:
-        """ Читает данные с источника и записывает их построчно в указанную таблицу БД (синхронизирует)
+        """ Читает данные с источника и записывает их постранично в указанную таблицу БД (синхронизирует)
+
+        Страницы запрашиваются параллельно (не более max_concurrency одновременно, с учетом ограничения
+            частоты запросов Amo) и передаются на запись в БД по мере получения
 
         Args:
             endpoint: адрес запроса (leads, contacts, etc.)
@@ -1054,51 +1098,74 @@ class APIClient:
         Returns:
             True - если были вставлены или обновлены записи
         """
-        page = 0
-        base_params = params
+        # страницы читаются в отдельных потоках, им нужен контекст приложения (например, для обновления токена)
+        app = current_app._get_current_object() if has_app_context() else None
+
+        def fetch_page(page: int) -> Optional[List[Dict]]:
+            page_params = f'{params}&page={page}'
+            if app is None:
+                return self.__get_page(endpoint=endpoint, params=page_params, entity=entity, entity_id=entity_id, key=key)
+            with app.app_context():
+                return self.__get_page(endpoint=endpoint, params=page_params, entity=entity, entity_id=entity_id, key=key)
+
+        fetcher = PageFetcher(fetch_page=fetch_page, limit=limit, max_concurrency=self.max_concurrency)
         engine = get_engine()
-        updated_or_inserted_records = []
+        changed = 0
         with engine.begin() as connection:
-            while True:
-                page += 1
-                params = f'{base_params}&page={page}'
-                response = self.__execute(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id)
-                if not response:
-                    print('no response', response)
-                    break
-                # нет данных - выходим из цикла
-                if response.status_code == 204:
-                    # print(f'{datetime.now()} response.status_code == 204', response.text)
-                    break
-                try:
-                    json_response = response.json()
-                    # print(response.status_code, len((json_response.get('_embedded') or {}).get(endpoint) or []))
-                except requests.exceptions.JSONDecodeError as exc:
-                    print('JSONDecodeError')
-                    if '500 Internal Server Error' in response.text:
-                        print(f'{endpoint} 500 Internal Server Error')
-                    elif '414 Request-URI Too Large' in response.text:
-                        print(f'{endpoint} 414 Request-URI Too Large')
-                    raise exc
-                except Exception as exc:
-                    print(exc)
-                    print(response.status_code, response.text)
-                chunk = (json_response.get('_embedded') or {}).get(key or endpoint) or []
-                records = [item for item in chunk]
-                result = self.sync_controller.sync_records(
-                    records=records,
+            # запись в БД идет в текущем потоке, через одно соединение
+            for chunk in fetcher.pages():
+                # учитываются только вставленные и фактически измененные записи
+                changed += self.sync_controller.sync_records(
+                    records=chunk,
                     table_name=db_table,
                     connection=connection,
                     engine=engine
                 )
-                updated_or_inserted_records.append(result)
-                sleep(random.uniform(0.1, REQUEST_SLEEP_INTERVAL))
-                # нам вернули данных меньше предельного размера чанка, значит, записей больше нет
-                if len(chunk) < limit:
-                    break
-        return any(updated_or_inserted_records)
+        return changed > 0
 
-    def sync_records(self, records: List[Dict], table_name: str) -> bool:
+    def __get_page(
+        self,
+        endpoint: str,
+        params: str,
+        entity: str = '',
+        entity_id: Optional[int] = None,
+        key: Optional[str] = None
+    ) -> Optional[List[Dict]]:
+        """ Получение одной страницы данных с эндпоинта
+
+        Args:
+            endpoint: адрес запроса (leads, contacts, etc.)
+            params: параметры запроса, включая номер страницы
+            entity: сущность, например, leads, может использоваться как дополнение к эндпоинту
+            entity_id: идентификатор сущности
+            key: ключ данных в _embedded
+
+        Returns:
+            записи страницы, None - если данных нет
+        """
+        response = self.__execute(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id)
+        if not response:
+            print('no response', response)
+            return None
+        # нет данных
+        if response.status_code == 204:
+            return None
+        try:
+            json_response = response.json()
+        except requests.exceptions.JSONDecodeError as exc:
+            print('JSONDecodeError')
+            if '500 Internal Server Error' in response.text:
+                print(f'{endpoint} 500 Internal Server Error')
+            elif '414 Request-URI Too Large' in response.text:
+                print(f'{endpoint} 414 Request-URI Too Large')
+            raise exc
+        except Exception as exc:
+            print(exc)
+            print(response.status_code, response.text)
+            return None
+        return (json_response.get('_embedded') or {}).get(key or endpoint) or []
+
+    def sync_records(self, records: List[Dict], table_name: str) -> int:
         engine = get_engine()
         with engine.begin() as connection:
             return self.sync_controller.sync_records(
@@ -1153,26 +1220,30 @@ class APIClient:
         """
         response = None
         while not response:
+            self.rate_limiter.acquire()
             try:
                 if method == 'GET':
-                    response = requests.get(
+                    response = self.http.get(
                         url=self.__get_url(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id),
-                        headers=self.headers
+                        headers=self.headers,
+                        timeout=self.timeout
                     )
                     # todo вот тут надо бы обработать всякие 401 - "не авторизован"
                     # print(response.text)
                 elif method == 'PATCH':
-                    response = requests.patch(
+                    response = self.http.patch(
                         url=self.__get_url(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id),
                         headers=self.headers,
-                        data=json.dumps(data)
+                        data=json.dumps(data),
+                        timeout=self.timeout
                     )
                     return response
                 elif method == 'POST':
-                    response = requests.post(
+                    response = self.http.post(
                         url=self.__get_url(endpoint=endpoint, params=params, entity=entity, entity_id=entity_id),
                         headers=self.headers,
-                        json=data
+                        json=data,
+                        timeout=self.timeout
                     )
                     return response
                 else:
@@ -1188,7 +1259,7 @@ class APIClient:
                     print('refreshing token')
                     self.refresh_token()
                     self._set_auth_headers()
-            except requests.exceptions.ConnectionError:
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
                 # повторный запрос
                 sleep(REQUEST_SLEEP_INTERVAL)
             except Exception as exc:
@@ -2,13 +2,23 @@
 __author__ = 'ke.mizonov'
 from datetime import datetime
 from typing import Dict, List, Optional, Tuple
-from sqlalchemy import Table, MetaData, select
+from sqlalchemy import JSON, cast, delete, or_, select
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.dialects.postgresql import insert
 from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.dialects.postgresql import insert as pg_insert
+from app.amo.processor.functions import get_contact_keys
 from app.engine import get_engine
 from app.logger import DBLogger
+from app.metadata import get_table
 from app.models.log import SMLog, CDVLog
+from app.models.sync_state import DUPLICATE_INDEX_ENTITY
+
+# индекс поиска дублей: синхронизируемая таблица -> (таблица индекса, поле с идентификатором записи)
+DUPLICATE_INDEX = {
+    'Contact': ('ContactKey', 'contact_id'),
+    'Lead': ('LeadContact', 'lead_id'),
+}
 
 
 class SyncController:
@@ -44,7 +54,7 @@ class SyncController:
         if data.get('create_lead'):
             message['text'] = 'Init Tawk chat'
         engine = get_engine()
-        target_table = Table('Chat', MetaData(), autoload_with=engine, schema=self.schema)
+        target_table = get_table('Chat', schema=self.schema, engine=engine)
         messages = []
         with engine.begin() as connection:
             phone_field = target_table.c.phone
@@ -77,11 +87,23 @@ class SyncController:
                     print(f'insert {target_table.name} error {exc}')
         return messages
 
-    def sync_records(self, records: List[Dict], table_name: str, connection, engine) -> bool:
-        target_table = Table(table_name, MetaData(), autoload_with=engine, schema=self.schema)
-        exclude_fields = ('_links', 'email', 'roles')
-        from sqlalchemy import select
+    def sync_records(self, records: List[Dict], table_name: str, connection, engine) -> int:
+        """ Синхронизация записей с таблицей БД (upsert)
+
+        Сравнение с уже сохраненными данными выполняет Postgres: существующая строка обновляется,
+            только если хотя бы одно поле отличается (IS DISTINCT FROM), неизмененные строки не трогаются
 
+        Args:
+            records: записи из Amo
+            table_name: имя таблицы
+            connection: соединение с БД (транзакция)
+            engine: соединение с БД
+
+        Returns:
+            количество добавленных и фактически измененных записей
+        """
+        target_table = get_table(table_name, schema=self.schema, engine=engine)
+        exclude_fields = ('_links', 'email', 'roles')
         # Подготовка данных для вставки
         insert_records = [{
             key: value for key, value in record.items() if key not in exclude_fields
@@ -89,39 +111,104 @@ class SyncController:
         for record in insert_records:
             record['id_on_source'] = record.pop('id')
         if not insert_records:
-            return False
-        # Предварительная проверка существующих данных
-        existing_records_query = select(target_table).where(
-            target_table.c.id_on_source.in_([record['id_on_source'] for record in insert_records])
-        )
-        existing_records = connection.execute(existing_records_query).fetchall()
-        # Преобразование результатов запроса в словарь, используя _mapping для доступа к данным как к словарю
-        existing_records_dict = {
-            record._mapping['id_on_source']: dict(record._mapping)
-            for record in existing_records
-        }
-        need_update = False
-        for record in insert_records:
-            if record['id_on_source'] not in existing_records_dict:
-                need_update = True
-                break
-            existing_record = existing_records_dict[record['id_on_source']]
-            if any(record[key] != existing_record.get(key) for key in record.keys() if key not in exclude_fields):
-                need_update = True
-                break
-        if not need_update:
-            return False
+            return 0
+        update_fields = [name for name in insert_records[0].keys() if name != 'id_on_source']
         try:
             stmt = pg_insert(target_table).values(insert_records)
             on_conflict_stmt = stmt.on_conflict_do_update(
                 index_elements=['id_on_source'],  # Уникальный идентификатор для обновления
-                set_={name: stmt.excluded[name] for name in insert_records[0].keys() if name not in exclude_fields}
-            )
-            result = connection.execute(on_conflict_stmt)
-            return result.rowcount > 0
+                set_={name: stmt.excluded[name] for name in update_fields},
+                where=or_(*[
+                    self.__comparable(target_table.c[name]).is_distinct_from(
+                        self.__comparable(stmt.excluded[name])
+                    ) for name in update_fields
+                ]) if update_fields else None
+            ).returning(target_table.c.id_on_source)
+            # RETURNING возвращает только вставленные и реально обновленные строки
+            changed_ids = {row[0] for row in connection.execute(on_conflict_stmt).fetchall()}
         except Exception as exc:
             print(f'Error during UPSERT operation: {exc}')
-            return False
+            return 0
+        if table_name in DUPLICATE_INDEX and changed_ids:
+            self.update_duplicate_index(
+                records=[record for record in insert_records if record['id_on_source'] in changed_ids],
+                table_name=table_name,
+                connection=connection,
+                engine=engine
+            )
+        return len(changed_ids)
+
+    def update_duplicate_index(self, records: List[Dict], table_name: str, connection, engine):
+        """ Обновляет индекс поиска дублей по добавленным и измененным контактам / сделкам
+
+        Строки индекса записи заменяются целиком; ошибка индекса не прерывает синхронизацию (пишется в savepoint)
+
+        Args:
+            records: записи (с id_on_source)
+            table_name: Contact, Lead
+            connection: соединение с БД (транзакция)
+            engine: соединение с БД
+        """
+        index_table_name, key = DUPLICATE_INDEX[table_name]
+        rows = []
+        for record in records:
+            if record.get('is_deleted'):
+                continue
+            if table_name == 'Contact':
+                rows.extend(
+                    {'contact_id': record['id_on_source'], 'value': value} for value in get_contact_keys(record)
+                )
+            else:
+                contact_ids = {contact['id'] for contact in (record.get('_embedded') or {}).get('contacts') or []}
+                rows.extend({'lead_id': record['id_on_source'], 'contact_id': _id} for _id in contact_ids)
+        try:
+            index_table = get_table(index_table_name, schema=self.schema, engine=engine)
+            with connection.begin_nested():
+                connection.execute(delete(index_table).where(
+                    index_table.c[key].in_([record['id_on_source'] for record in records])
+                ))
+                if rows:
+                    connection.execute(insert(index_table).values(rows))
+        except Exception as exc:
+            print(f'Error during {index_table_name} update: {exc}')
+
+    def rebuild_duplicate_index(self, chunk_size: int = 5000):
+        """ Перестраивает индекс поиска дублей по всем сохраненным контактам и сделкам
+
+        Args:
+            chunk_size: количество записей, читаемых за раз
+        """
+        engine = get_engine()
+        for table_name, (index_table_name, _) in DUPLICATE_INDEX.items():
+            table = get_table(table_name, schema=self.schema, engine=engine)
+            columns = [table.c.id_on_source, table.c.is_deleted]
+            columns.append(table.c.custom_fields_values if table_name == 'Contact' else table.c._embedded)
+            with engine.begin() as connection:
+                connection.execute(delete(get_table(index_table_name, schema=self.schema, engine=engine)))
+                result = connection.execution_options(stream_results=True).execute(select(*columns))
+                for rows in result.mappings().partitions(chunk_size):
+                    self.update_duplicate_index(
+                        records=[dict(row) for row in rows],
+                        table_name=table_name,
+                        connection=connection,
+                        engine=engine
+                    )
+        # индекс построен целиком - поиск дублей может на него опираться (см. find_duplicated_lead)
+        now = int(datetime.now().timestamp())
+        sync_state = get_table('SyncState', schema=self.schema, engine=engine)
+        stmt = pg_insert(sync_state).values(entity=DUPLICATE_INDEX_ENTITY, watermark=now, updated_at=now)
+        with engine.begin() as connection:
+            connection.execute(stmt.on_conflict_do_update(
+                index_elements=['entity'],
+                set_={'watermark': stmt.excluded.watermark, 'updated_at': stmt.excluded.updated_at}
+            ))
+
+    @staticmethod
+    def __comparable(column):
+        # у типа json в Postgres нет оператора сравнения, поэтому сравниваем как jsonb
+        if isinstance(column.type, JSON):
+            return cast(column, JSONB)
+        return column
 
 
 class SMSyncController(SyncController):
@@ -2,6 +2,7 @@
 __author__ = 'ke.mizonov'
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional, Callable, Tuple
+from app.amo.data.base.store import ENTITY_INDEX_KEYS, get_store
 
 
 class Client:
@@ -77,7 +78,7 @@ class Client:
         Returns:
             список сделок
         """
-        serializer = PklSerializer(file_name=self.leads_file_name)
+        store = get_store(self.leads_file_name)
         leads_from_file: List[Dict] = []
         # делаем поправку на часовой пояс:
         #   get_current_timeshift - часовой пояс машины, с которой запускается скрипт
@@ -87,39 +88,24 @@ class Client:
             date_from += timedelta(hours=get_current_timeshift() - self.time_shift)
             date_to += timedelta(hours=get_current_timeshift() - self.time_shift)
             date_from_stamp, date_to_stamp = date_from.timestamp(), date_to.timestamp()
-        # попытка считать сделки из файла (если не заявлена принудительная загрузка из AMO)
+        # попытка считать сделки из хранилища (если не заявлена принудительная загрузка из AMO)
         if not forced_load:
             if worker:
-                worker.emit({'msg': f'Reading leads from file "{self.leads_file_name}.pkl"'})
-            leads = serializer.load() or []
-            total = len(leads)
+                worker.emit({'msg': f'Reading leads from store "{self.leads_file_name}"'})
+            # с диска читаются только подходящие по индексу сделки
+            if ids:
+                leads = store.read(ids=ids)
+            elif date_from_stamp and date_to_stamp:
+                leads = store.read(date_from=date_from_stamp, date_to=date_to_stamp, date_key=date_key)
+            else:
+                leads = store.read()
+            total = len(store)
             for num, lead in enumerate(leads, 1):
-
-                # if num % 10000 == 0:
-                #     print(f'{num} of {total}')
-
-                # # fixme del
-                # if lead['id'] == 33836633:
-                #     print(lead)
-
-                # if lead['id'] == 22782321:
-                #     for k, v in lead.items():
-                #         print(k, '::', v)
-
                 if worker and num % 100 == 0:
                     worker.emit({'num': num, 'total': total})
-                # пропускам лиды, выходящие за пределы диапазона дат или не относящиеся к текущему домену
-                if not ids and date_from_stamp and date_to_stamp and \
-                        (not lead[date_key] or not (date_from_stamp <= lead[date_key] <= date_to_stamp)):
-                    continue
-                if ids and lead['id'] not in ids:
-                    continue
+                # пропускам лиды, не относящиеся к текущему домену
                 if lead['sub_domain'] != self.api_client.sub_domain:
                     continue
-                # # преобразование времени лида
-                # for k, v in lead.items():
-                #     print(k, '::', v)
-                # print()
                 leads_from_file.append(lead)
         # сделки из файла получены - вернем их
         if leads_from_file:
@@ -131,7 +117,7 @@ class Client:
             return leads_from_file
         print('Loading leads from AMO')
         if worker:
-            worker.emit({'msg': f'Loading leads from AMO into "{self.leads_file_name}.pkl"', 'num': 0, 'total': 0})
+            worker.emit({'msg': f'Loading leads from AMO into store "{self.leads_file_name}"', 'num': 0, 'total': 0})
         # загрузка сделок из AMO
         if not date_from or not date_to:
             if worker:
@@ -139,31 +125,15 @@ class Client:
             return []
         api_client = self.api_client()
         leads_from_amo: List[Dict] = api_client.get_leads(date_from=date_from, date_to=date_to, worker=worker)
-        # добавление отсутствующих сделок в файл
-        leads_from_file: List[Dict] = serializer.load() or []
-        leads_from_file_dict = {lead['id']: lead for lead in leads_from_file}
-        total = len(leads_from_amo)
-        for num, lead in enumerate(leads_from_amo, 1):
-            # if lead['is_deleted']:
-            # print('>>>', lead)
-            _id = lead['id']
-            # такого лида в файлах нет - добавим
-            # if _id not in leads_from_file_dict.keys():
-            #     # print('appending')
-            if worker and num % 1000 == 0:
-                worker.emit({'msg': f'Обновление файла сделок', 'num': num, 'total': total})
-            # дата обновления лида отличается - перезапишем его
-            if leads_from_file_dict.get(_id):
-                leads_from_file_dict[_id] = lead
-            else:
-                leads_from_file_dict[_id] = lead
-                leads_from_file.append(lead)
-        # тут обязательно переписываем лид, т.к. выше мы меняли по ссылке другой объект (!)
-        leads_from_file = [lead for lead in leads_from_file_dict.values()]
-        total = len(leads_from_file)
         # подмешиваем события удаления сделок, попутно сохраняем те из них, для которых не нашлось лидов
         deleted_events = api_client.get_deleted_events(date_from=date_from, date_to=date_to, worker=worker)
-        for num, lead in enumerate(leads_from_file, 1):
+        leads_to_save = {lead['id']: lead for lead in leads_from_amo}
+        # события удаления относятся и к сделкам, загруженным ранее: дочитываем из хранилища только их
+        stored_ids = [_id for _id in deleted_events.keys() if _id not in leads_to_save]
+        for lead in store.get(stored_ids):
+            leads_to_save[lead['id']] = lead
+        total = len(leads_to_save)
+        for num, lead in enumerate(leads_to_save.values(), 1):
             if worker and num % 1000 == 0:
                 worker.emit({'msg': 'Подмешиваем события удаления сделок к лидам', 'num': num, 'total': total})
             deleted_event = deleted_events.get(lead['id'])
@@ -180,16 +150,15 @@ class Client:
             deleted_events_from_file.update(deleted_events)
             if deleted_events_from_file:
                 deleted_serializer.save(deleted_events_from_file)
-        # сортировка и сохранение лидов
+        # дописываем новые и измененные сделки в хранилище (без перезаписи остальных)
         if worker:
             worker.emit({'msg': 'Сохраняем список сделок'})
-        leads_from_file = sorted(leads_from_file, key=lambda x: x['created_at'])
-        serializer.save(leads_from_file)
+        store.append(sorted(leads_to_save.values(), key=lambda x: x['created_at']))
         if mixin_notes:
             print('mixin_notes...')
-            self._mixin_notes(leads=leads_from_file)
+            self._mixin_notes(leads=leads_from_amo)
             print('mixin_events...')
-            self._mixin_events(leads=leads_from_file)
+            self._mixin_events(leads=leads_from_amo)
         return leads_from_amo
 
     # def update_alive_leads(self, leads: List[Dict]):
@@ -245,13 +214,14 @@ class Client:
         Returns:
             список событий
         """
-        serializer = PklSerializer(file_name=self.leads_file_name)
-        leads = serializer.load()
+        store = get_store(self.leads_file_name)
         # делаем поправку на часовой пояс:
         date_from += timedelta(hours=get_current_timeshift() - self.time_shift)
         date_to += timedelta(hours=get_current_timeshift() - self.time_shift)
         date_from_stamp, date_to_stamp = date_from.timestamp(), date_to.timestamp()
-        lead_ids = [lead['id'] for lead in leads if date_from_stamp <= lead['created_at'] <= date_to_stamp]
+        # из хранилища читаются только сделки, созданные за период
+        leads = list(store.read(date_from=date_from_stamp, date_to=date_to_stamp, date_key='created_at'))
+        lead_ids = [lead['id'] for lead in leads]
         events = self.api_client().load_events(
             lead_ids=lead_ids,
             event_types=event_types,
@@ -261,23 +231,22 @@ class Client:
         for event in events:
             events_data_dict[event['entity_id']].append(event)
         # подмиксовываем догруженные события к лидам, не забываем о повторах и сортировке
+        changed_leads = []
         for lead in leads:
-            if not (date_from_stamp <= lead['created_at'] <= date_to_stamp):
-                continue
-            new_events = lead.get('events')
-            events_ids = tuple(event['id'] for event in lead.get('events') or [])
+            new_events = lead.get('events') or []
+            events_ids = set(event['id'] for event in new_events)
+            has_new = False
             for event in events_data_dict.get(lead['id']) or []:
-                # if lead['id'] == 22734727:
-                #     print(event)
                 if event['id'] in events_ids:
                     continue
                 new_events.append(event)
+                has_new = True
+            if not has_new:
+                continue
             lead['events'] = sorted(new_events, key=lambda x: x['created_at'])
-            # if lead['id'] == 22734727:
-            #     print('new_events', new_events)
-            #     print('events', lead['events'])
-        # обновляем файл с лидами
-        serializer.save(leads)
+            changed_leads.append(lead)
+        # дописываем в хранилище только сделки с новыми событиями
+        store.append(changed_leads)
 
     def _mixin_notes(self, leads: List[Dict]):
         """ Примешать примечания
@@ -317,18 +286,9 @@ class Client:
         Returns:
             словарь вида { entity_id: [notes_list] }
         """
-        notes = PklSerializer(file_name=f'{self.api_client.sub_domain}_{entity}_notes').load() or []
-        if not notes:
-            return {}
-        notes = sorted(notes, key=lambda x: x['created_at'])
-        notes_dict = {note['entity_id']: [] for note in notes if note['entity_id'] in entity_ids}
-        for note in notes:
-            if note['entity_id'] not in entity_ids:
-                continue
-            # # подмешиваем пользователей к примечаниям
-            # note['user'] = users_dict.get(note['created_by'])
-            notes_dict[note['entity_id']].append(note)
-        return notes_dict
+        store = get_store(f'{self.api_client.sub_domain}_{entity}_notes', index_keys=ENTITY_INDEX_KEYS)
+        # группы entity_id -> примечания (по возрастанию created_at) строятся по индексу один раз на версию данных
+        return store.get_grouped(values=entity_ids, index_key='entity_id', sort_key='created_at')
 
     def _mixin_events(self, leads: List[Dict]):
         """ Примешать события
@@ -358,13 +318,6 @@ class Client:
         Returns:
             словарь вида { entity_id: [events_list] }
         """
-        events = PklSerializer(file_name=f'{self.api_client.sub_domain}_{entity}_events').load() or []
-        if not events:
-            return {}
-        events = sorted(events, key=lambda x: x['created_at'])
-        events_dict = {event['entity_id']: [] for event in events if event['entity_id'] in entity_ids}
-        for note in events:
-            if note['entity_id'] not in entity_ids:
-                continue
-            events_dict[note['entity_id']].append(note)
-        return events_dict
+        store = get_store(f'{self.api_client.sub_domain}_{entity}_events', index_keys=ENTITY_INDEX_KEYS)
+        # группы entity_id -> события (по возрастанию created_at) строятся по индексу один раз на версию данных
+        return store.get_grouped(values=entity_ids, index_key='entity_id', sort_key='created_at')
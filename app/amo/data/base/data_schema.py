@@ -1,13 +1,18 @@
 """ Константы данных AMO """
 __author__ = 'ke.mizonov'
+import threading
 from dataclasses import dataclass, field, fields
-from typing import Optional, List, Tuple, Union
+from typing import Dict, Optional, List, Tuple, Union
 
 DEBUG = False
 
 PRICE = 'price'
 TO = ' -> '
 
+# скомпилированные схемы моделей лида (см. Lead.get_schema)
+schemas: Dict[type, 'LeadSchema'] = {}
+lock = threading.Lock()
+
 
 def clear_spaces(text: str) -> str:
     """ Чистит двойные пробелы в строке """
@@ -832,46 +837,56 @@ class Lead:
     #     return None
 
     @classmethod
-    def get_date_fields(cls):
-        """ Генератор полей лида, содержащих даты """
-        instance = cls()
-        for _field in fields(cls):
-            value = getattr(instance, _field.name)
-            if isinstance(value, LeadField) and value.IsDate:
-                yield value
+    def get_schema(cls) -> 'LeadSchema':
+        """ Скомпилированная схема модели лида (строится один раз на класс)
+
+        Returns:
+            схема модели лида
+        """
+        schema = schemas.get(cls)
+        if schema is not None:
+            return schema
+        with lock:
+            schema = schemas.get(cls)
+            if schema is None:
+                instance = cls()
+                schema = schemas[cls] = LeadSchema(
+                    instance=instance,
+                    stage=cls.Stage(),
+                    fields=tuple(
+                        value for value in (getattr(instance, _field.name) for _field in fields(cls))
+                        if isinstance(value, LeadField)
+                    ),
+                    stages=tuple(x['field'] for x in cls.__get_stages_priority()),
+                    loss_reasons=cls.get_loss_reasons(),
+                    utm_keys=tuple(cls.Utm.get_keys())
+                )
+        return schema
 
     @classmethod
-    def get_fields(cls):
-        """ Генератор всех полей лида """
-        instance = cls()
-        for _field in fields(cls):
-            value = getattr(instance, _field.name)
-            if isinstance(value, LeadField):
-                yield value
+    def get_date_fields(cls) -> Tuple[LeadField, ...]:
+        """ Поля лида, содержащие даты """
+        return cls.get_schema().date_fields
 
     @classmethod
-    def get_custom_fields(cls):
-        """ Генератор дополнительных полей лида """
-        instance = cls()
-        for _field in fields(cls):
-            value = getattr(instance, _field.name)
-            if isinstance(value, LeadField) and value.CustomField:
-                yield value
+    def get_fields(cls) -> Tuple[LeadField, ...]:
+        """ Все поля лида """
+        return cls.get_schema().fields
 
     @classmethod
-    def get_raw_fields(cls):
-        """ Генератор "сырых" полей лида - то есть тех, которые берутся непосредственно из сделки Amo """
-        instance = cls()
-        for _field in fields(cls):
-            value = getattr(instance, _field.name)
-            if isinstance(value, LeadField) and value.IsRaw:
-                yield value
+    def get_custom_fields(cls) -> Tuple[LeadField, ...]:
+        """ Дополнительные поля лида """
+        return cls.get_schema().custom_fields
+
+    @classmethod
+    def get_raw_fields(cls) -> Tuple[LeadField, ...]:
+        """ "Сырые" поля лида - то есть те, которые берутся непосредственно из сделки Amo """
+        return cls.get_schema().raw_fields
 
     @classmethod
     def get_stages_priority(cls) -> Tuple:
         """ Возвращает кортеж стадий воронки лида, отсортированных по порядку прохождения """
-        priorities = cls.__get_stages_priority()
-        return tuple(x['field'] for x in priorities)
+        return cls.get_schema().stages
 
     @classmethod
     def get_documentation(cls):
@@ -912,6 +927,80 @@ class Lead:
         return utm
 
 
+class LeadSchema:
+    """ Скомпилированная схема модели лида: кортежи полей и стадий и словари для поиска по ним
+
+    Notes:
+        Схема строится один раз на класс модели (см. Lead.get_schema), после чего построение строк лидов
+            обходится обращениями к словарям вместо создания экземпляров dataclass и обхода fields()
+    """
+
+    def __init__(
+        self,
+        instance: Lead,
+        stage: StageBase,
+        fields: Tuple[LeadField, ...],
+        stages: Tuple[StageItem, ...],
+        loss_reasons: Tuple,
+        utm_keys: Tuple[str, ...]
+    ):
+        """
+        Args:
+            instance: экземпляр модели лида
+            stage: экземпляр стадий воронки модели
+            fields: поля лида
+            stages: стадии воронки в порядке прохождения
+            loss_reasons: причины закрытия целевых лидов
+            utm_keys: ключи utm-меток
+        """
+        self.instance = instance
+        self.stage = stage
+        self.fields = fields
+        self.date_fields = tuple(x for x in fields if x.IsDate)
+        self.custom_fields = tuple(x for x in fields if x.CustomField)
+        self.raw_fields = tuple(x for x in fields if x.IsRaw)
+        self.stages = stages
+        self.loss_reasons = loss_reasons
+        self.utm_keys = utm_keys
+        # доп. поле Amo -> ключ поля лида
+        self.custom_field_keys: Dict[str, str] = {x.CustomField: x.Key for x in self.custom_fields}
+        # названия этапов Amo (в нижнем регистре), на которых лид находится на стадии в данный момент
+        self.include_stages: Tuple[frozenset, ...] = tuple(
+            frozenset(x.lower() for x in stage.IncludeStages) for stage in stages
+        )
+        # этап Amo (в нижнем регистре) -> стадии, на которых лид находится в данный момент
+        self.stages_by_status: Dict[str, Tuple[StageItem, ...]] = {}
+        # этап Amo -> первая по порядку прохождения стадия, которая считается достигнутой
+        self.stage_by_status: Dict[str, StageItem] = {}
+        # доп. поле -> стадии, достижение которых оно определяет
+        self.__stages_by_field: Dict[str, Tuple[StageItem, ...]] = {}
+        for stage_item, include_stages in zip(stages, self.include_stages):
+            for status in include_stages:
+                self.stages_by_status[status] = self.stages_by_status.get(status, ()) + (stage_item, )
+            for status in stage_item.IncludeStages:
+                self.stage_by_status.setdefault(status, stage_item)
+            for field_name in stage_item.IncludeFields:
+                self.__stages_by_field[field_name] = self.__stages_by_field.get(field_name, ()) + (stage_item, )
+
+    def stages_by_field(self, name: str) -> Tuple[StageItem, ...]:
+        """ Стадии воронки, достижение которых определяется доп. полем (без учета регистра названия поля)
+
+        Args:
+            name: название доп. поля
+
+        Returns:
+            стадии в порядке прохождения воронки
+        """
+        stages = self.__stages_by_field.get(name, ())
+        lower_name = name.lower()
+        if lower_name == name or lower_name not in self.__stages_by_field:
+            return stages
+        lower_stages = self.__stages_by_field[lower_name]
+        if not stages:
+            return lower_stages
+        return tuple(x for x in self.stages if x in stages or x in lower_stages)
+
+
 # fixme предметы кластеризации
 CLUSTER_SUBJECT = (
     None,
@@ -132,7 +132,8 @@ class AmoProcessor:
             worker=worker,
             need_result_by_months=False
         )
-        time.sleep(4)       # жуткий костыль (файл с данными не успевает сохраниться, а мы его уже открываем)
+        if not ExcelClient.is_headless():
+            time.sleep(4)       # жуткий костыль (Excel не успевает увидеть сохраненный файл с данными)
         data = ExcelClient.Data(
             outer_file=self.cluster_file_name,
             pivot=self._pivot_tags_builders()
@@ -0,0 +1,457 @@
+""" Сегментное хранилище записей Amo (сделки, события, примечания) на диске
+
+Notes:
+    Вместо одного pickle-файла на всю коллекцию записи раскладываются по сегментам - по одному файлу
+        на месяц (по created_at). Сегмент - это последовательность pickle-записей, которая только дописывается.
+        Индекс (id -> сегмент, смещение, длина, значения индексируемых полей) хранится отдельно и целиком
+        помещается в память, поэтому выборки по диапазону дат и по набору идентификаторов читают с диска
+        (через mmap) только нужные записи.
+
+    Обновленная запись дописывается в конец сегмента, индекс начинает указывать на новую версию, а размер
+        старой учитывается как мусор сегмента. Когда доля мусора превышает порог из конфига
+        (data_store_compact_ratio), сегмент переписывается без устаревших версий (compact())
+
+    При записи индекс не переписывается целиком: новые элементы дописываются в журнал index.journal,
+        который сливается с index.pkl при загрузке хранилища и при сжатии сегментов
+
+    Чтение открывает (mmap) нужные сегменты под блокировкой вместе с выборкой смещений, а сжатие подменяет
+        файл сегмента целиком (os.replace), поэтому уже начатое чтение дочитывает прежнюю версию файла
+
+    При первом обращении к пустому хранилищу в него переносятся записи прежнего pickle-файла <имя хранилища>.pkl
+        (см. import_legacy_pickle), либо это можно сделать заранее командой flask import_legacy_data
+"""
+__author__ = 'ke.mizonov'
+import mmap
+import os
+import pickle
+import threading
+from datetime import datetime
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
+from config import Config
+
+INDEX_FILE_NAME = 'index.pkl'
+JOURNAL_FILE_NAME = 'index.journal'
+# поля индекса для примечаний и событий (группировка по сущности)
+ENTITY_INDEX_KEYS = ('created_at', 'entity_id')
+# сегмент для записей без даты создания
+UNDATED_SEGMENT = 'undated'
+
+stores: Dict[str, 'SegmentStore'] = {}
+lock = threading.Lock()
+
+
+def get_store(name: str, index_keys: Tuple[str, ...] = ('created_at', 'updated_at')) -> 'SegmentStore':
+    """ Синглтон хранилища: индекс читается с диска один раз на процесс
+
+    Args:
+        name: имя хранилища (например, swissmedica_leads)
+        index_keys: поля записи, значения которых хранятся в индексе
+
+    Returns:
+        хранилище
+    """
+    store = stores.get(name)
+    if store is not None:
+        return store
+    with lock:
+        store = stores.get(name)
+        if store is None:
+            store = SegmentStore(name=name, index_keys=index_keys)
+            import_legacy_pickle(store=store)
+            stores[name] = store
+    return store
+
+
+def import_legacy_pickle(store: 'SegmentStore') -> int:
+    """ Переносит в пустое хранилище записи прежнего pickle-файла <имя хранилища>.pkl, если он есть
+
+    Args:
+        store: хранилище
+
+    Returns:
+        количество перенесенных записей
+    """
+    file_path = os.path.join(Config().legacy_pickle_path, f'{store.name}.pkl')
+    if len(store) or not os.path.exists(file_path):
+        return 0
+    count = store.import_pickle(file_path)
+    print(f'{store.name}: imported {count} records from {file_path}')
+    return count
+
+
+class SegmentStore:
+    """ Сегментное хранилище записей с индексом по идентификатору и выбранным полям """
+
+    def __init__(
+        self,
+        name: str,
+        index_keys: Tuple[str, ...] = ('created_at', 'updated_at'),
+        key: str = 'id',
+        path: Optional[str] = None
+    ):
+        """
+        Args:
+            name: имя хранилища (например, swissmedica_leads)
+            index_keys: поля записи, значения которых хранятся в индексе (для выборок без чтения записей)
+            key: поле-идентификатор записи
+            path: каталог хранилищ, по умолчанию - из конфига
+        """
+        self.name = name
+        self.index_keys = index_keys
+        self.key = key
+        self.path = os.path.join(path or Config().data_store_path, name)
+        self.__lock = threading.RLock()
+        # id -> (сегмент, смещение, длина, значения индексируемых полей)
+        self.__index: Dict[Any, Tuple[str, int, int, Tuple]] = {}
+        # сегмент -> размер устаревших версий записей, байт
+        self.__dead: Dict[str, int] = {}
+        # версия данных: увеличивается при каждой записи (используется для инвалидации производных индексов)
+        self.version = 0
+        # сгруппированные индексы: (поле группировки, поле сортировки) -> (версия данных, группы)
+        self.__groups: Dict[Tuple[str, str], Tuple[int, Dict[Any, List]]] = {}
+        self.__load_index()
+
+    def __len__(self) -> int:
+        return len(self.__index)
+
+    def __contains__(self, record_id: Any) -> bool:
+        return record_id in self.__index
+
+    def ids(self) -> List:
+        """ Идентификаторы всех записей хранилища """
+        return list(self.__index.keys())
+
+    def index_values(self, index_key: str) -> Dict[Any, Any]:
+        """ Значения индексируемого поля для всех записей (без чтения самих записей)
+
+        Args:
+            index_key: индексируемое поле
+
+        Returns:
+            словарь вида { id: значение поля }
+        """
+        position = self.index_keys.index(index_key)
+        return {record_id: entry[3][position] for record_id, entry in self.__index.items()}
+
+    def group_ids(self, index_key: str = 'entity_id', sort_key: str = 'created_at') -> Dict[Any, List]:
+        """ Идентификаторы записей, сгруппированные по значению индексируемого поля
+
+        Группы строятся по индексу один раз на версию данных и сбрасываются при записи в хранилище
+
+        Args:
+            index_key: индексируемое поле группировки (например, entity_id)
+            sort_key: индексируемое поле, по которому упорядочены записи в группе
+
+        Returns:
+            словарь вида { значение поля: [id, ...] }
+        """
+        key = (index_key, sort_key)
+        with self.__lock:
+            cached = self.__groups.get(key)
+            if cached and cached[0] == self.version:
+                return cached[1]
+            group_position = self.index_keys.index(index_key)
+            sort_position = self.index_keys.index(sort_key)
+            items = sorted(self.__index.items(), key=lambda x: x[1][3][sort_position] or 0)
+            groups: Dict[Any, List] = {}
+            for record_id, entry in items:
+                groups.setdefault(entry[3][group_position], []).append(record_id)
+            self.__groups[key] = (self.version, groups)
+            return groups
+
+    def get_grouped(
+        self,
+        values: Iterable,
+        index_key: str = 'entity_id',
+        sort_key: str = 'created_at'
+    ) -> Dict[Any, List[Dict]]:
+        """ Записи, сгруппированные по значению индексируемого поля
+
+        Args:
+            values: значения поля группировки (например, идентификаторы сделок)
+            index_key: индексируемое поле группировки
+            sort_key: индексируемое поле, по которому упорядочены записи в группе
+
+        Returns:
+            словарь вида { значение поля: [записи, упорядоченные по sort_key] } (только непустые группы)
+        """
+        groups = self.group_ids(index_key=index_key, sort_key=sort_key)
+        selected = {value: groups[value] for value in set(values) if value in groups}
+        records = {
+            record[self.key]: record
+            for record in self.get(record_id for ids in selected.values() for record_id in ids)
+        }
+        return {value: [records[record_id] for record_id in ids] for value, ids in selected.items()}
+
+    def get(self, ids: Iterable) -> List[Dict]:
+        """ Записи по набору идентификаторов
+
+        Args:
+            ids: идентификаторы записей
+
+        Returns:
+            найденные записи (в порядке расположения на диске)
+        """
+        with self.__lock:
+            segments = self.__open_segments([self.__index[_id] for _id in set(ids) if _id in self.__index])
+        return list(self.__read_segments(segments))
+
+    def read(
+        self,
+        date_from: Optional[float] = None,
+        date_to: Optional[float] = None,
+        date_key: str = 'created_at',
+        ids: Optional[Iterable] = None,
+        where: Optional[Callable[[Dict], bool]] = None
+    ) -> Iterator[Dict]:
+        """ Выборка записей по диапазону значений индексируемого поля и/или набору идентификаторов
+
+        Args:
+            date_from: значение поля с (timestamp)
+            date_to: значение поля по (timestamp)
+            date_key: индексируемое поле, по которому идет выборка
+            ids: идентификаторы записей
+            where: дополнительное условие на запись (проверяется после чтения)
+
+        Yields:
+            записи в порядке расположения на диске
+        """
+        with self.__lock:
+            if ids is not None:
+                entries = [self.__index[_id] for _id in set(ids) if _id in self.__index]
+            else:
+                entries = list(self.__index.values())
+            if date_from is not None or date_to is not None:
+                position = self.index_keys.index(date_key)
+                entries = [
+                    entry for entry in entries
+                    if entry[3][position] and
+                    (date_from is None or date_from <= entry[3][position]) and
+                    (date_to is None or entry[3][position] <= date_to)
+                ]
+            segments = self.__open_segments(entries)
+        for record in self.__read_segments(segments):
+            if where is None or where(record):
+                yield record
+
+    def append(self, records: Iterable[Dict]) -> int:
+        """ Добавляет (или обновляет) записи, дописывая их в конец сегментов
+
+        Args:
+            records: записи
+
+        Returns:
+            количество записанных записей
+        """
+        # группируем записи по сегментам, чтобы каждый файл открывался один раз
+        by_segment: Dict[str, List[Dict]] = {}
+        for record in records:
+            by_segment.setdefault(self.__segment_name(record), []).append(record)
+        if not by_segment:
+            return 0
+        journal = []
+        with self.__lock:
+            os.makedirs(self.path, exist_ok=True)
+            for segment, segment_records in by_segment.items():
+                with open(self.__segment_path(segment), 'ab') as file:
+                    offset = file.tell()
+                    for record in segment_records:
+                        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                        file.write(data)
+                        entry = (
+                            segment,
+                            offset,
+                            len(data),
+                            tuple(record.get(index_key) for index_key in self.index_keys)
+                        )
+                        self.__set_entry(record[self.key], entry)
+                        journal.append((record[self.key], entry))
+                        offset += len(data)
+            self.__write_journal(journal)
+            self.version += 1
+            ratio = Config().data_store_compact_ratio
+            segments = [
+                segment for segment, dead in self.__dead.items()
+                if dead and dead > ratio * os.path.getsize(self.__segment_path(segment))
+            ]
+            if segments:
+                self.compact(segments=segments)
+        return len(journal)
+
+    def compact(self, segments: Optional[Iterable[str]] = None):
+        """ Переписывает сегменты, удаляя из них устаревшие версии записей
+
+        Новый файл сегмента подменяет прежний целиком, поэтому начатое чтение дочитывает прежнюю версию файла
+
+        Args:
+            segments: сегменты (по умолчанию - все)
+        """
+        with self.__lock:
+            by_segment: Dict[str, List[Tuple[Any, Tuple]]] = {}
+            for record_id, entry in self.__index.items():
+                by_segment.setdefault(entry[0], []).append((record_id, entry))
+            for segment in (set(by_segment.keys()) | set(self.__dead.keys()) if segments is None else set(segments)):
+                items = sorted(by_segment.get(segment) or [], key=lambda x: x[1][1])
+                segment_path = self.__segment_path(segment)
+                if not items:
+                    # в сегменте не осталось актуальных записей
+                    if os.path.exists(segment_path):
+                        os.remove(segment_path)
+                    self.__dead.pop(segment, None)
+                    continue
+                records = self.__read_segments(self.__open_segments([x[1] for x in items]))
+                tmp_path = f'{segment_path}.tmp'
+                with open(tmp_path, 'wb') as file:
+                    offset = 0
+                    for record, (record_id, entry) in zip(records, items):
+                        data = pickle.dumps(record, protocol=pickle.HIGHEST_PROTOCOL)
+                        file.write(data)
+                        self.__index[record_id] = (segment, offset, len(data), entry[3])
+                        offset += len(data)
+                os.replace(tmp_path, segment_path)
+                self.__dead.pop(segment, None)
+            self.__save_index()
+            self.version += 1
+
+    def import_pickle(self, file_path: str) -> int:
+        """ Переносит записи из прежнего pickle-файла (список словарей) в хранилище
+
+        Args:
+            file_path: путь к pickle-файлу
+
+        Returns:
+            количество перенесенных записей
+        """
+        with open(file_path, 'rb') as file:
+            return self.append(pickle.load(file) or [])
+
+    def __open_segments(self, entries: List[Tuple[str, int, int, Tuple]]) -> List[Tuple[mmap.mmap, List[Tuple]]]:
+        """ Отображает в память сегменты с нужными записями (вызывается под блокировкой вместе с выборкой entries:
+            отображение остается привязанным к прочитанной версии файла, даже если сегмент затем будет сжат)
+
+        Returns:
+            список вида [(отображение сегмента, элементы индекса по возрастанию смещения), ...]
+        """
+        by_segment: Dict[str, List[Tuple[str, int, int, Tuple]]] = {}
+        for entry in entries:
+            by_segment.setdefault(entry[0], []).append(entry)
+        segments = []
+        try:
+            # сегменты читаем в хронологическом порядке, записи - по возрастанию смещения
+            for segment in sorted(by_segment.keys()):
+                with open(self.__segment_path(segment), 'rb') as file:
+                    mm = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+                segments.append((mm, sorted(by_segment[segment], key=lambda x: x[1])))
+        except Exception:
+            for mm, _ in segments:
+                mm.close()
+            raise
+        return segments
+
+    def __read_segments(self, segments: List[Tuple[mmap.mmap, List[Tuple]]]) -> Iterator[Dict]:
+        try:
+            for mm, segment_entries in segments:
+                for _, offset, length, _ in segment_entries:
+                    yield pickle.loads(mm[offset:offset + length])
+        finally:
+            for mm, _ in segments:
+                mm.close()
+
+    def __set_entry(self, record_id: Any, entry: Tuple[str, int, int, Tuple]):
+        """ Обновляет элемент индекса; прежняя версия записи становится мусором своего сегмента """
+        old_entry = self.__index.get(record_id)
+        # повторное применение того же элемента (журнал, уже слитый с индексом) мусора не добавляет
+        if old_entry == entry:
+            return
+        if old_entry is not None:
+            self.__dead[old_entry[0]] = self.__dead.get(old_entry[0], 0) + old_entry[2]
+        self.__index[record_id] = entry
+
+    def __segment_name(self, record: Dict) -> str:
+        created_at = record.get('created_at')
+        if not created_at:
+            return UNDATED_SEGMENT
+        return datetime.utcfromtimestamp(created_at).strftime('%Y-%m')
+
+    def __segment_path(self, segment: str) -> str:
+        return os.path.join(self.path, f'{segment}.seg')
+
+    def __load_index(self):
+        index_path = os.path.join(self.path, INDEX_FILE_NAME)
+        if os.path.exists(index_path):
+            with open(index_path, 'rb') as file:
+                data = pickle.load(file)
+            # набор индексируемых полей изменился - индекс придется перестроить
+            if data.get('index_keys') != self.index_keys:
+                self.__rebuild_index()
+                return
+            self.__index = data.get('index') or {}
+            self.__dead = data.get('dead') or {}
+        if self.__replay_journal():
+            self.__save_index()
+
+    def __replay_journal(self) -> bool:
+        """ Применяет к индексу журнал записей
+
+        Returns:
+            True - журнал был
+        """
+        journal_path = os.path.join(self.path, JOURNAL_FILE_NAME)
+        if not os.path.exists(journal_path):
+            return False
+        with open(journal_path, 'rb') as file:
+            while True:
+                try:
+                    items = pickle.load(file)
+                except (EOFError, pickle.UnpicklingError):
+                    # конец журнала (или недописанный при сбое хвост)
+                    break
+                for record_id, entry in items:
+                    self.__set_entry(record_id, entry)
+        return True
+
+    def __write_journal(self, items: List[Tuple[Any, Tuple[str, int, int, Tuple]]]):
+        with open(os.path.join(self.path, JOURNAL_FILE_NAME), 'ab') as file:
+            file.write(pickle.dumps(items, protocol=pickle.HIGHEST_PROTOCOL))
+
+    def __rebuild_index(self):
+        self.__index = {}
+        self.__dead = {}
+        if not os.path.isdir(self.path):
+            return
+        for file_name in sorted(os.listdir(self.path)):
+            if not file_name.endswith('.seg'):
+                continue
+            segment = file_name[:-4]
+            with open(self.__segment_path(segment), 'rb') as file:
+                offset = 0
+                while True:
+                    try:
+                        record = pickle.load(file)
+                    except EOFError:
+                        break
+                    position = file.tell()
+                    self.__set_entry(record[self.key], (
+                        segment,
+                        offset,
+                        position - offset,
+                        tuple(record.get(index_key) for index_key in self.index_keys)
+                    ))
+                    offset = position
+        self.__save_index()
+
+    def __save_index(self):
+        os.makedirs(self.path, exist_ok=True)
+        index_path = os.path.join(self.path, INDEX_FILE_NAME)
+        tmp_path = f'{index_path}.tmp'
+        with open(tmp_path, 'wb') as file:
+            pickle.dump(
+                {'index_keys': self.index_keys, 'index': self.__index, 'dead': self.__dead},
+                file,
+                protocol=pickle.HIGHEST_PROTOCOL
+            )
+        # индекс подменяется атомарно: при сбое остается прежняя версия (вместе с журналом)
+        os.replace(tmp_path, index_path)
+        journal_path = os.path.join(self.path, JOURNAL_FILE_NAME)
+        if os.path.exists(journal_path):
+            os.remove(journal_path)
@@ -0,0 +1,152 @@
+""" Пакетное построение полей этапов воронки для строк сводной таблицы
+
+Notes:
+    Построчные проходы процессора (_check_alive_stages, _freeze_stages, _process_prices) перебирают
+        lead_models × stages_priority для каждого лида. В пакетном режиме флаги, даты, цены и планируемый доход
+        считаются операциями над столбцами пакета лидов по скомпилированной схеме модели (Lead.get_schema)
+"""
+__author__ = 'ke.mizonov'
+from typing import Any, Dict, List, Tuple, Type
+import numpy as np
+from pandas import DataFrame, Series, to_datetime
+from app.amo.data.base.data_schema import Lead
+
+
+def blank_where(values: Any, mask: np.ndarray) -> np.ndarray:
+    """ Значения там, где выполняется условие, иначе '' (пустое значение строки сводной таблицы)
+
+    Args:
+        values: скаляр или массив значений
+        mask: условие
+
+    Returns:
+        массив объектов
+    """
+    mask = np.asarray(mask, dtype=bool)
+    result = np.full(mask.shape, '', dtype=object)
+    result[mask] = np.asarray(values)[mask] if np.ndim(values) else values
+    return result
+
+
+class StageFrame:
+    """ Пакет строк сводной таблицы в виде столбцов
+
+    Столбцы читаются из строк по требованию, вычисленные столбцы записываются обратно в строки (flush)
+    """
+
+    def __init__(self, lines: List[Dict]):
+        self.lines = lines
+        self.__columns: Dict[str, Series] = {}
+        self.__result: Dict[str, Series] = {}
+
+    def __len__(self) -> int:
+        return len(self.lines)
+
+    def __getitem__(self, key: str) -> Series:
+        if key in self.__result:
+            return self.__result[key]
+        if key not in self.__columns:
+            self.__columns[key] = Series([line.get(key, '') for line in self.lines], dtype=object)
+        return self.__columns[key]
+
+    def __setitem__(self, key: str, values: Any):
+        if not np.ndim(values):
+            values = np.full(len(self.lines), values, dtype=object)
+        self.__result[key] = Series(values, dtype=object)
+
+    def set_where(self, key: str, mask: np.ndarray, values: Any):
+        """ Записывает значения там, где выполняется условие (остальные значения столбца не меняются)
+
+        Args:
+            key: столбец
+            mask: условие
+            values: скаляр или массив значений
+        """
+        column = self[key].to_numpy(dtype=object, copy=True)
+        mask = np.asarray(mask, dtype=bool)
+        column[mask] = np.asarray(values, dtype=object)[mask] if np.ndim(values) else values
+        self[key] = column
+
+    def dates(self, key: str) -> Series:
+        """ Столбец дат (пустые значения - NaT) """
+        column = self[key]
+        return to_datetime(column.where(column != ''), errors='coerce')
+
+    def days_after(self, key: str, created_at_key: str) -> Tuple[np.ndarray, np.ndarray]:
+        """ Количество дней от даты создания до даты в столбце
+
+        Args:
+            key: столбец с датой
+            created_at_key: столбец с датой создания
+
+        Returns:
+            (дата заполнена и не раньше даты создания, количество дней)
+        """
+        created_at = self.dates(created_at_key)
+        value = self.dates(key)
+        reached = (value >= created_at).to_numpy()
+        days = (value - created_at).dt.days.fillna(0).astype(int).to_numpy()
+        return reached, days
+
+    def flush(self):
+        """ Записывает вычисленные столбцы в строки """
+        if not self.__result:
+            return
+        # to_dict приводит значения numpy к встроенным типам Python (строки уходят в JSON)
+        for line, values in zip(self.lines, DataFrame(self.__result).to_dict('records')):
+            line.update(values)
+        self.__result.clear()
+        self.__columns.clear()
+
+
+def process_stages(
+    frame: StageFrame,
+    lead_models: List[Type[Lead]],
+    prices: List,
+    status_key: str,
+    at_work_any_key: str
+):
+    """ Текущие стадии, цены и планируемый доход по этапам воронки для пакета строк
+
+    Повторяет DataProcessor._check_alive_stages и DataProcessor._process_prices
+
+    Args:
+        frame: пакет строк
+        lead_models: модели лида
+        prices: бюджеты сделок (в порядке строк)
+        status_key: столбец с названием этапа Amo
+        at_work_any_key: столбец "в работе в любой воронке"
+    """
+    status = frame[status_key].map(lambda x: (x or '').lower())
+    price = np.asarray(prices)
+    has_price = price > 0
+    at_work_any = np.zeros(len(frame), dtype=bool)
+    for lead_model in lead_models:
+        schema = lead_model.get_schema()
+        alive_count = np.zeros(len(frame), dtype=int)
+        at_work_count = np.zeros(len(frame), dtype=int)
+        for stage, include_stages in zip(schema.stages, schema.include_stages):
+            alive = status.isin(include_stages).to_numpy()
+            frame[stage.Alive] = blank_where(1, alive)
+            alive_count += alive
+            if stage.AtWork:
+                at_work_count += alive
+            # фактический доход
+            paid = (frame[stage.Key] == 1).to_numpy() & has_price
+            frame[stage.Price] = blank_where(price, paid)
+            fact = np.where(paid, price, 0)
+            full = fact.astype(object)
+            frame[stage.PlannedIncome] = ''
+            # планируемый доход (заполняется только для этапов с заданными конверсиями)
+            if stage.PurchaseRate > 0:
+                planned = alive * stage.PurchaseRate * price
+                frame[stage.PlannedIncome] = blank_where(planned, planned != 0)
+                customers = np.trunc(alive * stage.PurchaseRate).astype(int)
+                frame[stage.PlannedCustomers] = blank_where(customers, customers != 0)
+                has_planned = planned != 0
+                full[has_planned] = (fact + planned)[has_planned]
+            frame[stage.PlannedIncomeFull] = blank_where(full, full != 0)
+        frame[schema.instance.AllAlive.Key] = blank_where(alive_count, alive_count > 0)
+        frame[schema.instance.AtWork.Key] = blank_where(at_work_count, at_work_count > 0)
+        at_work_any |= at_work_count > 0
+    frame[at_work_any_key] = blank_where(1, at_work_any)
@@ -5,6 +5,9 @@ import zipfile
 from datetime import datetime
 from typing import Union, List, Dict, Tuple, Optional
 
+# количество цифр (с конца), по которым сравниваются телефоны при поиске дублей
+DUPLICATE_PHONE_DIGITS = 8
+
 
 def append_unique(source_collection: List[Dict], new_collection: List[Dict]):
     """ Добавляет к исходному списку словарей новый список словарей, исключая повторы
@@ -52,6 +55,56 @@ def clear_phone(phone: Union[int, str], digits: Optional[int] = None) -> Optiona
     return phone
 
 
+def get_contact_keys(contact: Dict) -> List[str]:
+    """ Нормализованные телефоны и email контакта - ключи индекса поиска дублей
+
+    Args:
+        contact: контакт Amo (custom_fields_values)
+
+    Returns:
+        телефоны (последние DUPLICATE_PHONE_DIGITS цифр) и email в нижнем регистре, без повторов
+    """
+    keys = []
+    for contact_field in contact.get('custom_fields_values') or []:
+        field_code = contact_field.get('field_code')
+        for value in contact_field.get('values') or []:
+            key = None
+            if field_code == 'PHONE':
+                key = get_phone_key(value.get('value'))
+            elif field_code == 'EMAIL':
+                key = get_email_key(value.get('value'))
+            if key and key not in keys:
+                keys.append(key)
+    return keys
+
+
+def get_phone_key(phone: Union[int, str, None]) -> Optional[str]:
+    """ Нормализованный телефон - ключ индекса поиска дублей
+
+    Args:
+        phone: телефон в произвольном формате
+
+    Returns:
+        последние DUPLICATE_PHONE_DIGITS цифр номера, None - если цифр меньше
+    """
+    # из номера берем только цифры: скобки, пробелы и прочее оформление не мешают сравнению
+    digits = ''.join(x for x in str(phone or '') if x.isdigit())
+    return digits[-DUPLICATE_PHONE_DIGITS:] if len(digits) >= DUPLICATE_PHONE_DIGITS else None
+
+
+def get_email_key(email: Optional[str]) -> Optional[str]:
+    """ Нормализованный email - ключ индекса поиска дублей
+
+    Args:
+        email: адрес почты
+
+    Returns:
+        адрес в нижнем регистре, None - если это не адрес
+    """
+    email = str(email or '').strip().lower()
+    return email if '@' in email and len(email) >= 6 else None
+
+
 def get_current_timeshift() -> int:
     """ Возвращает смещение времени в часах относительно GMT для текущего часового пояса """
     current_timeshift = datetime.now().astimezone().strftime("%z")
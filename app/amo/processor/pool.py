@@ -0,0 +1,101 @@
+""" Пул процессов для параллельного построения строк сводной таблицы """
+__author__ = 'ke.mizonov'
+import multiprocessing
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterator, List, Optional, Tuple, Type
+
+pools: Dict[type, Tuple[int, ProcessPoolExecutor]] = {}
+lock = threading.Lock()
+# процессор данных, созданный в процессе пула (справочники загружаются один раз на процесс)
+worker_processor = None
+
+
+def get_pivot_pool(processor_class: Type, processes: int) -> ProcessPoolExecutor:
+    """ Синглтон пула процессов для класса процессора данных
+
+    Процессы запускаются через spawn: форк процесса с eventlet и открытыми соединениями с БД небезопасен
+
+    Args:
+        processor_class: класс процессора данных (SMDataProcessor, CDVDataProcessor)
+        processes: количество процессов
+
+    Returns:
+        пул процессов
+    """
+    with lock:
+        size, pool = pools.get(processor_class) or (None, None)
+        if pool is not None and size == processes:
+            return pool
+        if pool is not None:
+            pool.shutdown(wait=True)
+        pool = ProcessPoolExecutor(
+            max_workers=processes,
+            mp_context=multiprocessing.get_context('spawn'),
+            initializer=__init_worker,
+            initargs=(processor_class, )
+        )
+        pools[processor_class] = (processes, pool)
+    return pool
+
+
+def shutdown_pivot_pools():
+    """ Останавливает все пулы процессов """
+    with lock:
+        for _, pool in pools.values():
+            pool.shutdown(wait=True)
+        pools.clear()
+
+
+def build_lines(
+    processor_class: Type,
+    tasks: List[Tuple[Dict, List]],
+    pre_data: Dict,
+    processes: int,
+    chunk_size: int,
+    schedule: Optional[Dict] = None,
+    bulk: bool = False
+) -> Iterator[Dict]:
+    """ Строит строки сводной таблицы в пуле процессов
+
+    Args:
+        processor_class: класс процессора данных
+        tasks: пары (лид, события создания лида)
+        pre_data: предзагруженные словари (см. DataProcessor._pre_build)
+        processes: количество процессов
+        chunk_size: количество лидов в одной задаче пула
+        schedule: расписание
+        bulk: строить строки задачи пакетом (см. DataProcessor._build_lines_bulk)
+
+    Yields:
+        строки сводной таблицы в исходном порядке лидов
+    """
+    pool = get_pivot_pool(processor_class=processor_class, processes=processes)
+    chunks = [tasks[i:i + chunk_size] for i in range(0, len(tasks), chunk_size)]
+    for lines in pool.map(
+        _build_chunk,
+        chunks,
+        [pre_data] * len(chunks),
+        [schedule] * len(chunks),
+        [bulk] * len(chunks)
+    ):
+        yield from lines
+
+
+def _build_chunk(
+    tasks: List[Tuple[Dict, List]],
+    pre_data: Dict,
+    schedule: Optional[Dict] = None,
+    bulk: bool = False
+) -> List[Dict]:
+    if bulk:
+        return worker_processor._build_lines_bulk(tasks=tasks, pre_data=pre_data, schedule=schedule)
+    return [
+        worker_processor._build_line(lead=lead, events=events, pre_data=pre_data, schedule=schedule)
+        for lead, events in tasks
+    ]
+
+
+def __init_worker(processor_class: Type):
+    global worker_processor
+    worker_processor = processor_class()
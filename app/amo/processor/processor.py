@@ -1,21 +1,29 @@
+from copy import deepcopy
 from dataclasses import dataclass
 from datetime import datetime, timezone, timedelta
 from enum import Enum
 from functools import reduce
 from typing import Dict, List, Optional, Any, Type, Tuple, Union
-from sqlalchemy import Table, MetaData, select, and_, func, text
+import numpy as np
+from sqlalchemy import select, and_, func, text
 from app.amo.api.constants import AmoEvent
 from app.amo.data.base.data_schema import Lead, LeadField
 from app.amo.data.cdv.data_schema import LeadCDV, LeadMT
 from app.amo.data.sm.data_schema import LeadSM
+from app.amo.processor.bulk import StageFrame, blank_where, process_stages
 from app.amo.processor.communication import CommunicationBase
 from app.amo.processor.countries import CONTRY_REPLACEMENTS
 from app.amo.processor.country_codes import get_country_codes, get_country_by_code
 from app.amo.processor.functions import clear_phone
-from app.amo.processor.utm_controller import build_final_utm
+from app.amo.processor.pool import build_lines
+from app.amo.processor.references import get_references
+from app.amo.processor.utm_controller import build_final_utm, build_final_utm_bulk, compile_utm_rules
 from app.engine import get_engine
 from app.logger import DBLogger
+from app.metadata import get_table
 from app.models.log import SMLog, CDVLog
+from app.models.sync_state import SYNCED_AT_ENTITY, DUPLICATE_INDEX_ENTITY
+from app.google_api.cache import get_reference_sheet
 from app.google_api.client import GoogleAPIClient
 
 
@@ -48,6 +56,12 @@ CLOSE_REASON_SUCCESS = (
     'Успешно реализовано'
 )
 MAXIMUM_OFFER_SENDING_SPEED = 45
+# предельное количество лидов в одном запросе событий создания
+EVENTS_LOOKUP_CHUNK = 5000
+# количество лидов в одной задаче пула процессов при построении сводной таблицы
+PIVOT_CHUNK_SIZE = 200
+# количество лидов в одном пакете при пакетном построении строк сводной таблицы
+BULK_CHUNK_SIZE = 5000
 
 
 class DataProcessor:
@@ -57,6 +71,8 @@ class DataProcessor:
     time_shift: int = NotImplemented
     check_by_stages: bool = False
     utm_rules_book_id: str = NotImplemented
+    # сортировать ключи строки сводной таблицы
+    sort_lines: bool = False
 
     @dataclass
     class By:
@@ -74,18 +90,10 @@ class DataProcessor:
         self.__date_to = date_to
         self.lead: Lead = self.lead_models[0]()
         self.engine = get_engine()
-        # загрузка справочников
-        self.pipelines_dict = {
-            pipeline['id_on_source']: {
-                'name': pipeline['name'],
-                'statuses': {
-                    status['id']: status['name']
-                    for status in (pipeline.get('_embedded') or {}).get('statuses') or []
-                }
-            }
-            for pipeline in self.pipelines()
-        }
-        self.users_dict = {x['id_on_source']: x for x in self.users()}
+        # справочники - из общего кэша филиала (не изменять!)
+        self.references = get_references(schema=self.schema, engine=self.engine)
+        self.pipelines_dict = self.references.pipelines
+        self.users_dict = self.references.users
 
     @property
     def __date_from_ts(self):
@@ -161,8 +169,23 @@ class DataProcessor:
         date_from: Optional[datetime] = None,
         date_to: Optional[datetime] = None,
         schedule: Optional[Dict] = None,
-        pre_data: Optional[Dict] = None
+        pre_data: Optional[Dict] = None,
+        processes: int = 0,
+        bulk: bool = False
     ) -> Dict:
+        """ Строки сводной таблицы для лидов, обновленных за период
+
+        Args:
+            date_from: дата с
+            date_to: дата по
+            schedule: расписание
+            pre_data: предзагруженные словари (см. _pre_build)
+            processes: количество процессов для параллельного построения строк (0 - в текущем процессе)
+            bulk: пакетный режим - поля этапов воронки считаются по столбцам пакета лидов (см. bulk.py)
+
+        Yields:
+            строки сводной таблицы
+        """
         if date_from:
             self.__date_from = date_from
         if date_to:
@@ -171,33 +194,127 @@ class DataProcessor:
         lead_ids_created_at_dict = {lead['id_on_source']: lead['created_at'] for lead in leads}
         events_dict = self.get_events(lead_ids_created_at_dict=lead_ids_created_at_dict)
         # deleted_ids = self.get_delete_events_data()
+        if processes > 1 and len(leads) > PIVOT_CHUNK_SIZE:
+            # лиды вместе со справочниками уходят в пул процессов, строки возвращаются в исходном порядке
+            yield from build_lines(
+                processor_class=type(self),
+                tasks=[(lead, events_dict.get(lead['id_on_source']) or []) for lead in leads],
+                pre_data=pre_data,
+                processes=processes,
+                chunk_size=PIVOT_CHUNK_SIZE,
+                schedule=schedule,
+                bulk=bulk
+            )
+            return
+        if bulk:
+            for i in range(0, len(leads), BULK_CHUNK_SIZE):
+                yield from self._build_lines_bulk(
+                    tasks=[
+                        (lead, events_dict.get(lead['id_on_source']) or [])
+                        for lead in leads[i:i + BULK_CHUNK_SIZE]
+                    ],
+                    pre_data=pre_data,
+                    schedule=schedule
+                )
+            return
         for lead in leads:
+            yield self._build_line(
+                lead=lead,
+                events=events_dict.get(lead['id_on_source']) or [],
+                pre_data=pre_data,
+                schedule=schedule
+            )
+
+    def _build_line(self, lead: Dict, events: List, pre_data: Dict, schedule: Optional[Dict] = None) -> Dict:
+        """ Строка сводной таблицы для лида
+
+        Args:
+            lead: лид
+            events: события, связанные с созданием лида
+            pre_data: предзагруженные словари (см. _pre_build)
+            schedule: расписание
+
+        Returns:
+            строка сводной таблицы
+        """
+        # важно! подменяем идентификатор лида на идентификатор с источника
+        lead['id'] = lead['id_on_source']
+        created_by = lead['created_by']
+        # if lead['id'] in deleted_ids:
+        #     lead['deleted'] = 1
+        line = self._build_lead_data(lead=lead, pre_data=pre_data, schedule=schedule)
+        return self._complete_line(lead=line, created_by=created_by, events=events)
+
+    def _build_lines_bulk(
+        self,
+        tasks: List[Tuple[Dict, List]],
+        pre_data: Dict,
+        schedule: Optional[Dict] = None
+    ) -> List[Dict]:
+        """ Строки сводной таблицы для пакета лидов
+
+        Поля лида строятся построчно, а поля этапов воронки (текущие стадии, скорость прохождения, цены,
+            планируемый доход) - по столбцам всего пакета
+
+        Args:
+            tasks: пары (лид, события создания лида)
+            pre_data: предзагруженные словари (см. _pre_build)
+            schedule: расписание
+
+        Returns:
+            строки сводной таблицы в исходном порядке лидов
+        """
+        lines, prices, created_by = [], [], []
+        utms = build_final_utm_bulk(leads=[lead for lead, _ in tasks], rules=pre_data['utm_rules'])
+        for (lead, _), utm in zip(tasks, utms):
             # важно! подменяем идентификатор лида на идентификатор с источника
             lead['id'] = lead['id_on_source']
-            created_by = lead['created_by']
-            # if lead['id'] in deleted_ids:
-            #     lead['deleted'] = 1
-            lead = self._build_lead_data(lead=lead, pre_data=pre_data, schedule=schedule)
-            # created_at_offset: сравнение времени самого раннего события, примечания или задачи с датой создания лида
-            # self.__fix_created_at_lead(lead=lead)
-            # подмешиваем страны, определенные по номерам телефонов
-            self.__process_lead_country_by_phone_code(lead=lead)
-            # подмешиваем данные Sipuni
-            pass
-            # поля для упрощенной группировки по периодам
-            created_at = lead['created_at']
-            lead['created_by'] = created_by
-            lead['creation_source'] = self.get_source(lead=lead, events=events_dict.get(lead['id']) or [])
-            lead['year'] = created_at.year
-            lead['month'] = created_at.month
-            lead['day'] = created_at.day
-            lead['week'] = created_at.isocalendar()[1]
-            # убираем лишние поля
-            for key in ('budget', 'discount', 'events', 'notes', 'tasks', 'created_by'):
-                if key not in lead:
-                    continue
-                lead.pop(key)
-            yield lead
+            created_by.append(lead['created_by'])
+            prices.append(lead['price'] or 0)
+            lines.append(self._build_lead_data(lead=lead, pre_data=pre_data, schedule=schedule, bulk=True, utm=utm))
+        frame = StageFrame(lines=lines)
+        self._process_stages_bulk(frame=frame, prices=prices)
+        frame.flush()
+        return [
+            self._complete_line(
+                lead=self._sort_dict(line) if self.sort_lines else line,
+                created_by=_created_by,
+                events=events
+            )
+            for line, _created_by, (_, events) in zip(lines, created_by, tasks)
+        ]
+
+    def _complete_line(self, lead: Dict, created_by: int, events: List) -> Dict:
+        """ Дополняет построенные данные лида полями строки сводной таблицы
+
+        Args:
+            lead: данные лида (см. _build_lead_data)
+            created_by: автор сделки
+            events: события, связанные с созданием лида
+
+        Returns:
+            строка сводной таблицы
+        """
+        # created_at_offset: сравнение времени самого раннего события, примечания или задачи с датой создания лида
+        # self.__fix_created_at_lead(lead=lead)
+        # подмешиваем страны, определенные по номерам телефонов
+        self.__process_lead_country_by_phone_code(lead=lead)
+        # подмешиваем данные Sipuni
+        pass
+        # поля для упрощенной группировки по периодам
+        created_at = lead['created_at']
+        lead['created_by'] = created_by
+        lead['creation_source'] = self.get_source(lead=lead, events=events)
+        lead['year'] = created_at.year
+        lead['month'] = created_at.month
+        lead['day'] = created_at.day
+        lead['week'] = created_at.isocalendar()[1]
+        # убираем лишние поля
+        for key in ('budget', 'discount', 'events', 'notes', 'tasks', 'created_by'):
+            if key not in lead:
+                continue
+            lead.pop(key)
+        return lead
 
     def get_events(self, lead_ids_created_at_dict: Dict) -> Dict:
         """
@@ -269,33 +386,29 @@ class DataProcessor:
             'incoming_chat_message',
             'incoming_call'
         ]
-        # Подготовка частей условия WHERE для каждого lead_id и создания интервала
-        time_conditions = []
-        params = {'types': types}  # Начальная инициализация параметров запроса
-        i = 0
-        for lead_id, lead_created_at in lead_ids_created_at_dict.items():
-            key_id = f"lead_id_{i}"
-            key_from = f"ts_from_{i}"
-            key_to = f"ts_to_{i}"
-            time_conditions.append(f"""
-                ("entity_id" = :{key_id} AND "created_at" BETWEEN :{key_from} AND :{key_to})
-            """)
-            params[key_id] = lead_id
-            params[key_from] = lead_created_at - 10
-            params[key_to] = lead_created_at + 10
-            i += 1
-        # Формирование финального запроса с динамически созданными условиями
-        query = f"""
-            SELECT created_at, type, value_after, entity_id, created_by FROM {self.schema}."Event"
+        # лиды и даты их создания передаются массивами, Postgres сам соединяет их с событиями
+        query = text(f"""
+            SELECT e.created_at, e.type, e.value_after, e.entity_id, e.created_by
+            FROM unnest(CAST(:lead_ids AS bigint[]), CAST(:created_at AS bigint[])) AS l(lead_id, lead_created_at)
+            JOIN {self.schema}."Event" e
+                ON e.entity_id = l.lead_id
+                AND e.created_at BETWEEN l.lead_created_at - 10 AND l.lead_created_at + 10
             WHERE
-                "entity_type" = 'lead'
-                AND "type" = ANY(:types)
-                AND ({" OR ".join(time_conditions)})
-        """
-        # Выполнение запроса в контекстном менеджере
+                e.entity_type = 'lead'
+                AND e.type = ANY(:types)
+        """)
+        items = list(lead_ids_created_at_dict.items())
+        results = []
         with self.engine.begin() as connection:
-            result = connection.execute(text(query), params)
-            results = [dict(row) for row in result.mappings()]
+            # очень большие окна разбиваем на пакеты
+            for i in range(0, len(items), EVENTS_LOOKUP_CHUNK):
+                chunk = items[i:i + EVENTS_LOOKUP_CHUNK]
+                result = connection.execute(query, {
+                    'types': types,
+                    'lead_ids': [lead_id for lead_id, _ in chunk],
+                    'created_at': [lead_created_at for _, lead_created_at in chunk],
+                })
+                results.extend(dict(row) for row in result.mappings())
         return results
 
     def __get_users_leads(self):
@@ -363,10 +476,23 @@ class DataProcessor:
         keys = ['id'] + sorted(keys)
         return dict([(f, _dict.get(f)) for f in keys])
 
-    def _build_lead_data(self, lead: Dict, pre_data: Dict, schedule: Optional[Dict] = None):
+    def _build_lead_data(
+        self,
+        lead: Dict,
+        pre_data: Dict,
+        schedule: Optional[Dict] = None,
+        bulk: bool = False,
+        utm: Optional[Dict] = None
+    ):
         raise NotImplementedError
 
-    def _build_lead_base_data(self, lead: Dict, pre_data: Dict) -> Dict:
+    def _build_lead_base_data(
+        self,
+        lead: Dict,
+        pre_data: Dict,
+        bulk: bool = False,
+        utm: Optional[Dict] = None
+    ) -> Dict:
         _embedded = lead.get('_embedded') or {}
         # причина закрытия
         loss_reason = _embedded['loss_reason'][0]['name'] if _embedded['loss_reason'] else ''
@@ -386,16 +512,17 @@ class DataProcessor:
         user_group = (user.get('_embedded').get('groups') or [{}])[0].get('name')
         del user
         lead['sub_domain'] = self.sub_domain
+        schema = self.lead.get_schema()
         # готовим пустой словарь с обязательным списком полей
-        line = {field.Key: '' for field in self.lead.get_fields()}
+        line = {field.Key: '' for field in schema.fields}
         # добавляем выборочно сырые поля из лида, а также доп. поля (значение по умолчанию - '')
-        for field in self.lead.get_raw_fields():
+        for field in schema.raw_fields:
             line[field.Key] = lead.get(field.Key, '')
         # добавляем поля utm-меток
-        line.update({key: '' for key in self.lead.Utm.get_keys()})
+        line.update({key: '' for key in schema.utm_keys})
         self._build_stages_fields(line=line)
-        # добавляем постобработанные utm
-        line.update(build_final_utm(lead=lead, rules=pre_data['utm_rules']))
+        # добавляем постобработанные utm (в пакетном режиме они посчитаны для всего пакета)
+        line.update(build_final_utm(lead=lead, rules=pre_data['utm_rules']) if utm is None else utm)
         for field in lead.get('custom_fields_values') or []:
             name = field.get('field_name')
             lower_name = name.lower()
@@ -412,9 +539,9 @@ class DataProcessor:
             else:
                 loss_reason = 'active'
         is_lead = 1 if self._is_lead(loss_reason) and not lead.get('deleted') and not lead.get('deleted_leads') else ''
-        is_target = 1 if is_lead and (not loss_reason or loss_reason in self.lead.get_loss_reasons()) else ''
+        is_target = 1 if is_lead and (not loss_reason or loss_reason in schema.loss_reasons) else ''
         for lead_model in self.lead_models:
-            stage_instance = lead_model.Stage()
+            stage_instance = lead_model.get_schema().stage
             line.update({
                 stage_instance.RawLead.Key: 1,
                 stage_instance.Lead.Key: is_lead,
@@ -439,7 +566,11 @@ class DataProcessor:
             'created_at_ts': lead['created_at'],
             'updated_at_ts': lead['updated_at'],
         })
-        self._check_alive_stages(line=line)
+        # в пакетном режиме текущие стадии считаются по столбцам (см. _process_stages_bulk)
+        if not bulk:
+            self._check_alive_stages(line=line)
+        else:
+            self._seed_alive_stages(line=line)
         del contacts_data
         del lead
         return line
@@ -514,7 +645,7 @@ class DataProcessor:
         # проверка достигнутых стадий
         if self.check_by_stages:
             for status in statuses_after:
-                stage = self.__get_stage_if_reached(stages_priority=stages_priority, status=status['status'])
+                stage = lead_model.get_schema().stage_by_status.get(status['status'])
                 if not stage:
                     continue
                 stage_time = status['date']
@@ -615,19 +746,19 @@ class DataProcessor:
         status_name = (line.get(self.lead.StatusName.Key) or '').lower()
         line[self.lead.AtWorkAnyPipeline.Key] = ''
         for lead_model in self.lead_models:
-            lead_model_instance = lead_model()
-            alive = lead_model_instance.AllAlive.Key
-            at_work = lead_model_instance.AtWork.Key
+            schema = lead_model.get_schema()
+            alive = schema.instance.AllAlive.Key
+            at_work = schema.instance.AtWork.Key
             line[alive] = 0
             line[at_work] = 0
-            for stage in lead_model.get_stages_priority():
-                line[stage.Alive] = 1 if status_name in map(lambda x: x.lower(), stage.IncludeStages) else ''
-                # фиксируем последнюю достигнутую стадию воронки
-                if line[stage.Alive] == 1:
-                    line[alive] += 1
-                    if stage.AtWork:
-                        line[at_work] += 1
-                        line[self.lead.AtWorkAnyPipeline.Key] = 1
+            line.update({stage.Alive: '' for stage in schema.stages})
+            # стадии, на которых лид находится в данный момент
+            for stage in schema.stages_by_status.get(status_name) or ():
+                line[stage.Alive] = 1
+                line[alive] += 1
+                if stage.AtWork:
+                    line[at_work] += 1
+                    line[self.lead.AtWorkAnyPipeline.Key] = 1
             if line[alive] == 0:
                 line[alive] = ''
             if line[at_work] == 0:
@@ -678,12 +809,13 @@ class DataProcessor:
             # # логика прохождения лида по воронке
             # 'stages_priority': self.lead.get_stages_priority(),
             # схема дополнительных полей
-            'lead_custom_fields': {field.CustomField: field.Key for field in self.lead_models[0].get_custom_fields()},
+            'lead_custom_fields': self.lead_models[0].get_schema().custom_field_keys,
             # поля, содержащие даты
             'date_fields': [field.Key for field in self.lead_models[0].get_date_fields()],
             # данные по звонкам
             'calls': calls,
-            'utm_rules': GoogleAPIClient(book_id=self.utm_rules_book_id, sheet_title='rules').get_sheet()
+            # правила обработки меток и тегов (компилируются один раз на построение)
+            'utm_rules': compile_utm_rules(get_reference_sheet(book_id=self.utm_rules_book_id, sheet_title='rules'))
         }
 
     def _process_pipelines(self, line: Dict, lead: Dict, pre_data: Dict):
@@ -691,10 +823,10 @@ class DataProcessor:
         loss_reason = _embedded['loss_reason'][0]['name'] if _embedded['loss_reason'] else ''
         is_lead = 1 if self._is_lead(loss_reason) and not lead.get('deleted') else ''
         for lead_model in self.lead_models:
-            stages_priority = lead_model.get_stages_priority()
-            stage_instance = lead_model.Stage()
-            is_target = 1 if is_lead and (not loss_reason or loss_reason in lead_model.get_loss_reasons()) else ''
-            line[stage_instance.Target.Key] = is_target
+            schema = lead_model.get_schema()
+            stages_priority = schema.stages
+            is_target = 1 if is_lead and (not loss_reason or loss_reason in schema.loss_reasons) else ''
+            line[schema.stage.Target.Key] = is_target
             # строим историю прохождения сделки по этапам
             self._build_lead_history(
                 lead_model=lead_model,
@@ -731,8 +863,92 @@ class DataProcessor:
                 if line[stage.PlannedIncomeFull] == 0:
                     line[stage.PlannedIncomeFull] = ''
 
+    def _seed_alive_stages(self, line: Dict):
+        """ Пакетный режим: добавляет в строку ключи текущих стадий в том же порядке, что и _check_alive_stages
+
+        Значения посчитает _process_stages_bulk, а порядок колонок строки не должен зависеть от режима
+        """
+        line.setdefault(self.lead.AtWorkAnyPipeline.Key, '')
+        for lead_model in self.lead_models:
+            schema = lead_model.get_schema()
+            line.setdefault(schema.instance.AllAlive.Key, '')
+            line.setdefault(schema.instance.AtWork.Key, '')
+            for stage in schema.stages:
+                line.setdefault(stage.Alive, '')
+
+    def _seed_prices(self, line: Dict):
+        """ Пакетный режим: добавляет в строку ключи планируемого дохода в том же порядке, что и _process_prices """
+        for lead_model in self.lead_models:
+            for stage in lead_model.get_stages_priority():
+                if line.get(stage.Key) is None:
+                    continue
+                line.setdefault(stage.PlannedIncome, '')
+                line.setdefault(stage.PlannedIncomeFull, '')
+                if stage.PurchaseRate > 0 and line.get(stage.Alive) is not None:
+                    line.setdefault(stage.PlannedCustomers, '')
+
+    def check_bulk_parity(
+        self,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        sample: int = 200
+    ) -> List[Tuple[int, str]]:
+        """ Сверяет строки, построенные построчно (_build_line) и пакетно (_build_lines_bulk), на выборке лидов
+
+        Args:
+            date_from: дата с
+            date_to: дата по
+            sample: количество лидов в выборке
+
+        Returns:
+            расхождения в виде (идентификатор лида, описание), пустой список - строки совпадают
+        """
+        if date_from:
+            self.__date_from = date_from
+        if date_to:
+            self.__date_to = date_to
+        leads = (self.leads() or [])[:sample]
+        lead_ids_created_at_dict = {lead['id_on_source']: lead['created_at'] for lead in leads}
+        events_dict = self.get_events(lead_ids_created_at_dict=lead_ids_created_at_dict)
+        tasks = [(lead, events_dict.get(lead['id_on_source']) or []) for lead in leads]
+        pre_data = self._pre_build()
+        # построение меняет данные лида, поэтому каждому режиму - своя копия
+        bulk_lines = self._build_lines_bulk(tasks=deepcopy(tasks), pre_data=pre_data)
+        result = []
+        for (lead, events), bulk_line in zip(tasks, bulk_lines):
+            line = self._build_line(lead=deepcopy(lead), events=deepcopy(events), pre_data=pre_data)
+            if list(line.keys()) != list(bulk_line.keys()):
+                result.append((lead['id_on_source'], 'different keys or key order'))
+            for key, value in line.items():
+                if key in bulk_line and bulk_line[key] != value:
+                    result.append((lead['id_on_source'], f'{key}: {value!r} != {bulk_line[key]!r}'))
+        return result
+
+    def _process_stages_bulk(self, frame: StageFrame, prices: List):
+        """ Поля этапов воронки для пакета строк (аналог _check_alive_stages, _freeze_stages и _process_prices)
+
+        Args:
+            frame: пакет строк
+            prices: бюджеты сделок (в порядке строк)
+        """
+        process_stages(
+            frame=frame,
+            lead_models=self.lead_models,
+            prices=prices,
+            status_key=self.lead.StatusName.Key,
+            at_work_any_key=self.lead.AtWorkAnyPipeline.Key
+        )
+        self._freeze_stages_bulk(frame=frame)
+
+    def _freeze_stages_bulk(self, frame: StageFrame):
+        raise NotImplementedError
+
+    def _is_lead_bulk(self, frame: StageFrame) -> np.ndarray:
+        """ Маска лидов (не сырых) в пакете строк """
+        return frame[self.lead.LossReason.Key].map(self._is_lead).to_numpy(dtype=bool)
+
     def __get_data(self, table_name: str, date_field: Optional[str] = 'updated_at') -> List[Dict]:
-        table = Table(table_name, MetaData(), autoload_with=self.engine, schema=self.schema)
+        table = get_table(table_name, schema=self.schema, engine=self.engine)
         if date_field == 'updated_at':
             dt_field = table.c.updated_at
         elif date_field == 'created_at':
@@ -751,36 +967,115 @@ class DataProcessor:
             return [x._asdict() for x in connection.execute(stmt).fetchall() or []]
 
     def get_pipeline_and_status_by_id(self, pipeline_id: int, status_id: int) -> Dict:
-        status_id = str(status_id)
-        table = Table('Pipeline', MetaData(), autoload_with=self.engine, schema=self.schema)
-        with self.engine.begin() as connection:
-            stmt = select(table).where(
-                table.c.id_on_source == pipeline_id
-            )
-            pipeline = connection.execute(stmt).fetchone()
-            if not pipeline:
-                return {}
-            _embedded = pipeline._embedded
-            status = None
-            for line in _embedded.get('statuses'):
-                if str(line['id']) == status_id:
-                    status = line['name']
-                    break
-            return {
-                'pipeline': pipeline.name,
-                'status': status
-            }
+        pipeline = self.pipelines_dict.get(int(pipeline_id)) if str(pipeline_id).isnumeric() else None
+        if not pipeline:
+            return {}
+        return {
+            'pipeline': pipeline['name'],
+            'status': pipeline['statuses'].get(int(status_id)) if str(status_id).isnumeric() else None
+        }
 
     def get_user_by_id(self, user_id: int):
-        table = Table('User', MetaData(), autoload_with=self.engine, schema=self.schema)
+        if not str(user_id).isnumeric():
+            return None
+        return self.references.user_rows.get(int(user_id))
+
+    def get_sync_lag(self) -> Optional[int]:
+        """ Отставание локальных данных от Amo: сколько секунд назад завершился последний проход синхронизации
+
+        Returns:
+            количество секунд, None - если синхронизация еще не завершалась
+        """
+        table = get_table('SyncState', schema=self.schema, engine=self.engine)
         with self.engine.begin() as connection:
-            stmt = select(table).where(
-                table.c.id_on_source == user_id
+            synced_at = connection.execute(
+                select(table.c.watermark).where(table.c.entity == SYNCED_AT_ENTITY)
+            ).scalar()
+        return int(datetime.now().timestamp()) - synced_at if synced_at else None
+
+    def has_duplicate_index(self) -> bool:
+        """ Построен ли индекс поиска дублей по всем сохраненным контактам и сделкам
+
+        Пока индекс не построен (SyncController.rebuild_duplicate_index), в нем есть только контакты и сделки,
+            измененные после развертывания, и искать дубли по нему нельзя
+
+        Returns:
+            True - индекс построен
+        """
+        table = get_table('SyncState', schema=self.schema, engine=self.engine)
+        with self.engine.begin() as connection:
+            return connection.execute(
+                select(table.c.id).where(table.c.entity == DUPLICATE_INDEX_ENTITY)
+            ).first() is not None
+
+    def find_duplicated_leads(
+        self,
+        keys: Optional[List[str]] = None,
+        lead_id: Optional[int] = None,
+        limit: int = 1
+    ) -> List[Dict]:
+        """ Поиск дублей сделки по локальному индексу (телефоны / email контактов)
+
+        Args:
+            keys: нормализованные телефоны и email (get_contact_keys)
+            lead_id: сделка, дубли которой ищутся (сама она в выдачу не попадает, ее контакты тоже учитываются)
+            limit: предельное количество дублей
+
+        Returns:
+            сделки в формате Amo (id - идентификатор в Amo), начиная с самой поздней
+        """
+        query = text(f"""
+            WITH keys AS (
+                SELECT unnest(CAST(:keys AS text[])) AS value
+                UNION
+                SELECT ck.value
+                FROM {self.schema}."LeadContact" lc
+                JOIN {self.schema}."ContactKey" ck ON ck.contact_id = lc.contact_id
+                WHERE lc.lead_id = :lead_id
             )
-            user = connection.execute(stmt).fetchone()
-        if not user:
-            return None
-        return user
+            SELECT l.*
+            FROM {self.schema}."Lead" l
+            WHERE
+                l.id_on_source IN (
+                    SELECT lc.lead_id
+                    FROM keys k
+                    JOIN {self.schema}."ContactKey" ck ON ck.value = k.value
+                    JOIN {self.schema}."LeadContact" lc ON lc.contact_id = ck.contact_id
+                )
+                AND l.id_on_source <> :lead_id
+                AND l.is_deleted IS NOT TRUE
+            ORDER BY l.created_at DESC
+            LIMIT :limit
+        """)
+        with self.engine.begin() as connection:
+            result = connection.execute(query, {'keys': list(keys or []), 'lead_id': int(lead_id or 0), 'limit': limit})
+            leads = [dict(row) for row in result.mappings()]
+        for lead in leads:
+            lead['id'] = lead.pop('id_on_source')
+        return leads
+
+    def find_contacts_by_keys(self, keys: List[str]) -> Dict[str, Dict]:
+        """ Поиск контактов по локальному индексу (телефоны / email контактов)
+
+        Args:
+            keys: нормализованные телефоны и email (get_phone_key, get_email_key)
+
+        Returns:
+            {ключ: контакт}, для ключа, найденного у нескольких контактов, - самый поздний контакт
+            (id - идентификатор в Amo)
+        """
+        if not keys:
+            return {}
+        query = text(f"""
+            SELECT DISTINCT ON (ck.value) ck.value AS key, c.id_on_source AS id, c.created_at
+            FROM {self.schema}."ContactKey" ck
+            JOIN {self.schema}."Contact" c ON c.id_on_source = ck.contact_id
+            WHERE ck.value = ANY(CAST(:keys AS text[])) AND c.is_deleted IS NOT TRUE
+            ORDER BY ck.value, c.created_at DESC
+        """)
+        with self.engine.begin() as connection:
+            result = connection.execute(query, {'keys': list(set(keys))})
+            return {row['key']: {'id': row['id'], 'created_at': row['created_at']} for row in result.mappings()}
 
     def get_data_borders(self) -> Tuple[Optional[int], Optional[int]]:
         lowest_df = None
@@ -813,7 +1108,7 @@ class DataProcessor:
         return date_from, date_to, date_curr.strftime("%Y-%m-%dT%H:%M")
 
     def __get_data_borders(self, table_name: str, field: str = 'updated_at') -> Tuple[Optional[int], Optional[int]]:
-        table = Table(table_name, MetaData(), autoload_with=self.engine, schema=self.schema)
+        table = get_table(table_name, schema=self.schema, engine=self.engine)
         with self.engine.begin() as connection:
             min_stmt = select(func.min(table.c[field]))
             max_stmt = select(func.max(table.c[field]))
@@ -822,7 +1117,7 @@ class DataProcessor:
             return min_value, max_value
 
     def __get_by(self, table_name: str, by_list: List[By]) -> List[Dict]:
-        table = Table(table_name, MetaData(), autoload_with=self.engine, schema=self.schema)
+        table = get_table(table_name, schema=self.schema, engine=self.engine)
         with self.engine.begin() as connection:
             conditions = [table.c[by.Field] == by.Value for by in by_list]
             stmt = select(table).where(reduce(and_, conditions))
@@ -912,14 +1207,6 @@ class DataProcessor:
                 earliest_ts = current_ts
         lead['created_at_offset'] = 1 if not earliest_ts or earliest_ts - created_at < -3600 * 1 else ''
 
-    @staticmethod
-    def __get_stage_if_reached(stages_priority, status):
-        """ Достигнута ли стадия? """
-        for stage in stages_priority:
-            if status in stage.IncludeStages:
-                return stage
-        return None
-
     @staticmethod
     def __process_countries_by_phone_codes(collection: List[Dict]):
         country_codes = get_country_codes()
@@ -954,14 +1241,22 @@ class SMDataProcessor(DataProcessor):
     lead_models = [LeadSM]
     time_shift: int = 3
     utm_rules_book_id = GoogleSheets.UtmRulesSM.value
+    sort_lines = True
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
         self.log = DBLogger(log_model=SMLog, branch='sm')
 
-    def _build_lead_data(self, lead: Dict, pre_data: Dict, schedule: Optional[Dict] = None):
+    def _build_lead_data(
+        self,
+        lead: Dict,
+        pre_data: Dict,
+        schedule: Optional[Dict] = None,
+        bulk: bool = False,
+        utm: Optional[Dict] = None
+    ):
         # строим словарь с дефолтными значениями полей лида
-        line = self._build_lead_base_data(lead=lead, pre_data=pre_data)
+        line = self._build_lead_base_data(lead=lead, pre_data=pre_data, bulk=bulk, utm=utm)
         # заполняем доп. поля лида
         self._process_custom_fields(line=line, lead=lead, pre_data=pre_data)
         # костыль для дополнительных воронок
@@ -970,14 +1265,40 @@ class SMDataProcessor(DataProcessor):
         # self._process_first_reaction_time(line=line, lead=lead, schedule=schedule)
         # кастинг дат
         self._cast_dates(line=line, pre_data=pre_data)
-        # маркеры скорости прохождения лида по воронке
-        self._freeze_stages(line=line)
-        # особая скорость для Италии
-        self._freeze_stages_italy(line=line)
-        # прокидываем цены по этапам
-        self._process_prices(line=line, lead=lead)
+        # в пакетном режиме этапы, цены и сортировка - по всему пакету (см. _build_lines_bulk)
+        if not bulk:
+            # маркеры скорости прохождения лида по воронке
+            self._freeze_stages(line=line)
+            # особая скорость для Италии
+            self._freeze_stages_italy(line=line)
+            # прокидываем цены по этапам
+            self._process_prices(line=line, lead=lead)
+            # продажа, включая в клинике и выписан из клиники
+            self._process_purchase_extended(line=line)
+        else:
+            self._seed_prices(line=line)
+        # телефоны
+        line[self.lead.Phone.Key] = self.get_lead_phones(lead)
+        if bulk:
+            return line
+        # сортировка по ключам
+        sorted_line = self._sort_dict(line)
+        return sorted_line
+
+    def _process_stages_bulk(self, frame: StageFrame, prices: List):
+        super()._process_stages_bulk(frame=frame, prices=prices)
         # продажа, включая в клинике и выписан из клиники
-        stage_instance = self.lead.Stage()
+        stage_instance = self.lead.get_schema().stage
+        extended_key, extended_price = self.lead.PurchaseExtended.Key, self.lead.PurchaseExtendedPrice.Key
+        frame[extended_key] = frame[stage_instance.Purchase.Key]
+        frame[extended_price] = frame[stage_instance.Purchase.Price]
+        for stage in (stage_instance.Audit, stage_instance.Treatment):
+            empty = ~frame[extended_key].astype(bool).to_numpy()
+            frame.set_where(extended_key, empty, frame[stage.Key].to_numpy())
+            frame.set_where(extended_price, empty, frame[stage.Price].to_numpy())
+
+    def _process_purchase_extended(self, line: Dict):
+        stage_instance = self.lead.get_schema().stage
         line[self.lead.PurchaseExtended.Key] = line[stage_instance.Purchase.Key]
         line[self.lead.PurchaseExtendedPrice.Key] = line[stage_instance.Purchase.Price]
         if not line[self.lead.PurchaseExtended.Key]:
@@ -986,11 +1307,6 @@ class SMDataProcessor(DataProcessor):
         if not line[self.lead.PurchaseExtended.Key]:
             line[self.lead.PurchaseExtended.Key] = line[stage_instance.Treatment.Key]
             line[self.lead.PurchaseExtendedPrice.Key] = line[stage_instance.Treatment.Price]
-        # телефоны
-        line[self.lead.Phone.Key] = self.get_lead_phones(lead)
-        # сортировка по ключам
-        sorted_line = self._sort_dict(line)
-        return sorted_line
 
     def _freeze_stages(self, line: Dict):
         if not self._is_lead(line[self.lead.LossReason.Key]):
@@ -1027,6 +1343,28 @@ class SMDataProcessor(DataProcessor):
             period = (line[self.lead.DateOfOffer.Key] - created_at).days
             line[self.lead.OfferSent21Days.Key] = 1 if period <= 21 else ''
 
+    def _freeze_stages_bulk(self, frame: StageFrame):
+        is_lead = self._is_lead_bulk(frame=frame)
+        created_at = self.lead.CreatedAt.Key
+        reached, days = frame.days_after(self.lead.ClosedAt.Key, created_at)
+        frame.set_where(self.lead.Duration30Days.Key, is_lead & reached, days // 30 + 1)
+        for date_key, key, limit in (
+            (self.lead.DateOfPriorConsent.Key, self.lead.PriorConsent28Days.Key, 28),
+            (self.lead.DateOfQuestionnaireRecieved.Key, self.lead.QuestionnaireRecieved7Days.Key, 7),
+            (self.lead.DateOfOffer.Key, self.lead.OfferSent14Days.Key, 14),
+        ):
+            reached, days = frame.days_after(date_key, created_at)
+            frame.set_where(key, is_lead & reached, blank_where(1, days <= limit))
+        # особая скорость для Италии
+        is_italy = frame[self.lead.PipelineName.Key].isin(('Italy', 'Italian')).to_numpy()
+        for date_key, key, limit in (
+            (self.lead.DateOfPriorConsent.Key, self.lead.PriorConsent35Days.Key, 35),
+            (self.lead.DateOfQuestionnaireRecieved.Key, self.lead.QuestionnaireRecieved14Days.Key, 14),
+            (self.lead.DateOfOffer.Key, self.lead.OfferSent21Days.Key, 21),
+        ):
+            reached, days = frame.days_after(date_key, created_at)
+            frame.set_where(key, is_italy & is_lead & reached, blank_where(1, days <= limit))
+
     def _process_custom_fields(self, line: Dict, lead: Dict, pre_data: Dict):
         # кастомные поля
         custom_fields = lead.get('custom_fields_values') or []
@@ -1080,17 +1418,16 @@ class SMDataProcessor(DataProcessor):
         # очистка названий стран
         self._clear_country(line=line)
         # utm из доп. полей
-        keys = self.lead.Utm.get_keys()
+        keys = self.lead.get_schema().utm_keys
         for field in custom_fields:
             name = field['field_name'].lower()
             if name in keys:
                 line[name] = field['values'][0]['value']
         # только для лидов (не сырых!)
         for lead_model in self.lead_models:
-            # приоритеты стадий воронки
-            stages_priority = lead_model.get_stages_priority()
-            stage_instance = lead_model.Stage()
-            if not line[stage_instance.Lead.Key]:
+            # стадии воронки, определяемые доп. полями
+            schema = lead_model.get_schema()
+            if not line[schema.stage.Lead.Key]:
                 continue
             # определяем достигнутые этапы сделки по доп. полям
             for field in custom_fields:
@@ -1103,9 +1440,7 @@ class SMDataProcessor(DataProcessor):
                     value = 1 if value else ''
                 else:
                     value = 1 if value else ''
-                for stage in stages_priority:
-                    if name not in stage.IncludeFields and name.lower() not in stage.IncludeFields:
-                        continue
+                for stage in schema.stages_by_field(name):
                     line[stage.Key] = value
 
     # def _process_pipelines(self, line: Dict, lead: Dict, pre_data: Dict):
@@ -1166,19 +1501,30 @@ class CDVDataProcessor(DataProcessor):
         super().__init__(*args, **kwargs)
         self.log = DBLogger(log_model=CDVLog, branch='cdv')
 
-    def _build_lead_data(self, lead: Dict, pre_data: Dict, schedule: Optional[Dict] = None):
+    def _build_lead_data(
+        self,
+        lead: Dict,
+        pre_data: Dict,
+        schedule: Optional[Dict] = None,
+        bulk: bool = False,
+        utm: Optional[Dict] = None
+    ):
         # строим словарь с дефолтными значениями полей лида
-        line = self._build_lead_base_data(lead=lead, pre_data=pre_data)
+        line = self._build_lead_base_data(lead=lead, pre_data=pre_data, bulk=bulk, utm=utm)
         # заполняем доп. поля лида
         self._process_custom_fields(line=line, lead=lead, pre_data=pre_data)
         # костыль для дополнительных воронок
         self._process_pipelines(line=line, lead=lead, pre_data=pre_data)
         # кастинг дат
         self._cast_dates(line=line, pre_data=pre_data)
-        # маркеры скорости прохождения лида по воронке
-        self._freeze_stages(line=line)
-        # прокидываем цены по этапам
-        self._process_prices(line=line, lead=lead)
+        # в пакетном режиме этапы и цены - по всему пакету (см. _build_lines_bulk)
+        if not bulk:
+            # маркеры скорости прохождения лида по воронке
+            self._freeze_stages(line=line)
+            # прокидываем цены по этапам
+            self._process_prices(line=line, lead=lead)
+        else:
+            self._seed_prices(line=line)
         # телефоны
         line[self.lead.Phone.Key] = self.get_lead_phones(lead)
         # сортировка по ключам
@@ -1196,6 +1542,15 @@ class CDVDataProcessor(DataProcessor):
             period = (line[self.lead.DateOfPriorConsent.Key] - created_at).days
             line[self.lead.PriorConsent14Days.Key] = 1 if period <= 14 else ''
 
+    def _freeze_stages_bulk(self, frame: StageFrame):
+        is_lead = self._is_lead_bulk(frame=frame)
+        created_at = self.lead.CreatedAt.Key
+        reached, days = frame.days_after(self.lead.DateOfAdmission.Key, created_at)
+        frame.set_where(self.lead.Admission7Days.Key, is_lead & reached, days // 7 + 1)
+        frame.set_where(self.lead.Admission14Days.Key, is_lead & reached, blank_where(1, days <= 14))
+        reached, days = frame.days_after(self.lead.DateOfPriorConsent.Key, created_at)
+        frame.set_where(self.lead.PriorConsent14Days.Key, is_lead & reached, blank_where(1, days <= 14))
+
     def _process_custom_fields(self, line: Dict, lead: Dict, pre_data: Dict):
         # кастомные поля
         custom_fields = lead.get('custom_fields_values') or []
@@ -1245,23 +1600,19 @@ class CDVDataProcessor(DataProcessor):
         for lead_model in self.lead_models:
             if line['pipeline_name'] not in lead_model.Pipelines:
                 continue
-            # приоритеты стадий воронки
-            stages_priority = lead_model.get_stages_priority()
-            stage_instance = lead_model.Stage()
-            if not line[stage_instance.Lead.Key]:
+            # стадии воронки, определяемые доп. полями
+            schema = lead_model.get_schema()
+            if not line[schema.stage.Lead.Key]:
                 continue
             # определяем достигнутые этапы сделки по доп. полям
             for field in custom_fields:
                 name = field['field_name']
                 # значение по умолчанию для всех None - ''
                 value = 1 if field['values'][0]['value'] else ''
-                for stage in stages_priority:
-                    if name not in stage.IncludeFields and name.lower() not in stage.IncludeFields:
-                        continue
+                for stage in schema.stages_by_field(name):
                     line[stage.Key] = value
-                    lead_model_instance = lead_model()
                     if value == 1:
-                        line[lead_model_instance.ReachedStage.Key] = stage.DisplayName
+                        line[schema.instance.ReachedStage.Key] = stage.DisplayName
 
     # def _process_pipelines(self, line: Dict, lead: Dict, pre_data: Dict):
     #     for lead_model in self.lead_models:
@@ -0,0 +1,94 @@
+""" Кэш справочников Amo (воронки со статусами, пользователи) по филиалам
+
+Notes:
+    Справочники читаются из БД один раз на ttl секунд и общие для всех экземпляров процессора, поэтому создание
+        процессора в обработчиках webhook не стоит запросов к БД, а названия воронки, статуса и ответственного
+        ищутся по словарям. Задача синхронизации сбрасывает кэш филиала, если в Amo изменились воронки
+        или пользователи (invalidate_references)
+"""
+__author__ = 'ke.mizonov'
+import threading
+from dataclasses import dataclass
+from time import monotonic
+from typing import Any, Dict, Optional
+from sqlalchemy import select
+from sqlalchemy.engine import Engine
+from app.engine import get_engine
+from app.metadata import get_table
+from config import Config
+
+
+@dataclass
+class References:
+    """ Справочники филиала """
+    # id_on_source -> {'name': ..., 'statuses': {id: name}}
+    pipelines: Dict[int, Dict]
+    # id_on_source -> пользователь (словарь)
+    users: Dict[int, Dict]
+    # id_on_source -> пользователь (строка таблицы, поля доступны как атрибуты)
+    user_rows: Dict[int, Any]
+    loaded_at: float
+
+
+# схема БД -> справочники
+references: Dict[str, References] = {}
+lock = threading.Lock()
+
+
+def get_references(schema: str, engine: Optional[Engine] = None, ttl: Optional[float] = None) -> References:
+    """ Справочники филиала из кэша (устаревшие - перечитываются из БД)
+
+    Args:
+        schema: схема БД (sm, cdv)
+        engine: соединение с БД, по умолчанию - общее соединение приложения
+        ttl: время жизни справочников, сек. (по умолчанию - из конфига)
+
+    Returns:
+        справочники
+    """
+    ttl = Config().reference_cache['ttl'] if ttl is None else ttl
+    cached = references.get(schema)
+    if cached is not None and monotonic() - cached.loaded_at < ttl:
+        return cached
+    with lock:
+        # пока ждали блокировку, справочники мог перечитать другой поток
+        cached = references.get(schema)
+        if cached is None or monotonic() - cached.loaded_at >= ttl:
+            cached = references[schema] = __load(schema=schema, engine=engine or get_engine())
+    return cached
+
+
+def invalidate_references(schema: Optional[str] = None):
+    """ Сбрасывает кэш справочников
+
+    Args:
+        schema: схема БД, если не задана - сбрасываются справочники всех филиалов
+    """
+    with lock:
+        if schema:
+            references.pop(schema, None)
+        else:
+            references.clear()
+
+
+def __load(schema: str, engine: Engine) -> References:
+    pipeline_table = get_table('Pipeline', schema=schema, engine=engine)
+    user_table = get_table('User', schema=schema, engine=engine)
+    with engine.begin() as connection:
+        pipelines = connection.execute(select(pipeline_table)).fetchall()
+        users = connection.execute(select(user_table)).fetchall()
+    return References(
+        pipelines={
+            pipeline.id_on_source: {
+                'name': pipeline.name,
+                'statuses': {
+                    status['id']: status['name']
+                    for status in (pipeline._embedded or {}).get('statuses') or []
+                }
+            }
+            for pipeline in pipelines
+        },
+        users={user.id_on_source: user._asdict() for user in users},
+        user_rows={user.id_on_source: user for user in users},
+        loaded_at=monotonic()
+    )
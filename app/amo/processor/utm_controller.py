@@ -1,4 +1,5 @@
-from typing import Dict, List
+from collections import Counter
+from typing import Dict, List, Optional, Tuple, Union
 
 UTM_MAP = {
     'utm_source': 'final_utm_source',
@@ -42,6 +43,12 @@ UTM_MAP = {
     # 'loc_physical_ms': 'final_',
     # 'extensionid': 'final_',
 }
+TAG = 'tag'
+OPERATOR_EQUAL = '='
+OPERATOR_CONTAINS = '*'
+OPERATOR_NOT_EQUAL = '!='
+# предельное количество запомненных результатов (по уникальным сочетаниям меток и тегов лида)
+UTM_RESULTS_CACHE_SIZE = 10000
 
 
 def process_rule_terms(terms: Dict, tags: List, utm_dict: Dict) -> bool:
@@ -103,15 +110,177 @@ def process_rule_terms(terms: Dict, tags: List, utm_dict: Dict) -> bool:
     return flag
 
 
-def build_final_utm(lead: Dict, rules: List[Dict]):
-    """ Постобработка UTM и тегов
+class UtmTerm:
+    """ Условие правила: тег или метка, оператор и значение """
+    __slots__ = ('key', 'field', 'operator', 'value')
+
+    def __init__(self, key: str, value: str):
+        """
+        Args:
+            key: tag, либо название метки (utm_source, ...)
+            value: значение из онлайн-таблицы (*значение - вхождение, !=значение - неравенство)
+        """
+        value = value.lower()
+        self.key = key
+        self.field = f'final_{key}'
+        if '*' in value:
+            self.operator, self.value = OPERATOR_CONTAINS, value.replace('*', '').strip()
+        elif '!=' in value:
+            self.operator, self.value = OPERATOR_NOT_EQUAL, value.replace('!=', '').strip()
+        else:
+            self.operator, self.value = OPERATOR_EQUAL, value
+
+    def check(self, tags: List[str], utm_dict: Dict) -> bool:
+        if self.key == TAG:
+            if self.operator == OPERATOR_CONTAINS:
+                return any(self.value in tag for tag in tags)
+            if self.operator == OPERATOR_NOT_EQUAL:
+                return any(self.value != tag for tag in tags)
+            return self.value in tags
+        utm_value = (utm_dict.get(self.field) or '').lower()
+        if self.operator == OPERATOR_CONTAINS:
+            return self.value in utm_value
+        if self.operator == OPERATOR_NOT_EQUAL:
+            return utm_value != self.value
+        return utm_value == self.value
+
+
+class UtmRule:
+    """ Правило обработки меток и тегов """
+    __slots__ = ('num', 'terms', 'result_field', 'result_value')
+
+    def __init__(self, rule: Dict, num: int):
+        """
+        Args:
+            rule: строка онлайн-таблицы с правилами
+            num: порядковый номер правила
+        """
+        # условия с одинаковыми ключами перекрывают друг друга (последнее побеждает)
+        terms = {}
+        for n in range(1, 99):
+            term = f'term_{n}'
+            if term not in rule:
+                break
+            key = rule.get(term)
+            if not key:
+                continue
+            terms[key] = rule.get(f'value_{n}') or ''
+        self.num = rule.get('num') or num
+        self.terms: Tuple[UtmTerm, ...] = tuple(UtmTerm(key=key, value=value) for key, value in terms.items())
+        self.result_field = rule.get('result_field')
+        self.result_value = rule.get('result_value')
+
+    def matches(self, tags: List[str], utm_dict: Dict) -> bool:
+        """ Выполнены все условия правила (правило без условий не срабатывает) """
+        return bool(self.terms) and all(term.check(tags=tags, utm_dict=utm_dict) for term in self.terms)
+
+
+class UtmRules:
+    """ Скомпилированные правила обработки меток и тегов
+
+    Notes:
+        Правила применяются последовательно, и последующие видят метки, измененные предыдущими. Поэтому индекс
+            строится только по условиям равенства на теги и метки, которые не перезаписывает ни одно правило:
+            для каждого правила выбирается самое избирательное такое условие, и для лида проверяются лишь правила,
+            у которых это условие выполнено, а также правила без индексируемых условий (в исходном порядке)
+    """
+
+    def __init__(self, rules: List[Dict]):
+        """
+        Args:
+            rules: данные онлайн-таблицы с правилами обработки меток и тегов
+        """
+        self.rules: List[UtmRule] = [UtmRule(rule=rule, num=num) for num, rule in enumerate(rules or [], 1)]
+        # метки, которые могут быть перезаписаны правилами
+        written = {rule.result_field for rule in self.rules if rule.result_field} | {'rule_num'}
+        indexable = [
+            [
+                term for term in rule.terms
+                if term.operator == OPERATOR_EQUAL and (term.key == TAG or term.key not in written)
+            ]
+            for rule in self.rules
+        ]
+        counts = Counter((term.key, term.value) for terms in indexable for term in terms)
+        self.__unindexed: List[int] = []
+        # (тег / метка, значение) -> номера правил
+        self.__index: Dict[Tuple[str, str], List[int]] = {}
+        for position, terms in enumerate(indexable):
+            if not terms:
+                self.__unindexed.append(position)
+                continue
+            term = min(terms, key=lambda x: counts[(x.key, x.value)])
+            self.__index.setdefault((term.key, term.value), []).append(position)
+        self.__index_keys = {key for key, _ in self.__index}
+        # результаты по уникальным сочетаниям тегов и меток лида
+        self.__results: Dict[Tuple, Dict] = {}
+
+    def __len__(self) -> int:
+        return len(self.rules)
+
+    def candidates(self, tags: List[str], utm_dict: Dict) -> List[UtmRule]:
+        """ Правила, которые могут сработать для лида (в исходном порядке) """
+        positions = set(self.__unindexed)
+        for key in self.__index_keys:
+            if key == TAG:
+                for tag in tags:
+                    positions.update(self.__index.get((TAG, tag), ()))
+            else:
+                positions.update(self.__index.get((key, (utm_dict.get(f'final_{key}') or '').lower()), ()))
+        return [self.rules[position] for position in sorted(positions)]
+
+    def apply(self, utm_dict: Dict, tags: List[str]) -> Dict:
+        """ Применяет правила к меткам и тегам лида
+
+        Args:
+            utm_dict: метки лида (см. parse_lead_utm)
+            tags: теги лида в нижнем регистре
+
+        Returns:
+            метки с учетом правил
+        """
+        signature = (tuple(tags), tuple(utm_dict.items()))
+        result = self.__results.get(signature)
+        if result is not None:
+            return dict(result)
+        for rule in self.candidates(tags=tags, utm_dict=utm_dict):
+            if not rule.matches(tags=tags, utm_dict=utm_dict):
+                continue
+            # результат ссылается на другую имеющуюся метку
+            result_value = utm_dict[f'final_{rule.result_value}'] \
+                if f'final_{rule.result_value}' in utm_dict else rule.result_value
+            if rule.result_field and result_value and f'final_{rule.result_field}' in utm_dict:
+                utm_dict[f'final_{rule.result_field}'] = result_value
+                if 'final_rule_num' not in utm_dict:
+                    utm_dict['final_rule_num'] = rule.num
+                else:
+                    utm_dict['final_rule_num'] = f"{utm_dict['final_rule_num']}, {rule.num}"
+        if len(self.__results) >= UTM_RESULTS_CACHE_SIZE:
+            self.__results.clear()
+        self.__results[signature] = dict(utm_dict)
+        return utm_dict
+
+
+def compile_utm_rules(rules: Optional[List[Dict]]) -> UtmRules:
+    """ Компилирует правила обработки меток и тегов (один раз на построение данных, см. DataProcessor._pre_build)
 
     Args:
-        lead: словарь лида
         rules: данные онлайн-таблицы с правилами обработки меток и тегов
+
+    Returns:
+        скомпилированные правила
+    """
+    return UtmRules(rules=rules or [])
+
+
+def parse_lead_utm(lead: Dict) -> Tuple[Dict, List[str]]:
+    """ Метки (из доп. полей и реферера) и теги лида
+
+    Args:
+        lead: словарь лида
+
+    Returns:
+        (метки, теги в нижнем регистре)
     """
-    if not rules:
-        return {}
     utm_dict = {x: '' for x in UTM_MAP.values()}
     utm_dict['final_utm_channel'] = ''
     for field in lead.get('custom_fields_values') or []:
@@ -148,33 +317,43 @@ def build_final_utm(lead: Dict, rules: List[Dict]):
             continue
         utm_dict[lead_utm_key] = utm_value
     utm_dict['final_base_url'] = utm_dict['final_utm_referer'].split('?')[0] if utm_dict['final_utm_referer'] else ''
-    # постобработка меток и тегов по правилам, описанным в онлайн-таблице
     tags = [
         (tag_data.get('name') or '').lower()
         for tag_data in (lead.get('_embedded') or {}).get('tags') or []
     ]
-    for num, rule in enumerate(rules, 1):
-        terms = {}
-        for n in range(1, 99):
-            term = f'term_{n}'
-            if term not in rule:
-                break
-            key = rule.get(term)
-            if not key:
-                continue
-            terms[key] = (rule.get(f'value_{n}') or '').lower()
-        if not process_rule_terms(terms=terms, tags=tags, utm_dict=utm_dict):
-            continue
-        result_field = rule.get('result_field')
-        result_value = rule.get('result_value')
-        # результат ссылается на другую имеющуюся метку
-        result_value = utm_dict[f'final_{result_value}'] if f'final_{result_value}' in utm_dict else result_value
-        # print(result_field, result_value)
-        if result_field and result_value and f'final_{result_field}' in utm_dict:
-            utm_dict[f'final_{result_field}'] = result_value
-            # print(f"rule {num} applied for lead {lead['id']}")
-            if 'final_rule_num' not in utm_dict:
-                utm_dict['final_rule_num'] = rule.get('num') or num
-            else:
-                utm_dict['final_rule_num'] = f"{utm_dict['final_rule_num']}, {rule.get('num') or num}"
-    return utm_dict
+    return utm_dict, tags
+
+
+def build_final_utm(lead: Dict, rules: Union[UtmRules, List[Dict]]) -> Dict:
+    """ Постобработка UTM и тегов
+
+    Args:
+        lead: словарь лида
+        rules: скомпилированные правила (см. compile_utm_rules), либо данные онлайн-таблицы с правилами
+    """
+    if not rules:
+        return {}
+    if not isinstance(rules, UtmRules):
+        rules = compile_utm_rules(rules)
+    utm_dict, tags = parse_lead_utm(lead=lead)
+    # постобработка меток и тегов по правилам, описанным в онлайн-таблице
+    return rules.apply(utm_dict=utm_dict, tags=tags)
+
+
+def build_final_utm_bulk(leads: List[Dict], rules: Union[UtmRules, List[Dict]]) -> List[Dict]:
+    """ Постобработка UTM и тегов для пакета лидов
+
+    Правила компилируются один раз на пакет, а лиды с одинаковыми метками и тегами обрабатываются один раз
+
+    Args:
+        leads: словари лидов
+        rules: скомпилированные правила (см. compile_utm_rules), либо данные онлайн-таблицы с правилами
+
+    Returns:
+        метки с учетом правил (в порядке лидов)
+    """
+    if not rules:
+        return [{} for _ in leads]
+    if not isinstance(rules, UtmRules):
+        rules = compile_utm_rules(rules)
+    return [build_final_utm(lead=lead, rules=rules) for lead in leads]
@@ -4,6 +4,7 @@ import click
 from flask.cli import with_appcontext
 from config import Config
 from .extensions import db
+from .metadata import invalidate_tables
 from .models.amo_credentials import CDVAmoCredentials, SMAmoCredentials
 from .models.amo_token import SMAmoToken, CDVAmoToken
 from .models.contact import SMContact, CDVContact
@@ -19,6 +20,9 @@ from .models.log import SMLog, CDVLog
 from .models.autocall import SMAutocallNumber, CDVAutocallNumber
 from .models.chat import SMChat, CDVChat
 from .models.raw_lead_data import SMRawLeadData, CDVRawLeadData
+from .models.sync_state import SMSyncState, CDVSyncState
+from .models.webhook import SMWebhook
+from .models.duplicate_index import SMContactKey, CDVContactKey, SMLeadContact, CDVLeadContact
 
 
 @click.command(name='create_tables')
@@ -26,3 +30,45 @@ from .models.raw_lead_data import SMRawLeadData, CDVRawLeadData
 def create_tables():
     """ Создание всех таблиц БД """
     db.create_all()
+    # create_all не добавляет индексы в уже существующие таблицы
+    for model in (SMEvent, CDVEvent):
+        for index in model.__table__.indexes:
+            index.create(bind=db.engine, checkfirst=True)
+    # структура БД могла измениться - отраженные таблицы перечитаем при следующем обращении
+    invalidate_tables()
+
+
+@click.command(name='build_duplicate_index')
+@with_appcontext
+def build_duplicate_index():
+    """ Построение индекса поиска дублей по уже сохраненным контактам и сделкам """
+    from .amo.api.sync_controller import SMSyncController, CDVSyncController
+    for controller in (SMSyncController, CDVSyncController):
+        controller().rebuild_duplicate_index()
+
+
+@click.command(name='check_bulk_parity')
+@click.option('--branch', default='sm', help='филиал (sm, cdv)')
+@click.option('--sample', default=200, help='количество лидов в выборке')
+@with_appcontext
+def check_bulk_parity(branch: str, sample: int):
+    """ Сверка построчного и пакетного построения строк сводной таблицы на выборке лидов """
+    from .main.processors import DATA_PROCESSOR
+    mismatches = DATA_PROCESSOR.get(branch)().check_bulk_parity(sample=sample)
+    for lead_id, description in mismatches:
+        click.echo(f'{lead_id} :: {description}')
+    click.echo(f'{len(mismatches)} mismatches')
+
+
+@click.command(name='import_legacy_data')
+@with_appcontext
+def import_legacy_data():
+    """ Перенос прежних pickle-файлов сделок, примечаний и событий в сегментные хранилища и их сжатие """
+    from .amo.data.base.store import ENTITY_INDEX_KEYS, get_store
+    for sub_domain in ('swissmedica', 'drvorobjev', 'cdvinner'):
+        stores = [get_store(f'{sub_domain}_leads')]
+        for name in ('leads_notes', 'contacts_notes', 'leads_events'):
+            stores.append(get_store(f'{sub_domain}_{name}', index_keys=ENTITY_INDEX_KEYS))
+        for store in stores:
+            store.compact()
+            click.echo(f'{store.name}: {len(store)} records')
@@ -0,0 +1,92 @@
+""" Кэш справочных данных из Google Sheets (правила UTM, менеджеры и проч.)
+
+Notes:
+    Данные листа живут ttl секунд. Устаревшие данные отдаются сразу, а лист перечитывается в фоне
+        (stale-while-revalidate), так что обработка вебхуков не ждет ответа Google.
+        Синхронно лист читается только при первом обращении, либо при явном обновлении
+"""
+__author__ = 'ke.mizonov'
+import threading
+from time import monotonic
+from typing import Dict, List, Optional, Tuple
+from app.google_api.client import GoogleAPIClient
+from config import Config
+
+# (книга, лист) -> (данные листа, время чтения)
+sheets: Dict[Tuple[str, str], Tuple[List[Dict], float]] = {}
+# листы, которые перечитываются в данный момент
+refreshing = set()
+lock = threading.Lock()
+
+
+def get_reference_sheet(book_id: str, sheet_title: str, ttl: Optional[float] = None) -> List[Dict]:
+    """ Данные справочного листа из кэша
+
+    Args:
+        book_id: идентификатор книги
+        sheet_title: название листа
+        ttl: время жизни данных, сек. (по умолчанию - из конфига)
+
+    Returns:
+        данные листа в виде списка словарей
+    """
+    key = (book_id, sheet_title)
+    ttl = Config().google_sheets_cache['ttl'] if ttl is None else ttl
+    with lock:
+        cached = sheets.get(key)
+        is_stale = cached is not None and monotonic() - cached[1] >= ttl
+        start_refresh = is_stale and key not in refreshing
+        if start_refresh:
+            refreshing.add(key)
+    if cached is None:
+        return refresh_reference_sheet(book_id=book_id, sheet_title=sheet_title)
+    if start_refresh:
+        threading.Thread(target=__refresh_in_background, args=(book_id, sheet_title), daemon=True).start()
+    return cached[0]
+
+
+def refresh_reference_sheet(book_id: str, sheet_title: str) -> List[Dict]:
+    """ Перечитывает справочный лист и обновляет кэш
+
+    Args:
+        book_id: идентификатор книги
+        sheet_title: название листа
+
+    Returns:
+        данные листа в виде списка словарей
+    """
+    key = (book_id, sheet_title)
+    data = GoogleAPIClient(book_id=book_id, sheet_title=sheet_title).get_sheet()
+    with lock:
+        cached = sheets.get(key)
+        # get_sheet при ошибке возвращает пустой список - прежние данные в этом случае не затираем
+        if not data and cached and cached[0]:
+            data = cached[0]
+        sheets[key] = (data, monotonic())
+    return data
+
+
+def invalidate_reference_sheets(book_id: Optional[str] = None, sheet_title: Optional[str] = None):
+    """ Сбрасывает кэш справочных листов
+
+    Args:
+        book_id: идентификатор книги, если не задан - сбрасываются листы всех книг
+        sheet_title: название листа, если не задано - сбрасываются все листы книги
+    """
+    with lock:
+        for key in list(sheets.keys()):
+            if book_id and key[0] != book_id:
+                continue
+            if sheet_title and key[1] != sheet_title:
+                continue
+            sheets.pop(key, None)
+
+
+def __refresh_in_background(book_id: str, sheet_title: str):
+    try:
+        refresh_reference_sheet(book_id=book_id, sheet_title=sheet_title)
+    except Exception as exc:
+        print(f'google sheet {book_id} / {sheet_title} refresh error: {exc}')
+    finally:
+        with lock:
+            refreshing.discard((book_id, sheet_title))
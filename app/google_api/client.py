@@ -12,9 +12,10 @@ References:
 """
 __author__ = 'ke.mizonov'
 import decimal
+import threading
 from datetime import datetime, timedelta
 from time import sleep
-from typing import Dict, List, Optional, Union
+from typing import Dict, Iterable, List, Optional, Tuple, Union
 from googleapiclient.discovery import build, Resource
 from google.oauth2 import service_account
 from googleapiclient.errors import HttpError
@@ -24,6 +25,10 @@ from app.google_api.constants import SCOPES
 from app.google_api.errors import SpreadSheetNotFoundError
 
 DATE_FORMAT = '%d.%m.%Y'
+# учетные данные сервисного аккаунта и объекты сервиса (по одному на поток)
+credentials = None
+services = threading.local()
+lock = threading.Lock()
 WEEKDAYS = {
     0: 'пн',
     1: 'вт',
@@ -242,6 +247,26 @@ class GoogleAPIClient:
         except HttpError as e:
             print(f"An error occurred: {e}")
 
+    def write_values_to_cells(self, cells: List[Tuple[int, int, str]]):
+        """ Записать значения в несколько ячеек таблицы одним запросом
+
+        Args:
+            cells: список (номер строки, номер колонки, значение) - нумерация как в write_value_to_cell
+        """
+        if not cells:
+            return
+        body = {
+            "valueInputOption": "RAW",
+            "data": [
+                {"range": f"{self.__sheet_title}!{chr(ord('A') + col)}{row + 1}", "values": [[value]]}
+                for row, col, value in cells
+            ]
+        }
+        try:
+            self.sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=self.__book_id, body=body).execute()
+        except HttpError as e:
+            print(f"An error occurred: {e}")
+
     def update_arrival_schedule(self, source_sheet_title: str):
         """ Обновление расписания клиник
 
@@ -317,6 +342,9 @@ class GoogleAPIClient:
     ):
         """ Синхронизация данных на листе
 
+        Обновления, добавления и удаления вычисляются за один проход по листу и применяются пакетно:
+            обновляемые и добавляемые строки - одним values.batchUpdate, удаляемые - одним batchUpdate
+
         Args:
             collection: данные в виде списка словарей
             unique_key: поле, значение которого считается уникальным (для перезаписи)
@@ -331,93 +359,77 @@ class GoogleAPIClient:
         self.paint_cells(sheet_id=sheet_id, red=0.8)
         # уже имеющиеся на листе данные
         rows = self.get_sheet()
-        # готовим словари обновляемых / существующих данных {unique_value: collection_item}
+        # готовим словари обновляемых данных {unique_value: collection_item} и индекс строк листа {unique_value: номер}
         collection_dict = {str(item.get(unique_key)): item for item in collection if item.get(unique_key)}
-        rows_dict = {str(item.get(unique_key)): item for item in rows if item.get(unique_key)}
-        # обновляемые записи, а также удаляемые записи (будут перемещены в архив)
-        updating = []
+        row_numbers = {}
+        for num, row_item in enumerate(rows, 1):
+            if row_item.get(unique_key):
+                row_numbers.setdefault(str(row_item.get(unique_key)), num)
+        # за один проход по листу: обновляемые записи {номер строки: запись}, а также удаляемые записи
+        #   (будут перемещены в архив) и номера их строк
+        updating = {}
         removing = []
+        removing_rows = []
         exclude_keys = [unique_key]
         if has_dates:
             exclude_keys.extend(['created_at', 'updated_at'])
-        for row_item in rows:
+        now = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+        for num, row_item in enumerate(rows, 1):
             unique_value = row_item.get(unique_key)
             if not unique_value:
                 continue
             collection_item = collection_dict.get(str(unique_value))
-            if collection_item:
-                # действительно ли запись нуждается в обновлении?
-                #   будут сравниваться все ключи коллекции, поэтому подразумевается, что
-                #   created_at, updated_at и сторонних полей в коллекции нет
-                need_update = False
-                for key, new_value in collection_item.items():
-                    if key in exclude_keys:
-                        continue
-                    if str(new_value) != str(row_item.get(key) or ''):
-                        need_update = True
-                        break
-                if need_update:
-                    if has_dates:
-                        with_dates = {
-                            'created_at': row_item.get('created_at'),
-                            'updated_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                        }
-                        with_dates.update(collection_item)
-                    else:
-                        with_dates = collection_item
-                    updating.append(with_dates)
-            else:
+            if not collection_item:
                 removing.append(row_item)
+                # первая строка листа - заголовки
+                removing_rows.append(num + 1)
+                continue
+            # действительно ли запись нуждается в обновлении?
+            #   будут сравниваться все ключи коллекции, поэтому подразумевается, что
+            #   created_at, updated_at и сторонних полей в коллекции нет
+            need_update = any(
+                str(new_value) != str(row_item.get(key) or '')
+                for key, new_value in collection_item.items()
+                if key not in exclude_keys
+            )
+            if not need_update:
+                continue
+            if has_dates:
+                with_dates = {'created_at': row_item.get('created_at'), 'updated_at': now}
+                with_dates.update(collection_item)
+            else:
+                with_dates = collection_item
+            updating[num] = with_dates
         # добавляемые записи
         adding = []
         for collection_item in collection:
             unique_value = collection_item.get(unique_key)
-            if not unique_value:
-                continue
-            row_item = rows_dict.get(str(unique_value))
-            if row_item:
+            if not unique_value or str(unique_value) in row_numbers:
                 continue
             if has_dates:
-                with_dates = {
-                    'created_at': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
-                    'updated_at': ''
-                }
+                with_dates = {'created_at': now, 'updated_at': ''}
                 with_dates.update(collection_item)
             else:
                 with_dates = collection_item
             adding.append(with_dates)
-
-        # записываем обновляемые данные
-        for item in updating:
-            unique_value = str(item.get(unique_key))
-            start_row = None
-            for num, row in enumerate(rows, 1):
-                if str(row.get(unique_key)) == unique_value:
-                    start_row = num
-                    break
-            if not start_row:
-                continue
-            self.__write(collection=[item], start_row=start_row, pause=.5)
-        # записываем добавляемые данные
+        # добавляем строки в конец листа (условие - должна существовать пустая последняя строка!)
         next_row = len(rows) + 1
-        # добавляем строки (условие - должна существовать пустая последняя строка!)
-        self.__add_rows(sheet_id=sheet_id, next_row=next_row, length=len(adding))
-        self.__write(collection=adding, start_row=next_row)
+        if adding:
+            self.__add_rows(sheet_id=sheet_id, next_row=next_row, length=len(adding))
+        # обновляемые и добавляемые данные записываем одним запросом (соседние строки - одним диапазоном)
+        ranges = [(first_row, [updating[num] for num in range(first_row, last_row + 1)])
+                  for first_row, last_row in self.__group_rows(updating.keys())]
+        if adding:
+            ranges.append((next_row, adding))
+        self.__write_ranges(ranges=ranges)
         # перемещаем удаляемые строки в архив
-        if archive_sheet:
+        if archive_sheet and removing:
             GoogleAPIClient(
                 book_id=self.__book_id,
                 sheet_title=archive_sheet
             ).write_data_to_sheet(data=removing)
-        # удаляем удаляемые строки
-        for item in removing:
-            unique_value = str(item.get(unique_key))
-            for row_num, row in enumerate(rows, 2):
-                if unique_value != str(row.get(unique_key)):
-                    continue
-                self.delete_row(sheet_id=sheet_id, row=row_num)
-                rows.remove(row)
-                break
+        # удаляем удаляемые строки (добавленные строки находятся ниже и на номера удаляемых не влияют)
+        self.__delete_rows(sheet_id=sheet_id, row_numbers=removing_rows)
         # красим A1 в белый в знак того, что обновление завершено
         self.paint_cells(sheet_id=sheet_id, red=1, green=1, blue=1)
 
@@ -535,6 +547,75 @@ class GoogleAPIClient:
                 return sheet['properties']['sheetId']
         raise SpreadSheetNotFoundError(f'Лист "{sheet_title}" не найден в онлайн-таблице')
 
+    def __write_ranges(self, ranges: List[Tuple[int, List[Dict]]]):
+        """ Запись нескольких диапазонов данных на лист одним запросом
+
+        Args:
+            ranges: список (с какой строки начинать запись, данные в виде списка словарей)
+        """
+        if not ranges:
+            return
+        body = {
+            "valueInputOption": "USER_ENTERED",
+            "data": [
+                {
+                    "range": f"{self.__sheet_title}!{self.__start_col}{start_row + 1}",
+                    "majorDimension": "ROWS",
+                    "values": self.__listdict_to_listlist(collection=collection)
+                }
+                for start_row, collection in ranges
+            ]
+        }
+        self.sheets_service.spreadsheets().values().batchUpdate(spreadsheetId=self.__book_id, body=body).execute()
+
+    def __delete_rows(self, sheet_id: str, row_numbers: Iterable[int]):
+        """ Удаляет строки одним запросом
+
+        Соседние строки удаляются одним диапазоном, диапазоны - снизу вверх, чтобы удаление одного диапазона
+            не сдвигало номера строк следующих
+
+        Args:
+            sheet_id: идентификатор листа
+            row_numbers: номера удаляемых строк
+        """
+        groups = self.__group_rows(row_numbers)
+        if not groups:
+            return
+        request = {
+            "requests": [
+                {
+                    "deleteDimension": {
+                        "range": {
+                            "sheetId": sheet_id,
+                            "dimension": "ROWS",
+                            "startIndex": first_row - 1,  # 0-indexed
+                            "endIndex": last_row
+                        }
+                    }
+                }
+                for first_row, last_row in reversed(groups)
+            ]
+        }
+        self.sheets_service.spreadsheets().batchUpdate(spreadsheetId=self.__book_id, body=request).execute()
+
+    @staticmethod
+    def __group_rows(row_numbers: Iterable[int]) -> List[Tuple[int, int]]:
+        """ Группирует номера строк в непрерывные диапазоны
+
+        Args:
+            row_numbers: номера строк
+
+        Returns:
+            список (первая строка, последняя строка) по возрастанию
+        """
+        groups = []
+        for num in sorted(set(row_numbers)):
+            if groups and groups[-1][1] == num - 1:
+                groups[-1] = (groups[-1][0], num)
+            else:
+                groups.append((num, num))
+        return groups
+
     def __write(self, collection: List[Dict], start_row: int, pause: float = .0):
         """ Запись данных на лист
 
@@ -561,14 +642,24 @@ class GoogleAPIClient:
     def __auth() -> Resource:
         """ Авторизация (через сервисный аккаунт)
 
+        Учетные данные создаются один раз на процесс (токен доступа переиспользуется, пока не истечет),
+            объект сервиса - один раз на поток: httplib2, на котором он построен, не потокобезопасен
+
         Returns:
             объект для обращения к гуглу по API
         """
-        creds = service_account.Credentials.from_service_account_info(
-            Config().google_credentials,
-            scopes=SCOPES
-        )
-        return build('sheets', 'v4', credentials=creds)
+        global credentials
+        service = getattr(services, 'sheets', None)
+        if service is not None:
+            return service
+        with lock:
+            if credentials is None:
+                credentials = service_account.Credentials.from_service_account_info(
+                    Config().google_credentials,
+                    scopes=SCOPES
+                )
+        service = services.sheets = build('sheets', 'v4', credentials=credentials, cache_discovery=False)
+        return service
 
     @staticmethod
     def __listdict_to_listlist(collection: List[Dict]) -> List[List]:
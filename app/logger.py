@@ -1,11 +1,35 @@
-""" Ведение логов в БД """
-__author__ = 'ke.mizonov'
+""" Ведение логов в БД
 
+Notes:
+    Записи лога не пишутся в БД по одной: DBLogger.add складывает их в буфер, а фоновый поток записывает буфер
+        одним многострочным INSERT - раз в flush_interval секунд, либо сразу, как только в буфере набралось
+        flush_size записей. Сообщения для клиента (Socket.IO) отправляются тем же потоком одним событием
+        на пакет. Старые записи удаляются периодически (по диапазону id), а не при каждой вставке
+"""
+__author__ = 'ke.mizonov'
+import atexit
+import threading
+import time
 from datetime import datetime
-from typing import Optional, List
-from sqlalchemy import Table, MetaData, select
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import insert, select
 from app import db, socketio
 from app.engine import get_engine
+from app.metadata import get_table
+from config import Config
+
+TEXT_LENGTH = 1000
+
+# модель лога -> записи, ожидающие записи в БД
+buffers: Dict[db.Model, List[Dict]] = {}
+# сообщения для клиента, ожидающие отправки
+messages: List[str] = []
+# модели, для которых выполняется удаление старых записей
+log_models = set()
+lock = threading.Lock()
+# будит фоновый поток, когда буфер заполнен
+wake = threading.Event()
+flusher = {'thread': None}
 
 
 class DBLogger:
@@ -16,17 +40,91 @@ class DBLogger:
         self.engine = get_engine()
 
     def add(self, text: str, log_type: int = 1, created_at: Optional[int] = None):
-        self.log.add(branch=self.branch, text=text, log_type=log_type, created_at=created_at)
-        # отправка данных клиенту
+        record = {
+            'branch': self.branch,
+            'text': text[:TEXT_LENGTH],
+            'type': log_type,
+            'created_at': created_at or int(time.time())
+        }
+        # сообщение для клиента отправится вместе с пакетом записей
+        message = None
         if log_type == 1:
             curr = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-            socketio.emit('new_event', {'msg': f'{curr} :: {self.branch} :: {text[:1000]}'})
+            message = f'{curr} :: {self.branch} :: {text[:TEXT_LENGTH]}'
+        _put(log_model=self.log, record=record, message=message)
 
     def get(self, log_type: int = 1, limit: int = 100) -> List[db.Model]:
-        table = Table('Log', MetaData(), autoload_with=self.engine, schema=self.branch)
+        # записи, еще не попавшие в БД, тоже должны быть в выдаче
+        flush_logs()
+        table = get_table('Log', schema=self.branch, engine=self.engine)
         with self.engine.begin() as connection:
             stmt = select(table)\
                 .where(table.c['type'] == log_type, table.c['branch'] == self.branch)\
                 .order_by(table.c.id.desc())\
                 .limit(limit=limit)
             return connection.execute(stmt).fetchall()
+
+
+def flush_logs():
+    """ Записывает накопленные записи лога в БД (по одному INSERT на таблицу) и отправляет сообщения клиенту """
+    with lock:
+        pending: List[Tuple[db.Model, List[Dict]]] = [(model, records) for model, records in buffers.items() if records]
+        for model, _ in pending:
+            buffers[model] = []
+        batch = messages[:]
+        messages.clear()
+    if pending:
+        engine = get_engine()
+        for model, records in pending:
+            try:
+                with engine.begin() as connection:
+                    connection.execute(insert(model.__table__), records)
+            except Exception as exc:
+                print(f'{model.__tablename__} flush error ({len(records)} records): {exc}')
+    if batch:
+        socketio.emit('new_events', {'msgs': batch})
+
+
+def remove_old_logs():
+    """ Удаляет из таблиц лога записи сверх предельного количества """
+    limit = Config().db_log['limit']
+    for model in list(log_models):
+        try:
+            model.remove_old(limit=limit, engine=get_engine())
+        except Exception as exc:
+            print(f'{model.__tablename__} retention error: {exc}')
+
+
+def _put(log_model: db.Model, record: Dict, message: Optional[str]):
+    config = Config().db_log
+    with lock:
+        buffer = buffers.setdefault(log_model, [])
+        buffer.append(record)
+        log_models.add(log_model)
+        if message:
+            messages.append(message)
+        is_full = len(buffer) >= config['flush_size']
+        if flusher['thread'] is None:
+            flusher['thread'] = threading.Thread(target=_flush_in_background, daemon=True)
+            flusher['thread'].start()
+    if is_full:
+        wake.set()
+
+
+def _flush_in_background():
+    last_retention = time.monotonic()
+    while True:
+        config = Config().db_log
+        wake.wait(timeout=config['flush_interval'])
+        wake.clear()
+        try:
+            flush_logs()
+        except Exception as exc:
+            print(f'log flush error: {exc}')
+        if time.monotonic() - last_retention >= config['retention_interval']:
+            last_retention = time.monotonic()
+            remove_old_logs()
+
+
+# при остановке процесса дописываем буфер
+atexit.register(flush_logs)
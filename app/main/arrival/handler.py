@@ -35,11 +35,14 @@ def waiting_for_arrival(app: Flask, branch: str):
             ) or {}
             # получаем лиды из Amo
             leads = amo_client.get_leads_by_pipeline_and_status(pipeline_id=pipeline_id, status_id=status_id)
-            for lead in leads:
-                _embedded = lead.get('_embedded') or {}
-                # получаем контакт из Amo
-                contacts = _embedded.get('contacts')
-                contact = amo_client.get_contact_by_id(contact_id=contacts[0]['id']) if contacts else {}
+            # получаем основные контакты сделок из Amo (пакетом)
+            contact_ids = [
+                ((lead.get('_embedded') or {}).get('contacts') or [{}])[0].get('id')
+                for lead in leads
+            ]
+            contacts = amo_client.get_contacts_by_ids(contact_ids)
+            for lead, contact_id in zip(leads, contact_ids):
+                contact = contacts.get(contact_id) or {}
                 email_and_phone = '; '.join([
                     cf['values'][0]['value']
                     for cf in contact.get('custom_fields_values') or []
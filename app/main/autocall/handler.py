@@ -323,6 +323,12 @@ class Autocall:
         branch_config = self.__sipuni_branch_config
         sipuni_client = Sipuni(sipuni_config=branch_config)
         numbers_added = []
+        # сделки номеров, которые могут попасть в автообзвон, запрашиваем из Amo пакетом
+        lead_ids = {
+            line.lead_id for line in all_numbers
+            if line.calls == 0 or line.last_call_timestamp + 23 * 3600 <= time.time()
+        }
+        leads = amo_client.get_leads_by_ids(lead_ids) if lead_ids else {}
         for line in all_numbers:
             db.session.add(line)
             db.session.refresh(line)
@@ -343,19 +349,21 @@ class Autocall:
             if not schedule:
                 continue
             # лид все еще находится в воронке автообзвона
-            lead = amo_client.get_lead_by_id(lead_id=line.lead_id)
+            if line.lead_id in lead_ids:
+                # сделки нет в ответе Amo - она удалена
+                lead = leads.get(line.lead_id) or {}
+            else:
+                lead = amo_client.get_lead_by_id(lead_id=line.lead_id)
             pipeline_id, status_id = lead.get('pipeline_id'), lead.get('status_id')
             if not pipeline_id or not status_id:
                 db.session.delete(line)
                 db.session.commit()
-                time.sleep(0.25)
                 continue
             if autocall_config.get('pipeline_id') != str(pipeline_id) \
                     or autocall_config.get('status_id') != str(status_id):
                 # лид был перемещен, удаляем номер из БД автообзвона
                 db.session.delete(line)
                 db.session.commit()
-                time.sleep(0.25)
                 continue
             # сегодня день, подходящий под расписание
             curr_dt = datetime.now()
@@ -412,10 +420,7 @@ class Autocall:
         Returns:
             идентификатор автообзвона в Sipuni
         """
-        for autocall_id, data in (self.__sipuni_branch_config.get('autocall') or {}).items():
-            if str(data.get('pipeline_id')) == pipeline_id and str(data.get('status_id')) == status_id:
-                return int(autocall_id)
-        return None
+        return (Config().sipuni_autocall_id.get(self.__branch) or {}).get((str(pipeline_id), str(status_id)))
 
     def __get_autocall_number_entity(self, number: str):
         """ Перебирает таблицы БД в поисках экземпляра номера автодозвона
@@ -6,7 +6,9 @@ from datetime import datetime
 from typing import Dict, Optional, List
 import telebot
 from flask import Flask
+from app.amo.processor.functions import get_email_key, get_phone_key
 from app.google_api.client import GoogleAPIClient
+from app.main.leads_insurance.spam_filter import get_spam_rules
 from config import Config
 from modules.utils.utils.functions import clear_phone
 
@@ -43,30 +45,41 @@ class LeadsInsurance:
 
     def is_spam(self, line):
         """ Из лида делаем line: {'phone': ..., 'email': ..., 'msg': ...} """
-        spam_rules = self.__build_spam_rules()
-        return self.__is_spam(rules=spam_rules, line=line)
+        return get_spam_rules(book_id=self.__book_id).is_spam(line=line)
 
     def __start(self, amo_client):
+        from app.main.leads_insurance.constants import DATA_PROCESSOR
         leads_google_client = GoogleAPIClient(book_id=self.__book_id, sheet_title='Leads')
         collection = leads_google_client.get_sheet()
-        spam_rules = self.__build_spam_rules()
-        saved_leads = []
+        spam_rules = get_spam_rules(book_id=self.__book_id)
+        # строки без статуса и ключи их контактов (телефон, email)
+        lines = []
         for row, line in enumerate(collection, 1):
             if line.get('status'):
                 continue
             phone, email = clear_phone(line.get('phone') or ''), line.get('email')
-            contact = None
-            if phone and len(phone) >= 9:
+            phone = phone if phone and len(phone) >= 9 else None
+            email = email if email and '@' in email and len(email) > 4 else None
+            lines.append((row, line, phone, email))
+        # контакты ищем сначала одним запросом в локальной БД, в Amo - только ненайденные
+        #   (локальные данные отстают от Amo на интервал синхронизации)
+        keys = [key for _, _, phone, email in lines for key in (get_phone_key(phone), get_email_key(email)) if key]
+        local_contacts = DATA_PROCESSOR.get(self.__branch)().find_contacts_by_keys(keys=keys) if keys else {}
+        saved_leads = []
+        cells = []
+        for row, line, phone, email in lines:
+            contact = local_contacts.get(get_phone_key(phone)) or local_contacts.get(get_email_key(email))
+            if not contact and phone:
                 contacts = amo_client.find_contacts(query=phone[-8:], field_code='PHONE', limit=1) or [{}]
                 contact = contacts[0]
-            if not contact and email and '@' in email and len(email) > 4:
+            if not contact and email:
                 contacts = amo_client.find_contacts(query=email, field_code='EMAIL', limit=1) or [{}]
                 contact = contacts[0]
             if not contact:
                 status = 'contact not found'
-                is_spam = self.__is_spam(rules=spam_rules, line=line)
+                is_spam = spam_rules.is_spam(line=line)
                 # делаем пометку о спаме в таблице
-                leads_google_client.write_value_to_cell(row=row, col=7, value='1' if is_spam else '0')
+                cells.append((row, 7, '1' if is_spam else '0'))
                 if not is_spam:
                     # отправляем оповещение в Telegram
                     saved_leads.append(line)
@@ -75,8 +88,9 @@ class LeadsInsurance:
                 contact_date = datetime.fromtimestamp(int(contact.get('created_at'))).date()
                 line_date = datetime.strptime(line.get('date'), "%Y-%m-%d %H:%M:%S").date()
                 status = 'new contact found' if contact_date == line_date else 'old contact found'
-            leads_google_client.write_value_to_cell(row=row, col=6, value=status)
-            time.sleep(0.3)
+            cells.append((row, 6, status))
+        # статусы записываем в таблицу одним запросом
+        leads_google_client.write_values_to_cells(cells=cells)
         # отправляем оповещение в Telegram
         self.__send_telegram_notification(saved_leads=saved_leads)
         # удаляем старые записи о лидах
@@ -84,25 +98,6 @@ class LeadsInsurance:
             rows_number = len(collection) - self.leads_storage_limit
             leads_google_client.delete_row(row=2, rows_number=rows_number+1)
 
-    def __build_spam_rules(self) -> Dict:
-        """ Строит словарь с правилами спама
-
-        Returns:
-            Списки спамовых телефонов, адресов почты и фрагментов сообщений {'phone': [], 'email': [], 'msg': []}
-        """
-        spam_google_client = GoogleAPIClient(book_id=self.__book_id, sheet_title='_spam_filter')
-        spam_rules = {'phone': [], 'email': [], 'msg': []}
-        for line in spam_google_client.get_sheet() or []:
-            if line.get('dont_use') and line.get('dont_use') == 1:
-                continue
-            if line.get('phone'):
-                spam_rules['phone'].append(clear_phone(line['phone']))
-            if line.get('email'):
-                spam_rules['email'].append(line['email'].lower().strip())
-            if line.get('msg'):
-                spam_rules['msg'].append(line['msg'].lower().strip())
-        return spam_rules
-
     def __send_telegram_notification(self, saved_leads: List[Dict]):
         """ Отправляет оповещение в телеграм
 
@@ -134,30 +129,3 @@ class LeadsInsurance:
             telegram_bot_token = Config().sm_telegram_bot_token
             telebot.TeleBot(telegram_bot_token).send_message(self.__channel_id, message)
             time.sleep(2)
-
-    @staticmethod
-    def __is_spam(rules: Dict, line: Dict) -> bool:
-        """ Проверяет, является ли заявка спамом
-
-        Args:
-            rules: списки спамовых номеров, адресов и фрагментов сообщений
-            line: строка данных, подлежащая проверке на спам
-
-        Returns:
-            True - заявка является спамом, иначе Flase
-        """
-        is_spam = False
-        if line.get('phone'):
-            phone = clear_phone(line['phone'])
-            is_spam = phone in rules['phone']
-        if not is_spam and line.get('email'):
-            is_spam = line['email'].lower().strip() in rules['email']
-        if not is_spam:
-            msg = line.get('msg')
-            if not msg:
-                return False
-            msg = msg.lower()
-            for _spam_msg in rules['msg']:
-                if _spam_msg in msg:
-                    return True
-        return is_spam
@@ -0,0 +1,144 @@
+""" Спам-фильтр заявок (лист _spam_filter книги подстраховки лидов)
+
+Notes:
+    Правила компилируются один раз на версию листа: телефоны и адреса почты - в множества, фрагменты сообщений -
+        в автомат Ахо-Корасик, который находит любой из фрагментов за один проход по тексту сообщения,
+        вместо поиска каждого фрагмента по отдельности
+"""
+__author__ = 'ke.mizonov'
+import threading
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Tuple
+from app.google_api.cache import get_reference_sheet
+from modules.utils.utils.functions import clear_phone
+
+SPAM_SHEET_TITLE = '_spam_filter'
+
+
+class PatternMatcher:
+    """ Поиск любого из множества фрагментов в тексте за один проход (алгоритм Ахо-Корасик) """
+
+    def __init__(self, patterns: Iterable[str]):
+        """
+        Args:
+            patterns: фрагменты (пустые игнорируются)
+        """
+        # переходы по символам, ссылки на наибольший собственный суффикс, признак "здесь заканчивается фрагмент"
+        self.__goto: List[Dict[str, int]] = [{}]
+        self.__fail: List[int] = [0]
+        self.__is_final: List[bool] = [False]
+        for pattern in patterns:
+            if pattern:
+                self.__add(pattern)
+        self.__build()
+
+    def __bool__(self) -> bool:
+        return len(self.__goto) > 1
+
+    def search(self, text: str) -> bool:
+        """ Содержит ли текст хотя бы один из фрагментов
+
+        Args:
+            text: текст
+
+        Returns:
+            True - найден хотя бы один фрагмент
+        """
+        state = 0
+        for char in text:
+            while state and char not in self.__goto[state]:
+                state = self.__fail[state]
+            state = self.__goto[state].get(char, 0)
+            if self.__is_final[state]:
+                return True
+        return False
+
+    def __add(self, pattern: str):
+        state = 0
+        for char in pattern:
+            next_state = self.__goto[state].get(char)
+            if next_state is None:
+                next_state = self.__goto[state][char] = len(self.__goto)
+                self.__goto.append({})
+                self.__fail.append(0)
+                self.__is_final.append(False)
+            state = next_state
+        self.__is_final[state] = True
+
+    def __build(self):
+        """ Строит суффиксные ссылки (обход в ширину: ссылки ведут на более короткие префиксы) """
+        queue = deque(self.__goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.__goto[state].items():
+                queue.append(next_state)
+                fail = self.__fail[state]
+                while fail and char not in self.__goto[fail]:
+                    fail = self.__fail[fail]
+                self.__fail[next_state] = self.__goto[fail].get(char, 0)
+                # фрагмент, являющийся суффиксом найденного префикса, тоже считается найденным
+                self.__is_final[next_state] = self.__is_final[next_state] or self.__is_final[self.__fail[next_state]]
+
+
+class SpamRules:
+    """ Скомпилированные правила спам-фильтра """
+
+    def __init__(self, rules: List[Dict]):
+        """
+        Args:
+            rules: данные листа _spam_filter (колонки phone, email, msg, dont_use)
+        """
+        self.phones = set()
+        self.emails = set()
+        messages = []
+        for line in rules or []:
+            if line.get('dont_use') and line.get('dont_use') == 1:
+                continue
+            if line.get('phone'):
+                self.phones.add(clear_phone(line['phone']))
+            if line.get('email'):
+                self.emails.add(line['email'].lower().strip())
+            if line.get('msg'):
+                messages.append(line['msg'].lower().strip())
+        self.messages = PatternMatcher(messages)
+
+    def is_spam(self, line: Dict) -> bool:
+        """ Проверяет, является ли заявка спамом
+
+        Args:
+            line: строка данных, подлежащая проверке на спам {'phone': ..., 'email': ..., 'msg': ...}
+
+        Returns:
+            True - заявка является спамом, иначе False
+        """
+        if line.get('phone') and clear_phone(line['phone']) in self.phones:
+            return True
+        if line.get('email') and line['email'].lower().strip() in self.emails:
+            return True
+        msg = line.get('msg')
+        return bool(msg) and self.messages.search(msg.lower())
+
+
+# книга -> (данные листа, скомпилированные правила)
+compiled: Dict[str, Tuple[List[Dict], SpamRules]] = {}
+lock = threading.Lock()
+
+
+def get_spam_rules(book_id: str, ttl: Optional[float] = None) -> SpamRules:
+    """ Скомпилированные правила спам-фильтра книги (перекомпилируются, когда обновился кэш листа)
+
+    Args:
+        book_id: идентификатор книги подстраховки лидов
+        ttl: время жизни данных листа, сек. (по умолчанию - из конфига)
+
+    Returns:
+        правила спам-фильтра
+    """
+    rules = get_reference_sheet(book_id=book_id, sheet_title=SPAM_SHEET_TITLE, ttl=ttl)
+    cached = compiled.get(book_id)
+    if cached is not None and cached[0] is rules:
+        return cached[1]
+    spam_rules = SpamRules(rules=rules)
+    with lock:
+        compiled[book_id] = (rules, spam_rules)
+    return spam_rules
@@ -6,7 +6,9 @@ from flask import request, current_app, render_template, Response
 from app import socketio
 from app.main import bp
 from app.main.autocall.handler import Autocall, start_autocall_iteration
-from app.main.utils import get_data_from_external_api, DATA_PROCESSOR
+from app.main.routes.utils import get_data_from_post_request
+from app.main.utils import DATA_PROCESSOR
+from app.main.webhooks.handler import enqueue_webhook, get_amo_dedupe_key, register_webhook_handler
 from config import Config
 
 
@@ -52,15 +54,26 @@ def autocall_handler():
             'callId': '1688471056.154959'
         }
     """
-    return get_data_from_external_api(
-        request=request,
-        handler_func=Autocall().handle_autocall_result,
-    )
+    data = get_data_from_post_request(_request=request)
+    if not data:
+        return 'Unsupported Media Type', 415
+    call_id = data.get('callId') or data.get('call_id')
+    enqueue_webhook(handler='autocall_result', data=data, dedupe_key=f'autocall_result:{call_id}' if call_id else None)
+    return 'success', 200
 
 
 @bp.route('/autocall', methods=['POST'])
 def init_autocall():
-    return get_data_from_external_api(
-        request=request,
-        handler_func=Autocall().handle_lead_status_changed
+    data = get_data_from_post_request(_request=request)
+    if not data:
+        return 'Unsupported Media Type', 415
+    enqueue_webhook(
+        handler='autocall_lead_status',
+        data=data,
+        dedupe_key=get_amo_dedupe_key(handler='autocall_lead_status', data=data)
     )
+    return 'success', 200
+
+
+register_webhook_handler(name='autocall_result', func=lambda data: Autocall().handle_autocall_result(data))
+register_webhook_handler(name='autocall_lead_status', func=lambda data: Autocall().handle_lead_status_changed(data))
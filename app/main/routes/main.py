@@ -1,13 +1,17 @@
 """ Общие маршруты """
 __author__ = 'ke.mizonov'
+import gzip
+import json
 from datetime import datetime
 from typing import Union, Type, Dict, Optional
 from flask import render_template, current_app, redirect, url_for, request, Response, flash, jsonify
 from flask_login import login_required, logout_user, current_user, login_user
+from sqlalchemy import Text, cast, func, select
 from werkzeug.security import generate_password_hash, check_password_hash
 from app import db, socketio
 from app.amo.api.client import SwissmedicaAPIClient, DrvorobjevAPIClient
 from app.amo.processor.processor import GoogleSheets, SMDataProcessor
+from app.engine import get_engine
 from app.google_api.client import GoogleAPIClient
 from app.main import bp
 from app.main.arrival.handler import waiting_for_arrival
@@ -18,14 +22,15 @@ from app.main.processors import DATA_PROCESSOR
 from app.main.routes.utils import get_data_from_post_request, get_args_from_url, add_if_not_exists, \
     create_view_excluding_columns
 from app.main.utils import DateTimeEncoder
+from app.main.webhooks.handler import enqueue_webhook, get_amo_dedupe_key, register_webhook_handler
 from app.models.app_user import SMAppUser
 from app.models.chat import SMChat, CDVChat
 from app.models.data import SMData, CDVData
 from app.models.raw_lead_data import SMRawLeadData, CDVRawLeadData
-from app.tawk.controller import TawkController
+from app.tawk.controller import TawkController, get_transcript_metrics
 from app.utils.country_by_ip import get_country_by_ip
 from app.whatsapp.controller import WhatsAppController
-from config import Config
+from config import Config, reload_config
 from modules.utils.utils.functions import clear_phone
 
 
@@ -61,6 +66,9 @@ DATA_MODEL = {
     'cdv': CDVData
 }
 
+# предельное количество дублей, отображаемых на странице поиска дублей
+FIND_DUPLICATES_LIMIT = 50
+
 
 @bp.route('/')
 @requires_roles('admin', 'superadmin')
@@ -356,43 +364,64 @@ def send_auth_code():
 
 
 def data_to_excel(branch: str):
-    model = DATA_MODEL.get(branch)
-    portion_size = 1000
-    offset = 0
+    """ Выгрузка данных сводной таблицы клиенту через сокет
+
+    Записи читаются порциями по первичному ключу (keyset), поле data берется из БД как текст JSON
+        и уходит клиенту без разбора и повторной сериализации - JSON-массивом, сжатым gzip
+
+    Args:
+        branch: ветка (sm, cdv)
+    """
+    table = DATA_MODEL.get(branch).__table__
+    portion_size = 5000
+    engine = get_engine()
+    with engine.connect() as connection:
+        total = connection.execute(select(func.count()).select_from(table)).scalar() or 0
     socketio.emit('pivot_data', {
         'start': True,
-        'data': [],
+        'data': None,
         'headers': None,
         'done': False,
-        'file_name': None
+        'file_name': None,
+        'sent': 0,
+        'total': total
     })
-    num = 0
     headers = []
+    last_id = 0
+    sent = 0
     while True:
-        collection = model.query.limit(portion_size).offset(offset).all()
-        if not collection:
+        stmt = select(table.c.id, cast(table.c.data, Text))\
+            .where(table.c.id > last_id)\
+            .order_by(table.c.id)\
+            .limit(portion_size)
+        with engine.connect() as connection:
+            rows = connection.execute(stmt).fetchall()
+        if not rows:
             break
+        last_id = rows[-1][0]
+        sent += len(rows)
+        lines = [line for _, line in rows if line]
+        if not lines:
+            continue
         if not headers:
-            headers = [x for x in collection[0].to_dict().get('data').keys()]
-        data = [
-            x.to_dict().get('data')
-            for x in collection
-        ]
-        num += 1
+            headers = list(json.loads(lines[0]).keys())
         socketio.emit('pivot_data', {
             'start': False,
-            'data': data,
+            'data': gzip.compress(f'[{",".join(lines)}]'.encode('utf-8')),
             'headers': headers,
             'done': False,
-            'file_name': None
+            'file_name': None,
+            'sent': sent,
+            'total': total
         })
-        offset += portion_size
     socketio.emit('pivot_data', {
         'start': False,
-        'data': [],
+        'data': None,
         'headers': headers,
         'done': True,
-        'file_name': f'data_{branch}'
+        'file_name': f'data_{branch}',
+        'sent': sent,
+        'total': total
     })
     return Response(status=204)
 
@@ -409,13 +438,24 @@ def data_to_excel_cdv():
 
 @bp.route('/new_raw_lead', methods=['POST'])
 def new_raw_lead():
-    """ В Amo пришел новый лид, его данные необходимо записать в RawLeadData """
+    """ В Amo пришел новый лид, его данные необходимо записать в RawLeadData (запись - в очереди webhook) """
     data = get_data_from_post_request(_request=request)
     if not data:
         return 'Unsupported Media Type', 415
     lead_id = data.get('leads[add][0][id]')
     if not lead_id:
         return Response(status=204)
+    enqueue_webhook(handler='new_raw_lead', data=data, dedupe_key=get_amo_dedupe_key(handler='new_raw_lead', data=data))
+    return Response(status=204)
+
+
+def save_raw_lead(data: Dict):
+    """ Записывает данные сделки и контакта в RawLeadData (выполняется в обработчике очереди webhook)
+
+    Args:
+        data: данные webhook Amo
+    """
+    lead_id = data.get('leads[add][0][id]')
     branch = data.get('account[subdomain]')
     # вытаскиваем данные сделки и контакта
     amo_client = API_CLIENT.get(branch)()
@@ -424,18 +464,18 @@ def new_raw_lead():
     contact = amo_client.get_contact_by_id(contact_id=contacts[0]['id']) if contacts else {}
     # добавляем запись в RawLeadData
     raw_lead_model: Type[Union[SMRawLeadData, CDVRawLeadData]] = RAW_LEAD.get(branch)
-    app = current_app._get_current_object()
-    with app.app_context():
-        raw_lead_model.add(
-            id_on_source=lead['id'],
-            created_at=lead['created_at'],
-            updated_at=lead['updated_at'],
-            data=DateTimeEncoder.encode({
-                'lead': lead,
-                'contact': contact
-            })
-        )
-    return Response(status=204)
+    raw_lead_model.add(
+        id_on_source=lead['id'],
+        created_at=lead['created_at'],
+        updated_at=lead['updated_at'],
+        data=DateTimeEncoder.encode({
+            'lead': lead,
+            'contact': contact
+        })
+    )
+
+
+register_webhook_handler(name='new_raw_lead', func=save_raw_lead)
 
 
 @bp.route('/amo_chat/<scope_id>', methods=['POST'])
@@ -465,7 +505,19 @@ def amo_chat(scope_id):
 
 @bp.route('/tawk', methods=['POST'])
 def tawk():
-    return TawkController().handle(request=request)
+    data = request.json or {}
+    enqueue_webhook(handler='tawk', data=data, dedupe_key=f"tawk:{data['chatId']}" if data.get('chatId') else None)
+    return Response(status=200)
+
+
+register_webhook_handler(name='tawk', func=lambda data: TawkController().handle(data=data))
+
+
+@bp.route('/tawk_metrics', methods=['GET'])
+@requires_roles('admin', 'superadmin')
+def tawk_metrics():
+    """ Метрики получения истории чатов Tawk (время от завершения чата до создания / обновления сделки) """
+    return jsonify(get_transcript_metrics())
 
 
 @bp.route('/register', methods=['GET', 'POST'])
@@ -493,6 +545,14 @@ def update_users_leads():
     return jsonify({'status': 'complete'})
 
 
+@bp.route('/reload_config', methods=['POST'])
+@requires_roles('superadmin')
+def reload_settings():
+    """ Применяет изменившиеся настройки (переменные окружения, .env) без перезапуска приложения """
+    reload_config()
+    return jsonify({'status': 'complete'})
+
+
 @bp.route('/login', methods=['GET', 'POST'])
 def login():
     if current_user.is_authenticated:
@@ -536,12 +596,22 @@ def process_lead_duplicates():
 
 @socketio.on('find_lead_duplicates')
 def handle_find_lead_duplicates(json):
-    lead_id = json['lead_id']
-    print('Received request to find duplicates for lead ID:', lead_id)
-    # Отправляем тестовые данные обратно на клиент
-    test_data = [{'id': 1, 'msg': 'Duplicate 1'}, {'id': 2, 'msg': 'Duplicate 2'}, {'id': 3, 'msg': 'Duplicate 3'}]
-    for item in test_data:
-        socketio.emit('duplicate_lead', item)
+    """ Дубли сделки по локальному индексу телефонов / email: каждый дубль отправляется клиенту отдельным событием """
+    lead_id = json.get('lead_id')
+    if not lead_id:
+        return
+    processor = DATA_PROCESSOR.get(json.get('branch') or 'sm')()
+    if not processor.has_duplicate_index():
+        # по неполному индексу дубли будут найдены не все
+        processor.log.add(text='duplicate index is not built yet, run "flask build_duplicate_index"')
+        return
+    for lead in processor.find_duplicated_leads(lead_id=int(lead_id), limit=FIND_DUPLICATES_LIMIT):
+        pipeline = processor.pipelines_dict.get(lead['pipeline_id']) or {}
+        status = (pipeline.get('statuses') or {}).get(lead['status_id']) or ''
+        socketio.emit('duplicate_lead', {
+            'id': lead['id'],
+            'msg': f"{lead['name']} :: {pipeline.get('name') or ''} :: {status}"
+        }, to=request.sid)
 
 
 @bp.route('/create_all')
@@ -1,6 +1,7 @@
 """ Маршруты для работы веб-сокетов """
 __author__ = 'ke.mizonov'
 from datetime import datetime
+from flask import request
 from app import socketio
 from app.main.processors import DATA_PROCESSOR
 
@@ -14,6 +15,9 @@ def pre_load_from_socket():
         processor = processor_entity()
         logs.extend(processor.log.get() or [])
     logs = sorted([log for log in logs], key=lambda x: x.created_at)
-    for log in logs:
-        dt = datetime.fromtimestamp(log.created_at).strftime("%Y-%m-%d %H:%M:%S")
-        socketio.emit('new_event', {'msg': f"{dt} :: {log.branch} :: {log.text[:1000]}"})
+    msgs = [
+        f"{datetime.fromtimestamp(log.created_at).strftime('%Y-%m-%d %H:%M:%S')} :: {log.branch} :: {log.text[:1000]}"
+        for log in logs
+    ]
+    # история отправляется одним событием и только подключившемуся клиенту
+    socketio.emit('new_events', {'msgs': msgs}, to=request.sid)
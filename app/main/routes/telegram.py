@@ -2,18 +2,20 @@
 __author__ = 'ke.mizonov'
 
 import time
+from functools import partial
 from typing import Dict, Callable
 import telebot
 from flask import request, current_app, Response
 
 from app.amo.api.client import SwissmedicaAPIClient
 from app.amo.processor.processor import SMDataProcessor, GoogleSheets
-from app.google_api.client import GoogleAPIClient
+from app.google_api.cache import get_reference_sheet
 from app.main import bp
 from app.main.routes.utils import get_data_from_post_request
 from app.main.utils import handle_new_lead, handle_autocall_success, handle_get_in_touch, DATA_PROCESSOR, \
     handle_new_lead_slow_reaction, get_data_from_external_api, handle_new_interaction, DUP_TAG, \
     check_for_duplicated_leads
+from app.main.webhooks.handler import enqueue_webhook, get_amo_dedupe_key, register_webhook_handler
 from config import Config
 
 
@@ -24,14 +26,31 @@ BOTS = {
 }
 
 
-def reply_on_lead_event(_request, msg_builder: Callable):
+def reply_on_lead_event(_request, handler: str):
+    """ Ставит событие сделки Amo в очередь webhook и сразу отвечает (сообщение отправит notify_on_lead_event)
+
+    Args:
+        _request: запрос
+        handler: имя обработчика в очереди webhook
+    """
     data = get_data_from_post_request(_request=_request)
     if not data:
         return 'Unsupported Media Type', 415
+    enqueue_webhook(handler=handler, data=data, dedupe_key=get_amo_dedupe_key(handler=handler, data=data))
+    return 'Ok', 200
+
+
+def notify_on_lead_event(data: Dict, msg_builder: Callable):
+    """ Отправляет в Telegram сообщение о событии сделки (выполняется в обработчике очереди webhook)
+
+    Args:
+        data: данные webhook
+        msg_builder: функция, собирающая (ключ чата, идентификатор воронки, сообщение)
+    """
     chat_key, pipeline_id, message = msg_builder(data=data)
     if not message:
         # если сообщения нет, ничего не делаем
-        return 'Ok', 200
+        return
     config = Config()
     # в параметрах содержится идентификатор чата; вероятно, есть параметры конкретной воронки (по дефолту - филиала)
     branch = data.get('account[subdomain]') or data.get('branch')
@@ -42,10 +61,20 @@ def reply_on_lead_event(_request, msg_builder: Callable):
         params = config.new_lead_telegram.get(branch)
         bot_key = branch
     if not params:
-        return 'Bot not found', 404
+        print('reply_on_lead_event: bot not found', pipeline_id, branch)
+        return
     print('reply_on_lead_event', chat_key, params.get(chat_key))
     BOTS[bot_key].send_message(params.get(chat_key), message)
-    return 'Ok', 200
+
+
+for _handler, _msg_builder in (
+    ('new_lead', handle_new_lead),
+    ('new_lead_slow_reaction', handle_new_lead_slow_reaction),
+    ('new_interaction', handle_new_interaction),
+    ('autocall_success', handle_autocall_success),
+    ('get_in_touch', handle_get_in_touch),
+):
+    register_webhook_handler(name=_handler, func=partial(notify_on_lead_event, msg_builder=_msg_builder))
 
 
 def make_send_welcome_handler(tg_bot):
@@ -100,7 +129,7 @@ def set_telegram_webhooks():
 
 @bp.route('/new_lead', methods=['POST'])
 def new_lead():
-    return reply_on_lead_event(_request=request, msg_builder=handle_new_lead)
+    return reply_on_lead_event(_request=request, handler='new_lead')
 
 
 @bp.route('/new_lead_sm', methods=['POST'])
@@ -159,7 +188,7 @@ def new_lead_sm():
     )
     # тегаем пользователя через @
     telegram_name = None
-    managers = GoogleAPIClient(book_id=GoogleSheets.Managers.value, sheet_title='managers').get_sheet()
+    managers = get_reference_sheet(book_id=GoogleSheets.Managers.value, sheet_title='managers')
     for manager in managers:
         if manager.get('manager') == user.get('name'):
             telegram_name = manager.get('telegram')
@@ -250,7 +279,7 @@ def new_communication_sm():
         tags_str = f'{tags_str}'
     # тегаем пользователя через @
     telegram_name = None
-    managers = GoogleAPIClient(book_id=GoogleSheets.Managers.value, sheet_title='managers').get_sheet()
+    managers = get_reference_sheet(book_id=GoogleSheets.Managers.value, sheet_title='managers')
     for manager in managers:
         if manager.get('manager') == user.get('name'):
             telegram_name = manager.get('telegram')
@@ -316,22 +345,22 @@ def missed_call_sm():
 
 @bp.route('/new_lead_slow_reaction', methods=['POST'])
 def new_lead_slow_reaction():
-    return reply_on_lead_event(_request=request, msg_builder=handle_new_lead_slow_reaction)
+    return reply_on_lead_event(_request=request, handler='new_lead_slow_reaction')
 
 
 @bp.route('/new_interaction', methods=['POST'])
 def new_interaction():
-    return reply_on_lead_event(_request=request, msg_builder=handle_new_interaction)
+    return reply_on_lead_event(_request=request, handler='new_interaction')
 
 
 @bp.route('/autocall_success', methods=['POST'])
 def autocall_success():
-    return reply_on_lead_event(_request=request, msg_builder=handle_autocall_success)
+    return reply_on_lead_event(_request=request, handler='autocall_success')
 
 
 @bp.route('/get_in_touch', methods=['POST'])
 def get_in_touch():
-    return reply_on_lead_event(_request=request, msg_builder=handle_get_in_touch)
+    return reply_on_lead_event(_request=request, handler='get_in_touch')
 
 
 @bp.route('/<bot_token>', methods=['POST'])
@@ -399,4 +428,4 @@ def handle_missed_call_result(data: Dict):
             None,
             f"Missed call: {data['src_num']}"
         )
-    reply_on_lead_event(_request=request, msg_builder=missed_call_msg_builder)
+    notify_on_lead_event(data=data, msg_builder=missed_call_msg_builder)
@@ -11,7 +11,7 @@ from flask import request, jsonify, current_app
 
 from app.amo.api.chat_client import AmoChatsAPIClient
 from app.amo.processor.functions import clear_phone
-from app.google_api.client import GoogleAPIClient
+from app.google_api.cache import get_reference_sheet
 from app.main import bp
 from app.main.routes.telegram import BOTS
 from app.main.routes.utils import get_data_from_post_request
@@ -53,15 +53,9 @@ def bwa_send_msg_by_template(template_name: str):
     lead_id = data.get('leads[status][0][id]')
     if not lead_id:
         return '200 OK HTTPS.', 200
-    config = Config().whatsapp
-    branch, template = None, None
-    for _branch, branch_config in config.items():
-        for _template in branch_config.get('templates') or []:
-            if _template['name'] == template_name:
-                template = _template
-                branch = _branch
-                break
-    numbers = config.get(branch).get('numbers') or [{}]
+    config = Config()
+    branch, template = config.whatsapp_template_by_name.get(template_name) or (None, None)
+    numbers = (config.whatsapp.get(branch) or {}).get('numbers') or [{}]
     number_id = numbers[0].get('id')
     if not branch or not template or not number_id:
         return '200 OK HTTPS.', 200
@@ -152,14 +146,7 @@ def process_whatsapp_message(data: Dict, app):
             # определяем идентификатор нашего номера, на который пришло сообщение
             phone_number_id = value['metadata']['phone_number_id']
             # по идентификатору номера определяем филиал
-            branch = None
-            for _branch, config in Config().whatsapp.items():
-                for number in config.get('numbers'):
-                    if number['id'] == phone_number_id:
-                        branch = _branch
-                        break
-                if branch:
-                    break
+            branch = Config().whatsapp_branch_by_number_id.get(phone_number_id)
             if not branch:
                 # print('no branch')
                 return '200 OK HTTPS.', 200
@@ -302,7 +289,7 @@ def send_telegram_notification(amo_client, branch: str, lead_id: int):
     user = amo_client.get_user(_id=lead_data.get('responsible_user_id'))
     user = user.get('name') or '' if user else ''
     telegram_name = None
-    managers = GoogleAPIClient(book_id=GoogleSheets.Managers.value, sheet_title='managers').get_sheet()
+    managers = get_reference_sheet(book_id=GoogleSheets.Managers.value, sheet_title='managers')
     for manager in managers:
         if manager.get('manager') == user:
             telegram_name = manager.get('telegram')
@@ -3,6 +3,11 @@ def run_amo_data_sync(*args):
     SchedulerTask().get_data_from_amo(*args)
 
 
+def run_amo_data_backfill(*args):
+    from app.main.tasks import SchedulerTask
+    SchedulerTask().backfill_amo_data(*args)
+
+
 def run_pivot_data_builder(*args):
     from app.main.tasks import SchedulerTask
     SchedulerTask().update_pivot_data(*args)
@@ -11,6 +11,7 @@ from flask import Flask
 from flask_sqlalchemy.session import Session
 from sqlalchemy import func
 from app import db
+from app.amo.processor.pool import shutdown_pivot_pools
 from app.main.controllers import SYNC_CONTROLLER
 from app.main.processors import DATA_PROCESSOR
 from app.main.utils import DateTimeEncoder
@@ -19,11 +20,37 @@ from app.models.data import SMData, CDVData
 from app.models.event import SMEvent, CDVEvent
 from app.models.lead import SMLead, CDVLead
 from app.models.note import SMNote, CDVNote
+from app.models.sync_state import SMSyncState, CDVSyncState, SYNCED_AT_ENTITY, DUPLICATE_INDEX_ENTITY
 from app.models.task import SMTask, CDVTask
 from config import Config
 
+# сущности, синхронизируемые инкрементально: модель, поле отметки, метод загрузки из Amo
+SYNC_ENTITIES = {
+    'sm': (
+        (SMContact, 'updated_at', 'get_contacts'),
+        (SMEvent, 'created_at', 'get_events'),
+        (SMNote, 'updated_at', 'get_notes'),
+        (SMTask, 'updated_at', 'get_tasks'),
+        (SMLead, 'updated_at', 'get_leads'),
+    ),
+    'cdv': (
+        (CDVContact, 'updated_at', 'get_contacts'),
+        (CDVEvent, 'created_at', 'get_events'),
+        (CDVNote, 'updated_at', 'get_notes'),
+        (CDVTask, 'updated_at', 'get_tasks'),
+        (CDVLead, 'updated_at', 'get_leads'),
+    ),
+}
+SYNC_STATE = {
+    'sm': SMSyncState,
+    'cdv': CDVSyncState,
+}
+# отметка, до которой (в прошлое) уже догружена история
+BACKFILL_ENTITY = 'backfill'
+
 is_running = {
     'get_data_from_amo': {'sm': False, 'cdv': False},
+    'backfill_amo_data': {'sm': False, 'cdv': False},
     'update_pivot_data': {'sm': False, 'cdv': False},
 }
 
@@ -31,26 +58,50 @@ is_running = {
 class SchedulerTask:
 
     def get_data_from_amo(self, app: Flask, branch: str, starting_date: Optional[datetime] = None):
+        """ Инкрементальная загрузка данных из Amo: запрашиваются только записи, измененные после отметки
+
+        Args:
+            app: приложение Flask
+            branch: ветка (sm, cdv)
+            starting_date: начальная отметка для сущностей, которые еще не синхронизировались
+        """
         key = 'get_data_from_amo'
         if self.__is_running(key=key, branch=branch):
             return
         if not starting_date:
-            date_str = Config().worker.get(key).get('starting_date')
+            date_str = (Config().worker.get(key) or {}).get('starting_date')
             starting_date = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S') if date_str else None
-        self.__get_data_from_amo(
-            app=app,
-            branch=branch,
-            starting_date=starting_date,
-            key=key,
-            time_started=time.time()
-        )
+        try:
+            self.__get_data_from_amo(app=app, branch=branch, starting_date=starting_date)
+        finally:
+            is_running.get(key)[branch] = False
+        gc.collect()
+
+    def backfill_amo_data(self, app: Flask, branch: str):
+        """ Догрузка истории из Amo: за один запуск - не более steps_per_run окон, от ранних сохраненных дат назад
+
+        Args:
+            app: приложение Flask
+            branch: ветка (sm, cdv)
+        """
+        key = 'backfill_amo_data'
+        if self.__is_running(key=key, branch=branch):
+            return
+        try:
+            self.__backfill_amo_data(app=app, branch=branch)
+        finally:
+            is_running.get(key)[branch] = False
         gc.collect()
 
     def update_pivot_data(self, app: Flask, branch: str):
         key = 'update_pivot_data'
         if self.__is_running(key=key, branch=branch):
             return
-        self.__update_pivot_data(app=app, branch=branch, key=key, time_started=time.time())
+        try:
+            self.__update_pivot_data(app=app, branch=branch, key=key, time_started=time.time())
+        finally:
+            # процессы пула построения строк между запусками не держим
+            shutdown_pivot_pools()
         gc.collect()
 
     @staticmethod
@@ -80,88 +131,113 @@ class SchedulerTask:
         else:
             return datetime.now()
 
-    def __get_data_from_amo(
-        self,
-        app: Flask,
-        branch: str,
-        key: str,
-        time_started: float,
+    @staticmethod
+    def __get_watermark(
+        session: Session,
+        sync_state: db.Model,
+        model: db.Model,
+        column_name: str,
         starting_date: Optional[datetime] = None
-    ):
-        empty_steps = 0
-        if branch == 'sm':
-            models_with_columns = [
-                (SMContact, 'updated_at'),
-                (SMEvent, 'created_at'),
-                (SMNote, 'updated_at'),
-                (SMTask, 'updated_at'),
-                (SMLead, 'updated_at'),
-            ]
-        elif branch == 'cdv':
-            models_with_columns = [
-                (CDVContact, 'updated_at'),
-                (CDVEvent, 'created_at'),
-                (CDVNote, 'updated_at'),
-                (CDVTask, 'updated_at'),
-                (CDVLead, 'updated_at'),
-            ]
-        else:
-            is_running.get(key)[branch] = False
+    ) -> int:
+        """ Отметка синхронизации сущности
+
+        Если сущность еще не синхронизировалась, отметка берется по самой поздней из уже сохраненных записей,
+            а при пустой таблице - от starting_date (либо от начала текущего интервала)
+        """
+        entity = model.__tablename__
+        watermark = sync_state.get_watermark(entity=entity)
+        if watermark is not None:
+            return watermark
+        watermark = session.query(func.max(getattr(model, column_name))).scalar()
+        if not watermark:
+            interval = Config().worker.get('get_data_from_amo')['interval']
+            watermark = int((starting_date or datetime.now() - timedelta(minutes=interval)).timestamp())
+        sync_state.set_watermark(entity=entity, watermark=watermark)
+        return watermark
+
+    def __get_data_from_amo(self, app: Flask, branch: str, starting_date: Optional[datetime] = None):
+        entities = SYNC_ENTITIES.get(branch)
+        if not entities:
             return
-        # задаем предельную длительность итерации в секундах и фиксируем время начала процесса
-        iteration_duration = 3600
+        sync_state = SYNC_STATE.get(branch)
         processor = DATA_PROCESSOR.get(branch)()
         with app.app_context():
             session = db.session
-            starting_date = starting_date or self.__get_earliest_date(
-                session=session,
-                models_with_columns=models_with_columns
-            )
-            config = Config().worker.get('get_data_from_amo')
-            interval = config['interval']
-            date_from = starting_date - timedelta(minutes=interval)
-            date_to = starting_date
-            df = date_from.strftime("%Y-%m-%d %H:%M:%S")
-            dt = date_to.strftime("%H:%M:%S")
-            processor.log.add(
-                text=f'reading Amo data :: {df} - {dt} :: iteration started',
-                log_type=1
-            )
             controller = SYNC_CONTROLLER.get(branch)()
-            while True:
-                # если достигнуто предельное время выполнения операции, завершаем процесс
-                if time.time() - time_started >= iteration_duration:
-                    is_running.get(key)[branch] = False
-                    return
-                config = Config().worker.get('get_data_from_amo')
-                interval = config['interval']
-                empty_steps_limit = config['empty_steps_limit']
-                has_new = False
-                if controller.run(date_from=date_from, date_to=date_to):
-                    has_new = True
-                    empty_steps = 0  # Обнуляем счетчик, если были изменения
-                if not has_new:
-                    empty_steps += 1
+            # справочники небольшие, их синхронизируем целиком
+            controller.get_users()
+            controller.get_pipelines()
+            date_to = datetime.now()
+            for model, column_name, method in entities:
+                entity = model.__tablename__
+                watermark = self.__get_watermark(
+                    session=session,
+                    sync_state=sync_state,
+                    model=model,
+                    column_name=column_name,
+                    starting_date=starting_date
+                )
+                # нижняя граница включается: записи, измененные в ту же секунду, что и отметка, не теряются,
+                #   а повторно прочитанные неизмененные записи upsert не трогает
+                date_from = datetime.fromtimestamp(watermark)
+                has_new = getattr(controller, method)(date_from=date_from, date_to=date_to)
+                if has_new:
+                    # новая отметка - самая поздняя из сохраненных в БД дат
+                    stored = session.query(func.max(getattr(model, column_name))).scalar()
+                    if stored and stored > watermark:
+                        watermark = stored
+                        sync_state.set_watermark(entity=entity, watermark=watermark)
                 df = date_from.strftime("%Y-%m-%d %H:%M:%S")
-                dt = date_to.strftime("%H:%M:%S")
-                # запись лога в БД
-                processor.log.add(text=f'reading Amo data :: {df} - {dt} :: R{empty_steps}', log_type=1)
-                if empty_steps_limit > 0 and empty_steps_limit == empty_steps:
-                    processor.log.add(
-                        text='reading Amo data :: iteration finished',
-                        log_type=1
-                    )
+                processor.log.add(
+                    text=f'reading Amo data :: {entity} :: since {df} :: {"updated" if has_new else "no changes"}',
+                    log_type=1
+                )
+            # индекс поиска дублей еще не строился по всем данным (первый запуск) - строим
+            if sync_state.get_watermark(entity=DUPLICATE_INDEX_ENTITY) is None:
+                processor.log.add(text='building duplicate index', log_type=1)
+                controller.rebuild_duplicate_index()
+            # проход завершен: локальные данные (в т.ч. индекс поиска дублей) актуальны на date_to
+            sync_state.set_watermark(entity=SYNCED_AT_ENTITY, watermark=int(date_to.timestamp()))
+
+    def __backfill_amo_data(self, app: Flask, branch: str):
+        entities = SYNC_ENTITIES.get(branch)
+        if not entities:
+            return
+        config = Config().worker.get('backfill_amo_data') or {}
+        # глубина истории не задана - догружать нечего
+        date_str = config.get('date_limit')
+        if not date_str:
+            return
+        date_limit = datetime.strptime(date_str, '%Y-%m-%d %H:%M:%S')
+        interval = config.get('interval', 60)
+        steps_per_run = config.get('steps_per_run', 10)
+        pause = config.get('pause', 1)
+        sync_state = SYNC_STATE.get(branch)
+        processor = DATA_PROCESSOR.get(branch)()
+        with app.app_context():
+            session = db.session
+            controller = SYNC_CONTROLLER.get(branch)()
+            cursor = sync_state.get_watermark(entity=BACKFILL_ENTITY)
+            if cursor is None:
+                date_to = self.__get_earliest_date(
+                    session=session,
+                    models_with_columns=[(model, column_name) for model, column_name, _ in entities]
+                )
+            else:
+                date_to = datetime.fromtimestamp(cursor)
+            for _ in range(steps_per_run):
+                if date_to <= date_limit:
                     break
-                date_from = date_from - timedelta(minutes=interval)
-                date_to = date_to - timedelta(minutes=interval)
-                time.sleep(random.uniform(0.01, 1.5))
-        self.__get_data_from_amo(
-            app=app,
-            branch=branch,
-            starting_date=datetime.now(),
-            key=key,
-            time_started=time_started
-        )
+                date_from = max(date_to - timedelta(minutes=interval), date_limit)
+                controller.run(date_from=date_from, date_to=date_to, with_references=False)
+                # история до date_from загружена - запоминаем позицию, следующий запуск продолжит с нее
+                sync_state.set_watermark(entity=BACKFILL_ENTITY, watermark=int(date_from.timestamp()))
+                df = date_from.strftime("%Y-%m-%d %H:%M:%S")
+                dt = date_to.strftime("%H:%M:%S")
+                processor.log.add(text=f'backfilling Amo data :: {df} - {dt}', log_type=1)
+                date_to = date_from
+                # не расходуем всю квоту запросов Amo на историю
+                time.sleep(pause)
 
     @staticmethod
     def __build_pivot_data_item(line: Dict) -> Dict:
@@ -224,7 +300,13 @@ class SchedulerTask:
                 batch_data = []
                 has_new = False
                 # используем генератор для получения обновленных данных
-                for line in data_processor.update(date_from=date_from, date_to=date_to, pre_data=pre_data):
+                for line in data_processor.update(
+                    date_from=date_from,
+                    date_to=date_to,
+                    pre_data=pre_data,
+                    processes=config.get('processes') or 0,
+                    bulk=bool(config.get('bulk'))
+                ):
                     batch_data.append(self.__build_pivot_data_item(line=line))
                     if len(batch_data) >= batch_size:
                         # пакетная синхронизация
@@ -4,8 +4,9 @@ import time
 from datetime import date, datetime
 from typing import Dict, Callable, Tuple, Optional
 from app.amo.api.client import SwissmedicaAPIClient, DrvorobjevAPIClient
+from app.amo.processor.functions import get_contact_keys
 from app.amo.processor.processor import SMDataProcessor, CDVDataProcessor
-from app.google_api.client import GoogleAPIClient
+from app.google_api.cache import get_reference_sheet
 from config import Config
 from modules.constants.constants.constants import GoogleSheets
 
@@ -162,30 +163,10 @@ def handle_new_lead_slow_reaction(data: Dict) -> Tuple[Optional[str], Optional[s
 
 
 def check_for_duplicated_leads(processor, lead, amo_client, branch, existing_tags) -> str:
-    contacts = []
-    for contact in (lead.get('_embedded') or {}).get('contacts') or []:
-        contacts.append(amo_client.get_contact_by_id(contact_id=contact['id']))
-        time.sleep(0.25)
-    lead['contacts'] = contacts
-    duplicated = None
-    for field_code in ('PHONE', 'EMAIL'):
-        for contact in processor.get_lead_contacts(lead=lead, field_code=field_code):
-            if not contact or len(contact) < 6:
-                continue
-            if field_code == 'EMAIL' and '@' not in contact:
-                continue
-            # processor.log.add(text=f"{field_code} :: {contact}")
-            if not contact:
-                continue
-            for existing_lead in amo_client.find_leads(query=contact, limit=2) or []:
-                if str(existing_lead['id']) != str(lead['id']):
-                    duplicated = existing_lead
-                    break
-            time.sleep(0.25)
-            if duplicated:
-                break
-        if duplicated:
-            break
+    contact_ids = [contact['id'] for contact in (lead.get('_embedded') or {}).get('contacts') or []]
+    contacts = amo_client.get_contacts_by_ids(contact_ids) if contact_ids else {}
+    lead['contacts'] = [contacts[_id] for _id in contact_ids if _id in contacts]
+    duplicated = find_duplicated_lead(processor=processor, lead=lead, amo_client=amo_client)
     duplicate = ''
     if duplicated:
         _embedded = duplicated.get('_embedded') or {}
@@ -231,6 +212,39 @@ def check_for_duplicated_leads(processor, lead, amo_client, branch, existing_tag
     return duplicate
 
 
+def find_duplicated_lead(processor, lead: Dict, amo_client) -> Optional[Dict]:
+    """ Первый найденный дубль сделки
+
+    Дубли ищутся по локальному индексу телефонов / email. Если синхронизация с Amo отстала больше,
+        чем на max_sync_lag, индекс может не знать о свежих сделках - тогда телефоны и email ищутся через Amo.
+        Так же и пока индекс не построен по всем сохраненным данным
+
+    Args:
+        processor: процессор данных филиала
+        lead: сделка Amo с контактами (lead['contacts'])
+        amo_client: клиент API Amo
+
+    Returns:
+        сделка-дубль, либо None
+    """
+    sync_lag = processor.get_sync_lag()
+    if sync_lag is not None and sync_lag <= Config().duplicates['max_sync_lag'] and processor.has_duplicate_index():
+        keys = [key for contact in lead.get('contacts') or [] for key in get_contact_keys(contact)]
+        duplicates = processor.find_duplicated_leads(keys=keys, lead_id=lead['id'], limit=1)
+        return duplicates[0] if duplicates else None
+    for field_code in ('PHONE', 'EMAIL'):
+        for contact in processor.get_lead_contacts(lead=lead, field_code=field_code):
+            if not contact or len(contact) < 6:
+                continue
+            if field_code == 'EMAIL' and '@' not in contact:
+                continue
+            for existing_lead in amo_client.find_leads(query=contact, limit=2) or []:
+                if str(existing_lead['id']) != str(lead['id']):
+                    return existing_lead
+            time.sleep(0.25)
+    return None
+
+
 def move_lead_to_continue_to_work(lead, branch, amo_client):
     """ Перемещает лид на этап "Продолжить работу" в соответствующей воронке
     {
@@ -291,7 +305,7 @@ def handle_new_interaction(data: Dict) -> Tuple[Optional[str], Optional[str], Op
     user = user.name if user else ''
     # тегаем пользователя через @
     telegram_name = None
-    managers = GoogleAPIClient(book_id=GoogleSheets.Managers.value, sheet_title='managers').get_sheet()
+    managers = get_reference_sheet(book_id=GoogleSheets.Managers.value, sheet_title='managers')
     for manager in managers:
         if manager.get('manager') == user:
             telegram_name = manager.get('telegram')
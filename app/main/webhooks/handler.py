@@ -0,0 +1,222 @@
+""" Очередь входящих webhook (Amo, Sipuni, Tawk)
+
+Notes:
+    Обработчики webhook делают несколько синхронных запросов к Amo (сделка, контакты, поиск дублей) и Google Sheets.
+        Пока они выполняются внутри запроса, единственный eventlet-воркер занят, а Amo повторяет (и со временем
+        отключает) медленные webhook. Поэтому маршрут только сохраняет webhook в таблицу Webhook и сразу отвечает,
+        а записи разбирает фоновая задача с ограниченным числом одновременно обрабатываемых webhook.
+
+    Ключ дедупликации - обработчик, событие и идентификатор сделки: пока по сделке есть необработанная запись,
+        повторный webhook не создает новую запись, а заменяет ее данные. Записи с одним ключом не обрабатываются
+        одновременно.
+
+    Если данные для обработки еще не готовы (например, Tawk не успел сохранить чат), обработчик выбрасывает
+        RetryLater: запись возвращается в очередь по расписанию задержек, не занимая воркер ожиданием.
+"""
+__author__ = 'ke.mizonov'
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, List, Optional, Sequence
+from flask import Flask, current_app
+from sqlalchemy import case, delete, exists, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.exc import IntegrityError
+from app.extensions import db, socketio
+from app.models.webhook import SMWebhook, PENDING, PROCESSING, DONE, FAILED
+from config import Config
+
+# ключ формы Amo с идентификатором сделки: leads[add][0][id], leads[status][0][id], leads[call_in][0][id], ...
+AMO_LEAD_KEY = re.compile(r'^leads\[(\w+)]\[0]\[id]$')
+ERROR_LENGTH = 1000
+
+# обработчики webhook по имени: регистрируются модулями маршрутов (register_webhook_handler)
+HANDLERS: Dict[str, Callable[[Dict], Any]] = {}
+is_running = {'value': False}
+lock = threading.Lock()
+
+
+class RetryLater(Exception):
+    """ Данные для обработки webhook еще не готовы - запись нужно повторить позже """
+    def __init__(self, message: str, delays: Sequence[int]):
+        """
+        Args:
+            message: причина (сохраняется в записи очереди)
+            delays: задержки перед повторами, сек. (после последней запись помечается ошибочной)
+        """
+        super().__init__(message)
+        self.delays = delays
+
+
+def register_webhook_handler(name: str, func: Callable[[Dict], Any]):
+    """ Регистрирует обработчик webhook
+
+    Args:
+        name: имя обработчика (сохраняется в записи очереди)
+        func: функция, принимающая данные webhook
+    """
+    HANDLERS[name] = func
+
+
+def get_amo_dedupe_key(handler: str, data: Dict) -> Optional[str]:
+    """ Ключ дедупликации webhook Amo: обработчик, событие и идентификатор сделки
+
+    Args:
+        handler: имя обработчика
+        data: данные webhook (форма Amo)
+
+    Returns:
+        ключ вида new_lead:add:23802129, либо None, если в данных нет сделки
+    """
+    for key, value in data.items():
+        match = AMO_LEAD_KEY.match(key)
+        if match and value:
+            return f'{handler}:{match.group(1)}:{value}'
+    return None
+
+
+def enqueue_webhook(handler: str, data: Dict, dedupe_key: Optional[str] = None):
+    """ Сохраняет webhook в очередь и будит фоновую обработку (вызывается внутри запроса)
+
+    Args:
+        handler: имя обработчика
+        data: данные webhook
+        dedupe_key: ключ дедупликации (необработанная запись с тем же ключом получит новые данные)
+    """
+    now = int(time.time())
+    table = SMWebhook.__table__
+    stmt = pg_insert(table).values(
+        handler=handler,
+        dedupe_key=dedupe_key,
+        data=data,
+        status=PENDING,
+        attempts=0,
+        created_at=now,
+        updated_at=now,
+        process_after=now
+    )
+    if dedupe_key:
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['dedupe_key'],
+            index_where=table.c.status == PENDING,
+            set_={'data': stmt.excluded.data, 'updated_at': stmt.excluded.updated_at}
+        )
+    db.session.execute(stmt)
+    db.session.commit()
+    socketio.start_background_task(process_webhook_queue, current_app._get_current_object())
+
+
+def process_webhook_queue(app: Flask):
+    """ Разбирает очередь webhook, пока в ней есть готовые к обработке записи
+
+    Args:
+        app: приложение Flask
+    """
+    with lock:
+        if is_running['value']:
+            return
+        is_running['value'] = True
+    try:
+        config = Config().webhook_queue
+        with app.app_context():
+            __release_stale(config=config)
+            __remove_old(config=config)
+        with ThreadPoolExecutor(max_workers=config['workers']) as executor:
+            while True:
+                with app.app_context():
+                    records = __claim(limit=config['batch'])
+                if not records:
+                    break
+                list(executor.map(lambda record: __process(app=app, record=record, config=config), records))
+    finally:
+        is_running['value'] = False
+
+
+def __claim(limit: int) -> List:
+    """ Забирает в работу ожидающие записи (параллельно запущенные обработчики получат другие записи) """
+    now = int(time.time())
+    table = SMWebhook.__table__
+    processing = table.alias('processing')
+    candidates = select(table.c.id).where(
+        table.c.status == PENDING,
+        table.c.process_after <= now,
+        # записи с тем же ключом дедупликации не обрабатываются одновременно
+        ~exists().where(processing.c.status == PROCESSING, processing.c.dedupe_key == table.c.dedupe_key)
+    ).order_by(table.c.id).limit(limit).with_for_update(skip_locked=True)
+    stmt = update(table).where(table.c.id.in_(candidates.scalar_subquery())).values(
+        status=PROCESSING,
+        attempts=table.c.attempts + 1,
+        updated_at=now
+    ).returning(table.c.id, table.c.handler, table.c.data, table.c.attempts)
+    records = db.session.execute(stmt).fetchall()
+    db.session.commit()
+    return sorted(records, key=lambda x: x.id)
+
+
+def __process(app: Flask, record, config: Dict):
+    with app.app_context():
+        try:
+            handler = HANDLERS.get(record.handler)
+            if handler is None:
+                raise KeyError(f'unknown webhook handler "{record.handler}"')
+            handler(record.data or {})
+            values = {'status': DONE, 'error': None}
+        except RetryLater as exc:
+            db.session.rollback()
+            is_exhausted = record.attempts > len(exc.delays)
+            values = {
+                'status': FAILED if is_exhausted else PENDING,
+                'error': str(exc)[:ERROR_LENGTH],
+                'process_after': int(time.time()) + (0 if is_exhausted else exc.delays[record.attempts - 1])
+            }
+        except Exception as exc:
+            db.session.rollback()
+            print(f'webhook {record.id} ({record.handler}) error:', exc)
+            values = {
+                'status': FAILED if record.attempts >= config['max_attempts'] else PENDING,
+                'error': str(exc)[:ERROR_LENGTH],
+                'process_after': int(time.time()) + config['retry_delay'] * record.attempts
+            }
+        table = SMWebhook.__table__
+        try:
+            db.session.execute(
+                update(table).where(table.c.id == record.id).values(updated_at=int(time.time()), **values)
+            )
+            db.session.commit()
+        except IntegrityError:
+            # пока запись обрабатывалась, по той же сделке пришел новый webhook - повторять будет он
+            db.session.rollback()
+            db.session.execute(update(table).where(table.c.id == record.id).values(
+                status=DONE,
+                updated_at=int(time.time()),
+                error=f'superseded: {values["error"]}'[:ERROR_LENGTH]
+            ))
+            db.session.commit()
+
+
+def __release_stale(config: Dict):
+    """ Возвращает в очередь записи, обработка которых была прервана (например, перезапуском приложения) """
+    now = int(time.time())
+    table = SMWebhook.__table__
+    pending = table.alias('pending')
+    stale = (table.c.status == PROCESSING) & (table.c.updated_at < now - config['processing_timeout'])
+    has_pending = exists().where(pending.c.status == PENDING, pending.c.dedupe_key == table.c.dedupe_key)
+    # по сделке уже есть новый webhook - прерванную запись не повторяем
+    db.session.execute(update(table).where(stale, has_pending).values(status=DONE, updated_at=now, error='superseded'))
+    db.session.execute(update(table).where(stale).values(
+        status=case((table.c.attempts >= config['max_attempts'], FAILED), else_=PENDING),
+        updated_at=now,
+        process_after=now
+    ))
+    db.session.commit()
+
+
+def __remove_old(config: Dict):
+    """ Удаляет обработанные записи старше retention_days """
+    table = SMWebhook.__table__
+    db.session.execute(delete(table).where(
+        table.c.status.in_((DONE, FAILED)),
+        table.c.updated_at < int(time.time()) - config['retention_days'] * 86400
+    ))
+    db.session.commit()
@@ -0,0 +1,3 @@
+def run(*args):
+    from app.main.webhooks.handler import process_webhook_queue
+    process_webhook_queue(*args)
@@ -0,0 +1,57 @@
+""" Реестр отраженных (reflected) таблиц БД """
+__author__ = 'ke.mizonov'
+import threading
+from typing import Dict, Optional, Tuple
+from sqlalchemy import Table, MetaData
+from sqlalchemy.engine import Engine
+from app.engine import get_engine
+
+tables: Dict[Tuple[str, str], Table] = {}
+lock = threading.Lock()
+
+
+def get_table(table_name: str, schema: str, engine: Optional[Engine] = None) -> Table:
+    """ Синглтон отраженной таблицы
+
+    Структура таблицы читается из каталога БД один раз на процесс,
+        повторные обращения получают уже готовый объект Table
+
+    Args:
+        table_name: имя таблицы (Lead, Pipeline, ...)
+        schema: схема БД (sm, cdv)
+        engine: соединение с БД, по умолчанию - общее соединение приложения
+
+    Returns:
+        таблица
+    """
+    key = (schema, table_name)
+    table = tables.get(key)
+    if table is not None:
+        return table
+    with lock:
+        # пока ждали блокировку, таблицу мог отразить другой поток
+        table = tables.get(key)
+        if table is None:
+            table = tables[key] = Table(
+                table_name,
+                MetaData(),
+                autoload_with=engine or get_engine(),
+                schema=schema
+            )
+    return table
+
+
+def invalidate_tables(schema: Optional[str] = None, table_name: Optional[str] = None):
+    """ Сбрасывает закэшированные таблицы (например, после изменения структуры БД)
+
+    Args:
+        schema: схема БД, если не задана - сбрасываются таблицы всех схем
+        table_name: имя таблицы, если не задано - сбрасываются все таблицы схемы
+    """
+    with lock:
+        for key in list(tables.keys()):
+            if schema and key[0] != schema:
+                continue
+            if table_name and key[1] != table_name:
+                continue
+            tables.pop(key, None)
@@ -0,0 +1,54 @@
+""" Индекс поиска дублей: нормализованные телефоны / email контактов и связи сделок с контактами
+
+Поддерживается инкрементально при синхронизации контактов и сделок (SyncController.sync_records)
+"""
+__author__ = 'ke.mizonov'
+from app.extensions import db
+
+
+class ContactKeyBase(db.Model):
+    __abstract__ = True
+
+    id = db.Column(db.Integer, primary_key=True)
+    contact_id = db.Column(db.Integer, nullable=False, index=True)     # id_on_source контакта
+    value = db.Column(db.String(255), nullable=False, index=True)      # телефон (последние цифры) или email
+
+    def __repr__(self):
+        return f'<ContactKey {self.contact_id} :: {self.value}>'
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'to_dict'}
+
+
+class SMContactKey(ContactKeyBase):
+    __tablename__ = 'ContactKey'
+    __table_args__ = {"schema": "sm"}
+
+
+class CDVContactKey(ContactKeyBase):
+    __tablename__ = 'ContactKey'
+    __table_args__ = {"schema": "cdv"}
+
+
+class LeadContactBase(db.Model):
+    __abstract__ = True
+
+    id = db.Column(db.Integer, primary_key=True)
+    lead_id = db.Column(db.Integer, nullable=False, index=True)        # id_on_source сделки
+    contact_id = db.Column(db.Integer, nullable=False, index=True)     # id_on_source контакта
+
+    def __repr__(self):
+        return f'<LeadContact {self.lead_id} :: {self.contact_id}>'
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'to_dict'}
+
+
+class SMLeadContact(LeadContactBase):
+    __tablename__ = 'LeadContact'
+    __table_args__ = {"schema": "sm"}
+
+
+class CDVLeadContact(LeadContactBase):
+    __tablename__ = 'LeadContact'
+    __table_args__ = {"schema": "cdv"}
@@ -25,12 +25,17 @@ class EventBase(db.Model):
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'to_dict'}
 
+    @staticmethod
+    def lookup_index() -> db.Index:
+        """ Индекс для поиска событий, связанных с созданием лидов (DataProcessor.get_creation_events_data) """
+        return db.Index('ix_event_entity_type_type_entity_id_created_at', 'entity_type', 'type', 'entity_id', 'created_at')
+
 
 class SMEvent(EventBase):
     __tablename__ = 'Event'
-    __table_args__ = {"schema": "sm"}
+    __table_args__ = (EventBase.lookup_index(), {"schema": "sm"})
 
 
 class CDVEvent(EventBase):
     __tablename__ = 'Event'
-    __table_args__ = {"schema": "cdv"}
+    __table_args__ = (EventBase.lookup_index(), {"schema": "cdv"})
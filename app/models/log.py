@@ -3,6 +3,8 @@ __author__ = 'ke.mizonov'
 import time
 from datetime import datetime
 from typing import Optional
+from sqlalchemy import delete, func, select
+from sqlalchemy.engine import Engine
 from app.extensions import db
 
 LIMIT = 300_000
@@ -26,15 +28,25 @@ class LogBase(db.Model):
             created_at = int(time.time())
         record = cls(branch=branch, text=text, type=log_type, created_at=created_at)
         db.session.add(record)
-        # commit the new record first
         db.session.commit()
-        # check if there are more than LIMIT records
-        if cls.query.count() > LIMIT:
-            oldest_record = cls.query.order_by(cls.id).first()
-            db.session.delete(oldest_record)
-            db.session.commit()
         db.session.close()
 
+    @classmethod
+    def remove_old(cls, limit: int = LIMIT, engine: Optional[Engine] = None) -> int:
+        """ Удаляет старые записи, оставляя не более limit последних (по диапазону id, без подсчета строк)
+
+        Args:
+            limit: сколько последних записей оставить
+            engine: соединение с БД, по умолчанию - соединение Flask-SQLAlchemy
+
+        Returns:
+            количество удаленных записей
+        """
+        table = cls.__table__
+        max_id = select(func.max(table.c.id)).scalar_subquery()
+        with (engine or db.engine).begin() as connection:
+            return connection.execute(delete(table).where(table.c.id <= max_id - limit)).rowcount
+
     def to_dict(self):
         return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'to_dict'}
 
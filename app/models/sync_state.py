@@ -0,0 +1,64 @@
+""" Состояние синхронизации с Amo (отметки "высокой воды" по сущностям) """
+__author__ = 'ke.mizonov'
+import time
+from typing import Optional
+from app.extensions import db
+
+# отметка последнего завершенного прохода синхронизации (верхняя граница окна, timestamp)
+SYNCED_AT_ENTITY = 'synced_at'
+# отметка построения индекса поиска дублей по всем сохраненным контактам и сделкам (timestamp)
+DUPLICATE_INDEX_ENTITY = 'duplicate_index'
+
+
+class SyncStateBase(db.Model):
+    __abstract__ = True
+
+    id = db.Column(db.Integer, primary_key=True)
+    entity = db.Column(db.String(50), unique=True, nullable=False)      # Lead, Contact, ..., backfill
+    watermark = db.Column(db.Integer, nullable=False)                   # timestamp
+    updated_at = db.Column(db.Integer, nullable=False)
+
+    def __repr__(self):
+        return f'<SyncState {self.entity} :: {self.watermark}>'
+
+    @classmethod
+    def get_watermark(cls, entity: str) -> Optional[int]:
+        """ Отметка синхронизации сущности
+
+        Args:
+            entity: сущность (имя таблицы)
+
+        Returns:
+            timestamp, либо None, если сущность еще не синхронизировалась
+        """
+        record = cls.query.filter_by(entity=entity).first()
+        return record.watermark if record else None
+
+    @classmethod
+    def set_watermark(cls, entity: str, watermark: int):
+        """ Сохраняет отметку синхронизации сущности
+
+        Args:
+            entity: сущность (имя таблицы)
+            watermark: timestamp
+        """
+        record = cls.query.filter_by(entity=entity).first()
+        if record is None:
+            record = cls(entity=entity)
+            db.session.add(record)
+        record.watermark = watermark
+        record.updated_at = int(time.time())
+        db.session.commit()
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'to_dict'}
+
+
+class SMSyncState(SyncStateBase):
+    __tablename__ = 'SyncState'
+    __table_args__ = {"schema": "sm"}
+
+
+class CDVSyncState(SyncStateBase):
+    __tablename__ = 'SyncState'
+    __table_args__ = {"schema": "cdv"}
@@ -0,0 +1,53 @@
+""" Очередь входящих webhook (Amo, Sipuni, Tawk) """
+__author__ = 'ke.mizonov'
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import JSON
+from app.extensions import db
+
+# статусы записи очереди
+PENDING = 0
+PROCESSING = 1
+DONE = 2
+FAILED = 3
+
+
+class WebhookBase(db.Model):
+    __abstract__ = True
+
+    id = db.Column(db.Integer, primary_key=True)
+    handler = db.Column(db.String(50), nullable=False)      # new_lead, new_raw_lead, tawk, autocall_result, ...
+    dedupe_key = db.Column(db.String(200))                  # new_lead:add:23802129 (повторы по той же сделке)
+    data = db.Column(JSON)
+    status = db.Column(db.Integer, nullable=False, default=PENDING)
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.String(1000))
+    created_at = db.Column(db.Integer, nullable=False)
+    updated_at = db.Column(db.Integer, nullable=False)
+    process_after = db.Column(db.Integer, nullable=False)   # timestamp, не раньше которого запись берется в работу
+
+    def __repr__(self):
+        return f'<Webhook {self.handler} :: {self.dedupe_key} :: {self.status}>'
+
+    def to_dict(self):
+        return {c.name: getattr(self, c.name) for c in self.__table__.columns if c.name != 'to_dict'}
+
+    @staticmethod
+    def queue_index() -> db.Index:
+        """ Индекс для выборки ожидающих записей """
+        return db.Index('ix_webhook_status_process_after', 'status', 'process_after')
+
+    @staticmethod
+    def dedupe_index() -> db.Index:
+        """ Среди ожидающих обработки записей ключ дедупликации уникален """
+        return db.Index(
+            'ix_webhook_pending_dedupe_key',
+            'dedupe_key',
+            unique=True,
+            postgresql_where=text(f'status = {PENDING}')
+        )
+
+
+class SMWebhook(WebhookBase):
+    """ Очередь общая для всех аккаунтов (филиал определяется по данным webhook) """
+    __tablename__ = 'Webhook'
+    __table_args__ = (WebhookBase.queue_index(), WebhookBase.dedupe_index(), {"schema": "sm"})
@@ -12,6 +12,16 @@ $('#events').prepend('<p>' + event.msg + '</p>');
     }
 });
 
+// пакет сообщений (в порядке поступления)
+socket.on('new_events', function(events) {
+    events.msgs.forEach(function(msg) {
+        $('#events').prepend('<p>' + msg + '</p>');
+    });
+    while ($('#events').children().length > 1000) {
+        $('#events').children().last().remove();
+    }
+});
+
 // This function tries to parse a string to Date, and if it succeeds, it returns the Date, otherwise, the original string.
 function parseISODate(isoString) {
     const regexDate = /^\d{4}-\d{2}-\d{2}$/;
@@ -27,7 +37,13 @@ let dataAccumulated = [];
 let headersReceived = false;
 let headers = [];
 
-socket.on('pivot_data', function(event) {
+// Порции данных приходят JSON-массивами, сжатыми gzip
+async function inflateJson(buffer) {
+    const stream = new Blob([buffer]).stream().pipeThrough(new DecompressionStream('gzip'));
+    return JSON.parse(await new Response(stream).text());
+}
+
+async function handlePivotData(event) {
     if (event.start) {
       dataAccumulated = [];
       headersReceived = false;
@@ -36,10 +52,14 @@ socket.on('pivot_data', function(event) {
       headers = event.headers;
       headersReceived = true;
     }
-    if (event.data && event.data.length > 0) {
-      dataAccumulated.push(...event.data);
+    if (event.data) {
+      dataAccumulated.push(...await inflateJson(event.data));
+    }
+    if (event.total) {
+        $('#pivot-progress').text('Downloading data: ' + event.sent + ' / ' + event.total);
     }
     if (event.done) {
+        $('#pivot-progress').text('');
         dataAccumulated.unshift(headers);
 
         let sanitizedData = dataAccumulated.map(item => {
@@ -58,6 +78,13 @@ socket.on('pivot_data', function(event) {
         const blob = new Blob([new Uint8Array([...binaryData].map(char => char.charCodeAt(0)))], { type: "application/octet-stream" });
         saveAs(blob, event.file_name + '.xlsx');
     }
+}
+
+// распаковка асинхронная, поэтому события обрабатываются строго по очереди
+let pivotDataQueue = Promise.resolve();
+
+socket.on('pivot_data', function(event) {
+    pivotDataQueue = pivotDataQueue.then(() => handlePivotData(event)).catch(error => console.error(error));
 });
 
 function makeGetRequest(endpoint, params, msg) {
@@ -1,9 +1,32 @@
 import json
+import threading
 from datetime import datetime, timedelta
 from typing import Dict, List, Optional
 import requests
+from requests.adapters import HTTPAdapter
 from config import Config
 
+# общая HTTP-сессия клиентов Tawk (пул keep-alive соединений к api.tawk.to)
+session = {'value': None}
+lock = threading.Lock()
+
+
+def get_session() -> requests.Session:
+    """ Синглтон HTTP-сессии для обращения к API Tawk
+
+    Returns:
+        общая для всех клиентов HTTP-сессия
+    """
+    if session['value'] is not None:
+        return session['value']
+    with lock:
+        if session['value'] is None:
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=Config().tawk_http['pool_size'], pool_block=True)
+            http = requests.Session()
+            http.mount('https://', adapter)
+            session['value'] = http
+    return session['value']
+
 
 class TawkRestClient:
     base_url: str = 'https://api.tawk.to/v1/'
@@ -15,6 +38,7 @@ class TawkRestClient:
             'Accept': 'application/json'
         }
         self.params = None
+        self.http = get_session()
 
     def get_channel_info(self, _id: str) -> Dict:
         return self._get_channel_info(_id=_id).get('data') or {}
@@ -252,11 +276,13 @@ class TawkRestClient:
         return self
 
     def __fetch(self, endpoint: str) -> Dict:
-        response = requests.post(
+        config = Config().tawk_http
+        response = self.http.post(
             f'{self.base_url}{endpoint}',
             headers=self.headers,
             auth=(self.token, ''),
-            data=json.dumps(self.params)
+            data=json.dumps(self.params),
+            timeout=(config['connect_timeout'], config['read_timeout'])
         )
         data = response.json()
         if not data or 'error' in data or 'data' not in data:
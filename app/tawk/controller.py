@@ -44,13 +44,19 @@
    "email":"TestOfflineForm@gmail.com",
    "phone":"+99595959595"
 }
+
+Чат, о завершении которого сообщил webhook, Tawk сохраняет с задержкой. Webhook обрабатывается в очереди
+    (app.main.webhooks): если чат еще не доступен через API, запись возвращается в очередь (RetryLater) и
+    повторяется с нарастающей задержкой, а сделка создается / обновляется, когда чат готов. Время от завершения
+    чата до получения его истории учитывается в transcript_metrics
 """
-import time
+import threading
+from datetime import datetime, timezone
 from typing import Dict, Optional, Tuple
 from urllib.parse import urlparse, parse_qs
-from flask import Response, Request
 
 from app.amo.api.client import SwissmedicaAPIClient, DrvorobjevAPIClient
+from app.main.webhooks.handler import RetryLater
 from app.models.chat import SMChat, CDVChat
 from app.tawk.api import TawkRestClient
 from config import Config
@@ -75,12 +81,34 @@ TAWK_CHAT_MODEL = {
     'drvorobjev': CDVChat,
 }
 
+# метрики получения истории чатов (в рамках процесса)
+transcript_metrics = {'ready': 0, 'not_ready': 0, 'seconds_total': 0.0, 'seconds_max': 0.0}
+metrics_lock = threading.Lock()
+
+
+def get_transcript_metrics() -> Dict:
+    """ Метрики получения истории чатов Tawk
+
+    Returns:
+        {
+            'ready': количество полученных чатов,
+            'not_ready': количество попыток, когда чат еще не был доступен,
+            'seconds_avg': среднее время от завершения чата до получения истории, сек.,
+            'seconds_max': максимальное время от завершения чата до получения истории, сек.
+        }
+    """
+    with metrics_lock:
+        metrics = dict(transcript_metrics)
+    seconds_total = metrics.pop('seconds_total')
+    metrics['seconds_avg'] = round(seconds_total / metrics['ready'], 1) if metrics['ready'] else None
+    return metrics
+
 
 class TawkController:
     """ Класс для управления чатами Tawk, интеграции с Amo """
 
-    def handle(self, request: Request):
-        """ Прилетают примерно такие данные
+    def handle(self, data: Dict):
+        """ Обработка webhook Tawk (выполняется в обработчике очереди webhook). Прилетают примерно такие данные
         {
             'questions': [
                 {'label': 'Name', 'answer': '...'},
@@ -95,7 +123,6 @@ class TawkController:
             'referrer': ''
         }
         """
-        data = request.json or {}
         # print('DATA FROM TAWK', data)
         lead_data = None
         # Кейс 1. Данные из оффлайн-формы, филиал и настройки будем определять по адресу сайта
@@ -109,12 +136,12 @@ class TawkController:
             lead_data = self.__handle_chat_end_event(
                 chat_name=chat_name,
                 channel_id=prop.get('id'),
-                chat_id=data['chatId']
+                chat_id=data['chatId'],
+                event_time=data.get('time')
             )
         if not lead_data:
-            return Response(status=204)
+            return
         self.__add_or_update_lead(data=lead_data)
-        return Response(status=200)
 
     @staticmethod
     def __get_offline_form_site(data: Dict) -> Optional[str]:
@@ -145,13 +172,7 @@ class TawkController:
 
     @staticmethod
     def __get_config_by_site(site: str) -> Tuple:
-        parsed_url = urlparse(site)
-        site = f"{parsed_url.scheme}://{parsed_url.netloc}".lower()
-        for key, value in Config().tawk.items():
-            for _site in value.get('sites') or []:
-                if _site.lower() == site:
-                    return key, value
-        return None, None
+        return Config().get_tawk_channel(site=site)
 
     def __handle_offline_form_event(self, site: str, data: Dict) -> Optional[Dict]:
         """ Прилетают примерно такие данные
@@ -193,15 +214,23 @@ class TawkController:
             'msg': msg
         }
 
-    def __handle_chat_end_event(self, chat_name: str, channel_id: str, chat_id: str) -> Optional[Dict]:
+    def __handle_chat_end_event(
+        self,
+        chat_name: str,
+        channel_id: str,
+        chat_id: str,
+        event_time: Optional[str] = None
+    ) -> Optional[Dict]:
         # по имени чата определяем филиал
         config = Config().tawk.get(chat_name) or {}
         branch = config.get('branch')
         if not branch:
             return None
-        tawk_data = self.__get_tawk_data(channel_id=channel_id, chat_id=chat_id, branch=branch)
+        tawk_data = TawkRestClient(branch=branch).get_messages_text_and_person(channel_id=channel_id, chat_id=chat_id)
+        self.__count_transcript(is_ready=bool(tawk_data), event_time=event_time)
         if not tawk_data:
-            return None
+            # данные нового чата могли не успеть записаться в базу Tawk - повторим позже, не занимая воркер
+            raise RetryLater(f'tawk chat {chat_id} is not ready', delays=Config().tawk_http['retry_delays'])
         name, phone, email, referer, ym_uid = self.__get_customer_data(person_dict=tawk_data.get('person') or {})
         if not phone or not email:
             return None
@@ -280,29 +309,31 @@ class TawkController:
 
     @staticmethod
     def __get_responsible_user_id(manager_id: str, branch: str) -> int:
-        managers = Config().managers.get(branch) or {}
-        tawk_amo_dict = {
-            value['tawk_id']: value['amo_id']
-            for value in managers.values()
-            if value['tawk_id'] and value['amo_id']
-        }
-        return tawk_amo_dict.get(manager_id) or 0
+        return (Config().tawk_amo_user_id.get(branch) or {}).get(manager_id) or 0
 
     @staticmethod
-    def __get_tawk_data(channel_id: str, chat_id: str, branch: str) -> Optional[Dict]:
-        # данные нового чата могли не успеть записаться в базу Tawk, поэтому циклим
-        tawk_data = None
-        counter = 0
-        max_counter = 24
-        while not tawk_data:
-            counter += 1
-            if counter > max_counter:
-                break
-            tawk_data = TawkRestClient(
-                branch=branch
-            ).get_messages_text_and_person(channel_id=channel_id, chat_id=chat_id)
-            time.sleep(5)
-        return tawk_data
+    def __count_transcript(is_ready: bool, event_time: Optional[str]):
+        """ Учитывает попытку получить историю чата в метриках
+
+        Args:
+            is_ready: история чата получена
+            event_time: время завершения чата из webhook (UTC, '2023-09-07T06:20:09.450Z')
+        """
+        seconds = None
+        if is_ready and event_time:
+            try:
+                ended_at = datetime.strptime(event_time, '%Y-%m-%dT%H:%M:%S.%fZ').replace(tzinfo=timezone.utc)
+                seconds = max(datetime.now(timezone.utc).timestamp() - ended_at.timestamp(), 0.0)
+            except ValueError:
+                pass
+        with metrics_lock:
+            if not is_ready:
+                transcript_metrics['not_ready'] += 1
+                return
+            transcript_metrics['ready'] += 1
+            if seconds is not None:
+                transcript_metrics['seconds_total'] += seconds
+                transcript_metrics['seconds_max'] = max(transcript_metrics['seconds_max'], seconds)
 
     @staticmethod
     def __get_utm_dict_from_url(url: Optional[str]) -> Dict:
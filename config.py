@@ -1,15 +1,50 @@
-""" Глобальные настройки Flask-приложения """
+""" Глобальные настройки Flask-приложения
+
+Notes:
+    Config() возвращает снимок конфига, общий для всего процесса: переменные окружения разбираются один раз
+        (при первом обращении к параметру), а не при каждом вызове. Снимок не изменяется - reload_config()
+        перечитывает окружение и подменяет снимок целиком, поэтому код, получивший снимок раньше,
+        продолжает работать с согласованными параметрами
+"""
 __author__ = 'ke.mizonov'
 import json
 import os
+import threading
+from functools import cached_property
+from typing import Dict, Tuple
+from urllib.parse import urlparse
 from dotenv import load_dotenv
 
 load_dotenv()
 
+# текущий снимок конфига
+snapshot = {'config': None}
+lock = threading.Lock()
+
 
 class Config:
     """ Конфиг, к которому обращается приложение. Параметры """
-    def __init__(self):
+    def __new__(cls):
+        config = snapshot['config']
+        if config is None:
+            with lock:
+                if snapshot['config'] is None:
+                    snapshot['config'] = cls._create()
+                config = snapshot['config']
+        return config
+
+    def __setattr__(self, key, value):
+        if self.__dict__.get('_Config__frozen'):
+            raise AttributeError('Config is read-only, use reload_config() to apply new settings')
+        super().__setattr__(key, value)
+
+    @classmethod
+    def _create(cls) -> 'Config':
+        config = super().__new__(cls)
+        config.__load()
+        return config
+
+    def __load(self):
         self.SQLALCHEMY_DATABASE_URI = self.sqlalchemy_database_uri
         self.CONNECTIONS_LIMIT = self.connections_limit
         self.CHROMEDRIVER_PATH = self.chromedriver_path
@@ -28,31 +63,81 @@ class Config:
         self.AMO_CHAT = self.amo_chat
         self.SECRET_KEY = self.secret_key
         self.WORKER = self.worker
+        self.__frozen = True
 
-    @property
+    @cached_property
     def sqlalchemy_database_uri(self):
         uri = os.environ.get('DATABASE_URL')
         if uri and uri.startswith("postgres://"):
             uri = uri.replace("postgres://", "postgresql://", 1)
         return uri
 
-    @property
+    @cached_property
+    def amo_http(self):
+        """
+        Returns:
+            {
+                "pool_connections": 4,
+                "pool_size": 10,
+                "connect_timeout": 5,
+                "read_timeout": 60,
+                "requests_per_second": 7,
+                "max_concurrency": 3,
+                "parallel_events": true,
+                "events_workers": 5
+            }
+        """
+        return {
+            'pool_connections': 4,
+            'pool_size': 10,
+            'connect_timeout': 5,
+            'read_timeout': 60,
+            # ограничение Amo - не более 7 запросов в секунду
+            'requests_per_second': 7,
+            'max_concurrency': 3,
+            # параллельная загрузка событий по пакетам сделок (load_events)
+            'parallel_events': True,
+            'events_workers': 5,
+            **json.loads(os.environ.get('AMO_HTTP') or '{}')
+        }
+
+    @cached_property
+    def tawk_http(self):
+        """
+        Returns:
+            {
+                "pool_size": 10,
+                "connect_timeout": 5,
+                "read_timeout": 30,
+                "retry_delays": [5, 5, 10, 15, 30, 60, 120, 300]
+            }
+        """
+        return {
+            'pool_size': 10,
+            'connect_timeout': 5,
+            'read_timeout': 30,
+            # задержки между попытками получить чат, который Tawk еще не сохранил (webhook приходит раньше)
+            'retry_delays': [5, 5, 10, 15, 30, 60, 120, 300],
+            **json.loads(os.environ.get('TAWK_HTTP') or '{}')
+        }
+
+    @cached_property
     def amo_chat(self):
         return json.loads(os.environ.get('AMO_CHAT') or '')
 
-    @property
+    @cached_property
     def continue_to_work(self):
         return json.loads(os.environ.get('CONTINUE_TO_WORK') or '')
 
-    @property
+    @cached_property
     def connections_limit(self):
         return int(os.environ.get('CONNECTIONS_LIMIT'))
 
-    @property
+    @cached_property
     def secret_key(self):
         return os.environ.get('SECRET_KEY')
 
-    @property
+    @cached_property
     def sm_telegram_bwa_notification(self):
         return [int(x) for x in (os.environ.get('SM_TELEGRAM_BWA_NOTIFICATION') or '').split(',') if x]
 
@@ -60,35 +145,124 @@ class Config:
     # def SQLALCHEMY_TRACK_MODIFICATIONS(self):
     #     return os.environ.get('SQLALCHEMY_TRACK_MODIFICATIONS')
 
-    @property
+    @cached_property
     def sm_telegram_bot_token(self):
         return os.environ.get('SM_TELEGRAM_BOT_TOKEN')
 
-    @property
+    @cached_property
     def leads_insurance(self):
         return {'swissmedica': '1OLqMKtNBf6DlI_ks9kJZ9Utn4eyJWs9kyF7J9WW2M9k'}
 
-    @property
+    @cached_property
     def sm_leads_insurance_channel(self):
         return os.environ.get('SM_LEADS_INSURANCE_CHANNEL')
 
-    @property
+    @cached_property
     def chromedriver_path(self):
         return os.environ.get('CHROMEDRIVER_PATH')
 
-    @property
+    @cached_property
     def chromedriver_binary_location(self):
         return os.environ.get('GOOGLE_CHROME_SHIM')
 
-    @property
+    @cached_property
     def google_credentials(self):
         return json.loads(os.environ.get('GOOGLE_CREDENTIALS') or '')
 
-    @property
+    @cached_property
+    def google_sheets_cache(self):
+        """ Кэш справочных листов Google Sheets
+
+        Returns:
+            {"ttl": 300} - время жизни данных листа, сек. (устаревшие данные отдаются, пока лист перечитывается)
+        """
+        return {'ttl': 300, **json.loads(os.environ.get('GOOGLE_SHEETS_CACHE') or '{}')}
+
+    @cached_property
+    def webhook_queue(self):
+        """ Очередь входящих webhook (Amo, Sipuni, Tawk)
+
+        Returns:
+            {
+                "workers": 4,               - одновременно обрабатываемых webhook
+                "batch": 20,                - webhook, забираемых из очереди за один раз
+                "interval": 5,              - период проверки очереди, сек.
+                "max_attempts": 5,          - попыток обработки до перевода в ошибку
+                "retry_delay": 30,          - пауза перед повтором (умножается на номер попытки), сек.
+                "processing_timeout": 600,  - через сколько секунд "зависшая" запись возвращается в очередь
+                "retention_days": 7         - сколько дней хранятся обработанные записи
+            }
+        """
+        return {
+            'workers': 4,
+            'batch': 20,
+            'interval': 5,
+            'max_attempts': 5,
+            'retry_delay': 30,
+            'processing_timeout': 600,
+            'retention_days': 7,
+            **json.loads(os.environ.get('WEBHOOK_QUEUE') or '{}')
+        }
+
+    @cached_property
+    def duplicates(self):
+        """ Поиск дублей сделок
+
+        Returns:
+            {"max_sync_lag": 600} - при каком отставании синхронизации с Amo, сек., поиск идет через Amo,
+                а не по локальному индексу
+        """
+        return {'max_sync_lag': 600, **json.loads(os.environ.get('DUPLICATES') or '{}')}
+
+    @cached_property
+    def reference_cache(self):
+        """ Кэш справочников Amo (воронки, статусы, пользователи)
+
+        Returns:
+            {"ttl": 300} - время жизни справочников, сек. (при изменении в Amo кэш сбрасывается синхронизацией)
+        """
+        return {'ttl': 300, **json.loads(os.environ.get('REFERENCE_CACHE') or '{}')}
+
+    @cached_property
+    def db_log(self):
+        """ Запись лога в БД
+
+        Returns:
+            {
+                "flush_interval": 2,        - период записи накопленных записей, сек.
+                "flush_size": 200,          - при таком количестве записей в буфере запись идет сразу
+                "retention_interval": 600,  - период удаления старых записей, сек.
+                "limit": 300000             - сколько последних записей хранить в таблице
+            }
+        """
+        return {
+            'flush_interval': 2,
+            'flush_size': 200,
+            'retention_interval': 600,
+            'limit': 300_000,
+            **json.loads(os.environ.get('DB_LOG') or '{}')
+        }
+
+    @cached_property
+    def data_store_path(self):
+        """ Каталог сегментных хранилищ данных Amo """
+        return os.environ.get('DATA_STORE_PATH') or 'data'
+
+    @cached_property
+    def data_store_compact_ratio(self):
+        """ Доля устаревших версий записей в сегменте хранилища, при превышении которой сегмент переписывается """
+        return float(os.environ.get('DATA_STORE_COMPACT_RATIO') or 0.5)
+
+    @cached_property
+    def legacy_pickle_path(self):
+        """ Каталог прежних pickle-файлов данных Amo (<имя хранилища>.pkl), переносимых в сегментные хранилища """
+        return os.environ.get('LEGACY_PICKLE_PATH') or '.'
+
+    @cached_property
     def heroku_url(self):
         return os.environ.get('HEROKU_URL')
 
-    @property
+    @cached_property
     def sipuni(self):
         return {
             "drvorobjev": {
@@ -454,35 +628,35 @@ class Config:
         }
         # return json.loads(os.environ.get('SIPUNI') or '')
 
-    @property
+    @cached_property
     def arrival(self):
         return json.loads(os.environ.get('ARRIVAL'))
 
-    @property
+    @cached_property
     def autocall_interval(self):
         return os.environ.get('AUTOCALL_INTERVAL')
 
-    @property
+    @cached_property
     def leads_insurance_interval(self):
         return os.environ.get('LEADS_INSURANCE_INTERVAL')
 
-    @property
+    @cached_property
     def new_lead_telegram(self):
         return json.loads(os.environ.get('NEW_LEAD_TELEGRAM') or '')
 
-    @property
+    @cached_property
     def meta_whatsapp_token(self):
         return os.environ.get('META_WHATSAPP_TOKEN')
 
-    @property
+    @cached_property
     def meta_system_user_token(self):
         return os.environ.get('META_SYSTEM_USER_TOKEN')
 
-    @property
+    @cached_property
     def whatsapp(self):
         return json.loads(os.environ.get('WHATSAPP') or '')
 
-    @property
+    @cached_property
     def tawk(self):
         """
         Returns:
@@ -507,19 +681,19 @@ class Config:
         """
         return json.loads(os.environ.get('TAWK') or '')
 
-    @property
+    @cached_property
     def tawk_rest_key(self):
         return json.loads(os.environ.get('TAWK_REST_KEY') or '')
 
-    @property
+    @cached_property
     def managers(self):
         return json.loads(os.environ.get('MANAGERS') or '')
 
-    @property
+    @cached_property
     def sipuni_cookies(self):
         return json.loads(os.environ.get('SIPUNI_COOKIES') or '')
 
-    @property
+    @cached_property
     def startstemcells_forms(self):
         return {
             '1878': {"n": "Subscription form - footer: IT", "r": "IT", "l": 0},
@@ -556,13 +730,109 @@ class Config:
         }
         # return json.loads(os.environ.get('STARTSTEMCELLS_FORMS') or '')
 
-    @property
+    @cached_property
     def swissmewdica_org_forms(self):
         return {
             'form480544796': {"n": "Innovative Therapy: EN", "r": "EN", "l": 0},
         }
         # return json.loads(os.environ.get('STARTSTEMCELLS_FORMS') or '')
 
-    @property
+    @cached_property
     def worker(self):
         return json.loads(os.environ.get('WORKER') or '')
+
+    @cached_property
+    def tawk_channel_by_site(self) -> Dict[str, Tuple[str, Dict]]:
+        """ Индекс каналов Tawk по сайту
+
+        Returns:
+            {"https://swiss-medica-2e0e7bc937df.herokuapp.com": ("cdv_main", {...конфиг канала...}), ...}
+        """
+        result = {}
+        for chat_name, config in self.tawk.items():
+            for site in config.get('sites') or []:
+                # сайт, указанный в нескольких каналах, относится к первому из них
+                result.setdefault(site.lower(), (chat_name, config))
+        return result
+
+    @cached_property
+    def tawk_amo_user_id(self) -> Dict[str, Dict[str, int]]:
+        """ Индекс идентификаторов пользователей Amo по идентификатору менеджера в Tawk
+
+        Returns:
+            {"SM": {"<tawk_id>": <amo_id>, ...}, ...}
+        """
+        return {
+            branch: {
+                value['tawk_id']: value['amo_id']
+                for value in (managers or {}).values()
+                if value['tawk_id'] and value['amo_id']
+            }
+            for branch, managers in self.managers.items()
+        }
+
+    @cached_property
+    def whatsapp_branch_by_number_id(self) -> Dict[str, str]:
+        """ Индекс филиалов по идентификатору номера WhatsApp (phone_number_id)
+
+        Returns:
+            {"151648284687808": "drvorobjev", ...}
+        """
+        result = {}
+        for branch, config in self.whatsapp.items():
+            for number in config.get('numbers') or []:
+                result.setdefault(number['id'], branch)
+        return result
+
+    @cached_property
+    def whatsapp_template_by_name(self) -> Dict[str, Tuple[str, Dict]]:
+        """ Индекс шаблонов WhatsApp по имени
+
+        Returns:
+            {"couldnt_reach_you_serbian": ("drvorobjev", {...шаблон...}), ...}
+        """
+        result = {}
+        for branch, config in self.whatsapp.items():
+            for template in config.get('templates') or []:
+                result.setdefault(template['name'], (branch, template))
+        return result
+
+    @cached_property
+    def sipuni_autocall_id(self) -> Dict[str, Dict[Tuple[str, str], int]]:
+        """ Индекс идентификаторов автообзвонов Sipuni по воронке и статусу Amo
+
+        Returns:
+            {"drvorobjev": {("7010970", "58840350"): 21774, ...}, ...}
+        """
+        result = {}
+        for branch, config in self.sipuni.items():
+            autocall_ids = result[branch] = {}
+            for autocall_id, data in (config.get('autocall') or {}).items():
+                autocall_ids.setdefault((str(data.get('pipeline_id')), str(data.get('status_id'))), int(autocall_id))
+        return result
+
+    def get_tawk_channel(self, site: str) -> Tuple:
+        """ Канал Tawk, к которому относится сайт
+
+        Args:
+            site: адрес страницы (учитываются только схема и домен)
+
+        Returns:
+            (имя канала, конфиг канала), либо (None, None)
+        """
+        parsed_url = urlparse(site)
+        return self.tawk_channel_by_site.get(f"{parsed_url.scheme}://{parsed_url.netloc}".lower()) or (None, None)
+
+
+def reload_config() -> Config:
+    """ Перечитывает настройки (переменные окружения и .env) и подменяет снимок конфига
+
+    Returns:
+        новый снимок конфига
+    """
+    load_dotenv(override=True)
+    # новый снимок разбирается до подмены: пока он строится, остальные потоки работают со старым
+    config = Config._create()
+    with lock:
+        snapshot['config'] = config
+    return config
@@ -11,17 +11,22 @@ from datetime import datetime, date, time
 import os
 from dataclasses import dataclass, field
 from typing import Dict, List, Optional, Union, Tuple
-import pythoncom
-import win32ctypes
-import win32timezone
-from PIL import ImageGrab
 from pandas import DataFrame, ExcelWriter, read_excel, read_csv
-# фикс см. https://stackoverflow.com/questions/33267002/why-am-i-suddenly-getting-a-no-attribute-clsidtopackagemap-error-with-win32com
-import win32com.client  # pip install pywin32
+try:
+    import pythoncom
+    import win32ctypes
+    import win32timezone
+    from PIL import ImageGrab
+    # фикс см. https://stackoverflow.com/questions/33267002/why-am-i-suddenly-getting-a-no-attribute-clsidtopackagemap-error-with-win32com
+    import win32com.client  # pip install pywin32
+except ImportError:
+    # без Excel (не Windows) сводные таблицы строятся через pandas и XlsxWriter, см. utils.pivot
+    pythoncom = win32ctypes = win32timezone = ImageGrab = win32com = None
 from utils.constants import DataBase, PivotDataBase, ConditionalFormattingBase, ConsolidationFunctionBase, \
     GroupFunctionBase, PivotFieldBase, NumberFormatBase, IMG_EXT, ColWidthBase, PivotFilterBase, PivotColBase, \
     CalculationConstantBase, AnalysisBase
 from utils.errors import UnknownFileFormatError
+from utils.pivot import build_pivot, write_pivot_sheet
 from worker.worker import Worker
 
 
@@ -128,16 +133,20 @@ class ExcelClient:
                     continue
                 self.__write_data_to_sheet(writer=writer, sheet_data=sheet_data, file=file)
 
-    def write_pivot(self, data: Data, worker: Optional[Worker] = None):
+    def write_pivot(self, data: Data, worker: Optional[Worker] = None, headless: bool = False):
         """ Создание файла Excel со сводной таблицей
 
         Args:
             data: данные в формате Data
             worker: экземпляр воркера
+            headless: построить сводные таблицы без Excel (если Excel недоступен, они строятся так в любом случае)
 
         References:
             https://www.youtube.com/watch?v=ZS4d3JvbQHQ
         """
+        if headless or self.is_headless():
+            self.write_pivot_headless(data=data, worker=worker)
+            return
         if worker:
             worker.emit({'msg': 'Building pivot tables...'})
         script_dir = os.path.abspath(os.curdir)
@@ -376,6 +385,49 @@ class ExcelClient:
         # скриншот
         # self.__save_range_image(sheet=pivot_sheet)
 
+    def write_pivot_headless(self, data: Data, worker: Optional[Worker] = None):
+        """ Создание файла Excel со сводной таблицей без Excel: сводные вычисляются pandas и записываются XlsxWriter
+
+        Notes:
+            В отличие от сводных таблиц Excel, результат статичен (без кэша сводной и возможности перестроения),
+                зато файл строится на любой ОС и не требует запущенного приложения Excel
+
+        Args:
+            data: данные в формате Data
+            worker: экземпляр воркера
+        """
+        if worker:
+            worker.emit({'msg': 'Building pivot tables...'})
+        if data.outer_file:
+            if worker:
+                worker.emit({'msg': 'Loading data from file...'})
+            df = read_excel(os.path.join(self.file_path, f'{data.outer_file}{self.file_ext}'), sheet_name=0)
+        else:
+            df = DataFrame(data.data)
+        self.__make_dir()
+        with ExcelWriter(os.path.join(self.file_path, f'{self.file_name}{self.file_ext}'), engine='xlsxwriter') as writer:
+            df.to_excel(writer, sheet_name='data', index=False)
+            for pivot_data in data.pivot:
+                if worker and not worker.isRunning:
+                    worker.emit({'done': True})
+                    worker.terminate()
+                    return
+                if worker:
+                    worker.emit({'msg': f'Building pivot table {pivot_data.sheet}...'})
+                write_pivot_sheet(
+                    writer=writer,
+                    result=build_pivot(df=df, data=pivot_data),
+                    data=pivot_data,
+                    first_data_row=pivot_data.first_data_row or self.first_data_row(data=pivot_data)
+                )
+        if worker:
+            worker.emit({'msg': 'Saving result...'})
+
+    @staticmethod
+    def is_headless() -> bool:
+        """ Excel (win32com) недоступен - сводные таблицы строятся без него """
+        return win32com is None
+
     @staticmethod
     def first_data_row(data: PivotData):
         filters_len = len(data.filters or [])
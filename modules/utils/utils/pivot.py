@@ -0,0 +1,352 @@
+""" Построение сводных таблиц без Excel (pandas + XlsxWriter)
+
+Notes:
+    Вычисляет объявления PivotData так же, как это делает сводная таблица Excel: фильтры, строки, столбцы,
+        значения с консолидирующими функциями, вычисляемые поля, константы вычислений и группировку дат
+        по неделям / месяцам, - и записывает результат на лист книги через XlsxWriter.
+        Работает на любой ОС, Excel (win32com) не нужен
+"""
+__author__ = 'ke.mizonov'
+import re
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional, Tuple
+import numpy as np
+from pandas import DataFrame, ExcelWriter, Series, Timedelta, to_datetime, to_numeric, to_timedelta
+from utils.constants import CalculationConstantBase, ConditionalFormattingBase, ConsolidationFunctionBase, \
+    PivotDataBase, PivotFieldBase
+
+GRAND_TOTAL = 'Grand Total'
+ALL_ITEMS = '(All)'
+AGGREGATIONS = {
+    ConsolidationFunctionBase.Average: 'mean',
+    ConsolidationFunctionBase.Count: 'count',
+    ConsolidationFunctionBase.Summ: 'sum',
+}
+# поле в формуле вычисляемого поля: 'имя в кавычках' либо имя без кавычек
+FORMULA_FIELD = re.compile(r"'([^']+)'|([^\W\d]\w*)")
+
+
+@dataclass()
+class PivotResult:
+    """ Вычисленная сводная таблица """
+    headers: List[str] = field(init=True, default_factory=list)
+    # строки таблицы: (уровень вложенности, значения); уровень 0 - верхний
+    lines: List[Tuple[int, List[Any]]] = field(init=True, default_factory=list)
+    # параметры значений (по одному на каждый столбец значений)
+    value_fields: List[PivotFieldBase] = field(init=True, default_factory=list)
+    # фильтры: (поле, выбранные значения)
+    filters: List[Tuple[str, str]] = field(init=True, default_factory=list)
+
+
+def build_pivot(df: DataFrame, data: PivotDataBase) -> PivotResult:
+    """ Вычисляет сводную таблицу
+
+    Args:
+        df: исходные данные
+        data: объявление сводной таблицы
+
+    Returns:
+        вычисленная сводная таблица
+    """
+    result = PivotResult()
+    # фильтры
+    for _filter in data.filters or []:
+        if _filter.key not in df.columns:
+            continue
+        if _filter.selected:
+            df = df[df[_filter.key].astype(str).isin([str(x) for x in _filter.selected])]
+            result.filters.append((_filter.key, ', '.join(str(x) for x in _filter.selected)))
+        else:
+            result.filters.append((_filter.key, ALL_ITEMS))
+    rows = [key for key in data.rows or [] if key in df.columns]
+    cols = [col for col in data.cols or [] if col.key in df.columns]
+    # видимые элементы столбцов
+    for col in cols:
+        if col.selected:
+            df = df[df[col.key].astype(str).isin([str(x) for x in col.selected])]
+    df = df.copy()
+    for key in rows + [col.key for col in cols]:
+        df[key] = df[key].fillna('').astype(str)
+    if rows and data.group_function:
+        df[rows[0]] = _group_dates(series=df[rows[0]], group_function=data.group_function)
+    values = [item for item in data.values or [] if item.key]
+    calculator = _ValuesCalculator(df=df, values=values)
+    col_keys = [col.key for col in cols]
+    col_items = _col_items(df=df, cols=cols)
+    # заголовки
+    result.headers.append(rows[0] if rows else '')
+    for item in col_items + [GRAND_TOTAL] if col_items else [None]:
+        label = ' / '.join(item) if isinstance(item, tuple) else item
+        for value in values:
+            # при единственном поле значений в заголовке столбца - только элемент, как в Excel
+            if label is None:
+                result.headers.append(_caption(value))
+            elif len(values) == 1:
+                result.headers.append(label)
+            else:
+                result.headers.append(f'{label} - {_caption(value)}')
+            result.value_fields.append(value)
+    # строки
+    if rows:
+        top = calculator.table(keys=rows[:1] + col_keys)
+        top_totals = calculator.table(keys=rows[:1]) if col_items else top
+        details = calculator.table(keys=rows + col_keys) if len(rows) > 1 else None
+        details_totals = (calculator.table(keys=rows) if col_items else details) if details is not None else None
+        for top_key in sorted(top_totals.keys()):
+            result.lines.append((0, [top_key[0]] + _line(
+                table=top, totals=top_totals, key=top_key, col_items=col_items, values=values
+            )))
+            if details is None:
+                continue
+            for detail_key in sorted(key for key in details_totals.keys() if key[0] == top_key[0]):
+                result.lines.append((1, [' / '.join(detail_key[1:])] + _line(
+                    table=details, totals=details_totals, key=detail_key, col_items=col_items, values=values
+                )))
+    # общий итог
+    grand = calculator.table(keys=col_keys) if col_items else calculator.table(keys=[])
+    grand_totals = calculator.table(keys=[]) if col_items else grand
+    grand_line = []
+    for item in col_items:
+        grand_line.extend((grand.get(item if isinstance(item, tuple) else (item, )) or {}).get(i) for i in range(len(values)))
+    grand_line.extend((grand_totals.get(()) or {}).get(i) for i in range(len(values)))
+    result.lines.append((0, [GRAND_TOTAL] + grand_line))
+    return result
+
+
+def write_pivot_sheet(writer: ExcelWriter, result: PivotResult, data: PivotDataBase, first_data_row: int):
+    """ Записывает сводную таблицу на новый лист книги
+
+    Args:
+        writer: pandas ExcelWriter (движок xlsxwriter)
+        result: вычисленная сводная таблица
+        data: объявление сводной таблицы
+        first_data_row: номер первой строки с данными (как в Excel, нумерация с 1)
+    """
+    workbook = writer.book
+    sheet = workbook.add_worksheet(data.sheet)
+    header_format = workbook.add_format({'bold': True, 'text_wrap': True, 'valign': 'top', 'bottom': 1})
+    total_format = workbook.add_format({'bold': True, 'top': 1})
+    formats = [
+        workbook.add_format({'num_format': _number_format(value.number_format)}) if value.number_format else None
+        for value in result.value_fields
+    ]
+    # фильтры над таблицей
+    for num, (key, selected) in enumerate(result.filters):
+        sheet.write(num, 0, key)
+        sheet.write(num, 1, selected)
+    header_row = first_data_row - 2
+    for col, header in enumerate(result.headers):
+        sheet.write(header_row, col, header, header_format)
+    row = header_row
+    for row, (level, line) in enumerate(result.lines, header_row + 1):
+        is_total = row == header_row + len(result.lines)
+        sheet.write(row, 0, line[0], total_format if is_total else None)
+        for col, value in enumerate(line[1:], 1):
+            if value is None or (isinstance(value, float) and np.isnan(value)):
+                continue
+            sheet.write_number(row, col, float(value), formats[col - 1])
+        if level:
+            sheet.set_row(row, None, None, {'level': level, 'hidden': bool(data.collide)})
+    # итоги групп - над вложенными строками
+    sheet.outline_settings(True, False, True, False)
+    last_data_row = row - 1
+    # условное форматирование (без строки общего итога)
+    for col, value in enumerate(result.value_fields, 1):
+        if value.conditional_formatting is None or last_data_row <= header_row:
+            continue
+        sheet.conditional_format(header_row + 1, col, last_data_row, col, _conditional_format(value))
+    # ширина колонок
+    for col, width in enumerate(data.col_width or []):
+        sheet.set_column(col, col, width)
+    if not data.graph and data.freeze_panes:
+        sheet.freeze_panes(header_row + 1, 1)
+    if data.graph and last_data_row > header_row:
+        chart = workbook.add_chart({'type': 'column'})
+        for col in range(1, len(result.headers)):
+            chart.add_series({
+                'name': [data.sheet, header_row, col],
+                'categories': [data.sheet, header_row + 1, 0, last_data_row, 0],
+                'values': [data.sheet, header_row + 1, col, last_data_row, col],
+            })
+        chart.set_size({'width': 1000, 'height': 600})
+        sheet.insert_chart(header_row, len(result.headers) + 1, chart)
+
+
+class _ValuesCalculator:
+    """ Вычисляет значения сводной таблицы для произвольного набора ключей группировки """
+
+    def __init__(self, df: DataFrame, values: List[PivotFieldBase]):
+        self.df = df
+        self.values = values
+        self.__numeric: Dict[str, Series] = {}
+        self.__filled: Dict[str, Series] = {}
+        # ссылки вычисляемых полей на поля данных
+        self.formulas: Dict[int, Tuple[str, List[str]]] = {
+            i: _compile_formula(value.calculated)
+            for i, value in enumerate(values) if isinstance(value.calculated, str)
+        }
+        self.__grand: Optional[Dict[int, Any]] = None
+
+    def table(self, keys: List[str]) -> Dict[Tuple, Dict[int, Any]]:
+        """ Значения по группам
+
+        Args:
+            keys: поля группировки (пустой список - общий итог)
+
+        Returns:
+            словарь вида { ключ группы: { номер значения: значение } }
+        """
+        frame = DataFrame(index=self.df.index)
+        for key in keys:
+            frame[key] = self.df[key]
+        # количество строк данных в группе (чтобы группы строились и без полей значений)
+        columns = {'__rows': (Series(1, index=self.df.index), 'sum')}
+        for i, value in enumerate(self.values):
+            if i in self.formulas:
+                for num, ref in enumerate(self.formulas[i][1]):
+                    columns[f'__f{i}_{num}'] = (self.__numeric_column(ref), 'sum')
+                continue
+            func = AGGREGATIONS.get(value.consolidation_function, 'sum')
+            if func == 'count':
+                columns[f'__v{i}'] = (self.__filled_column(value.key), 'sum')
+            else:
+                columns[f'__v{i}'] = (self.__numeric_column(value.key), func)
+        for name, (column, _) in columns.items():
+            frame[name] = column
+        aggregations = {name: func for name, (_, func) in columns.items()}
+        if keys:
+            base = frame.groupby(keys, sort=False).agg(aggregations)
+        else:
+            base = DataFrame([{name: getattr(frame[name], func)() for name, func in aggregations.items()}], index=[()])
+        table = {}
+        for index, line in base.iterrows():
+            key = index if isinstance(index, tuple) else (index, )
+            table[key] = self.__line_values(line=line)
+        return table
+
+    def __line_values(self, line: Series) -> Dict[int, Any]:
+        result = {}
+        for i, value in enumerate(self.values):
+            if i in self.formulas:
+                expression, refs = self.formulas[i]
+                namespace = {f'__f{num}': line[f'__f{i}_{num}'] for num in range(len(refs))}
+                result[i] = _evaluate(expression=expression, namespace=namespace)
+                continue
+            result[i] = line[f'__v{i}']
+            if value.calculated == CalculationConstantBase.PercentOfTotal:
+                total = self.__grand_total().get(i)
+                result[i] = result[i] / total if total else None
+        return result
+
+    def __grand_total(self) -> Dict[int, Any]:
+        if self.__grand is None:
+            self.__grand = {}
+            for i, value in enumerate(self.values):
+                if i in self.formulas:
+                    continue
+                func = AGGREGATIONS.get(value.consolidation_function, 'sum')
+                column = self.__filled_column(value.key) if func == 'count' else self.__numeric_column(value.key)
+                self.__grand[i] = column.sum() if func in ('count', 'sum') else column.mean()
+        return self.__grand
+
+    def __numeric_column(self, key: str) -> Series:
+        if key not in self.__numeric:
+            self.__numeric[key] = to_numeric(self.df[key], errors='coerce') if key in self.df.columns else \
+                Series(np.nan, index=self.df.index)
+        return self.__numeric[key]
+
+    def __filled_column(self, key: str) -> Series:
+        # Count в Excel считает непустые ячейки
+        if key not in self.__filled:
+            if key in self.df.columns:
+                column = self.df[key]
+                self.__filled[key] = (column.notna() & (column.astype(str) != '')).astype(int)
+            else:
+                self.__filled[key] = Series(0, index=self.df.index)
+        return self.__filled[key]
+
+
+def _line(table: Dict, totals: Dict, key: Tuple, col_items: List, values: List[PivotFieldBase]) -> List:
+    line = []
+    for item in col_items:
+        cell = table.get(key + (item if isinstance(item, tuple) else (item, ))) or {}
+        line.extend(cell.get(i) for i in range(len(values)))
+    cell = totals.get(key) or {}
+    line.extend(cell.get(i) for i in range(len(values)))
+    return line
+
+
+def _col_items(df: DataFrame, cols: List) -> List:
+    """ Элементы столбцов сводной таблицы: в порядке selected, остальные - по алфавиту """
+    if not cols:
+        return []
+    if len(cols) == 1:
+        col = cols[0]
+        present = set(df[col.key].unique())
+        if col.selected:
+            return [str(x) for x in col.selected if str(x) in present]
+        return sorted(present)
+    return sorted(set(map(tuple, df[[col.key for col in cols]].drop_duplicates().values.tolist())))
+
+
+def _group_dates(series: Series, group_function: Callable) -> Series:
+    """ Группировка дат по неделям (7 дней от самой ранней даты) или по месяцам, как в Excel """
+    name = getattr(group_function, '__name__', '')
+    if name not in ('by_weeks', 'by_months'):
+        return series
+    dates = to_datetime(series.where(series != ''), errors='coerce')
+    if dates.isna().all():
+        return series
+    if name == 'by_weeks':
+        start = dates.min().normalize()
+        week_start = start + to_timedelta(((dates.dt.normalize() - start).dt.days // 7) * 7, unit='D')
+        labels = week_start.dt.strftime('%Y-%m-%d') + ' - ' + (week_start + Timedelta(days=6)).dt.strftime('%Y-%m-%d')
+    else:
+        labels = dates.dt.strftime('%Y-%m')
+    return labels.where(dates.notna(), '')
+
+
+def _compile_formula(formula: str) -> Tuple[str, List[str]]:
+    """ Приводит формулу вычисляемого поля Excel (= 'field_a' / field_b) к выражению Python """
+    refs = []
+
+    def replace(match) -> str:
+        name = match.group(1) or match.group(2)
+        if name not in refs:
+            refs.append(name)
+        return f'__f{refs.index(name)}'
+
+    expression = FORMULA_FIELD.sub(replace, formula.strip().lstrip('='))
+    return expression, refs
+
+
+def _evaluate(expression: str, namespace: Dict[str, Any]) -> Optional[float]:
+    try:
+        value = eval(expression, {'__builtins__': {}}, namespace)
+    except (ZeroDivisionError, TypeError, ValueError):
+        return None
+    if value is None or not np.isfinite(value):
+        return None
+    return value
+
+
+def _caption(value: PivotFieldBase) -> str:
+    return (value.displayed_name or value.key).strip()
+
+
+def _number_format(number_format: str) -> str:
+    """ Формат Excel в русской локали (# ##0,00) -> формат XlsxWriter (#,##0.00) """
+    return re.sub(r',(0+)', r'.\1', number_format.replace('# ##0', '#,##0'))
+
+
+def _conditional_format(value: PivotFieldBase) -> Dict:
+    if value.conditional_formatting == ConditionalFormattingBase.Bars:
+        return {'type': 'data_bar', 'bar_color': '#63C384'}
+    green, yellow, red = '#63BE7B', '#FFEB84', '#F8696B'
+    max_is_green = value.conditional_formatting == ConditionalFormattingBase.MaxIsGreen
+    return {
+        'type': '3_color_scale',
+        'min_color': red if max_is_green else green,
+        'mid_color': yellow,
+        'max_color': green if max_is_green else red,
+    }